@@ -0,0 +1,302 @@
+"""
+Python client for the AR Reconciliation Engine (ar_matching.py).
+
+Both clients keep HTTP/1.1 keep-alive connections in a pool, accept gzip responses, retry
+429/502/503/504 and connection errors with exponential backoff (honoring Retry-After), and
+send an Idempotency-Key with every /reconcile call so a retried POST is answered from the
+server's result cache instead of being reconciled twice.
+
+Payloads larger than the server's limits (published by /health) are split into payment chunks
+and sent one after the other; invoices matched by a chunk are removed from the open items of the
+next one, and the responses are merged into a single /reconcile-shaped result.
+
+    from ar_client import ARMatchingClient
+    with ARMatchingClient("https://armatching-production.up.railway.app", api_key) as client:
+        result = client.reconcile(payload, top_k=3)
+        results = client.reconcile_many([payload_a, payload_b])
+
+    from ar_client import AsyncARMatchingClient
+    async with AsyncARMatchingClient(base_url, api_key, max_concurrency=8) as client:
+        results = await client.reconcile_many(payloads)
+"""
+import asyncio
+import concurrent.futures
+import os
+import random
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_BASE_URL = os.getenv("AR_MATCHING_URL", "https://armatching-production.up.railway.app")
+# Used when the server predates the "limits" block in /health
+DEFAULT_LIMITS = {"max_payments": 1000, "max_open_items": 1000, "max_batch_entities": 100}
+RETRY_STATUSES = {429, 502, 503, 504}
+MAX_RETRY_AFTER_SECONDS = 30.0
+
+
+class ARMatchingError(Exception):
+    """Non-retryable error response, or retries exhausted"""
+    def __init__(self, status_code: int, detail: Any):
+        super().__init__(f"HTTP {status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _retry_delay(attempt: int, backoff: float, retry_after: Optional[str]) -> float:
+    """Retry-After when the server sent one, otherwise exponential backoff with full jitter"""
+    if retry_after:
+        try:
+            return min(float(retry_after), MAX_RETRY_AFTER_SECONDS)
+        except ValueError:
+            pass
+    return random.uniform(0, backoff * (2 ** attempt))
+
+
+def _error_detail(response) -> Any:
+    try:
+        return response.json().get("detail", response.text)
+    except ValueError:
+        return response.text
+
+
+def _limits_from_health(health: Dict[str, Any]) -> Dict[str, int]:
+    return {**DEFAULT_LIMITS, **health.get("limits", {})}
+
+
+def _check_open_items(payload: Dict[str, Any], limits: Dict[str, int]) -> None:
+    # Open items are not split: a payment has to see every invoice it could match
+    if len(payload.get("open_items", [])) > limits["max_open_items"]:
+        raise ValueError(
+            f"{len(payload['open_items'])} open items exceed the server limit of {limits['max_open_items']}; "
+            "split the ledger by entity and use reconcile_batch()"
+        )
+
+
+def _payment_chunks(payload: Dict[str, Any], limits: Dict[str, int]) -> List[List[dict]]:
+    payments = payload.get("payments", [])
+    size = limits["max_payments"]
+    return [payments[i:i + size] for i in range(0, len(payments), size)] or [[]]
+
+
+def _matched_invoice_ids(result: Dict[str, Any]) -> set:
+    return {iid for bucket in ("high_confidence", "hitl_review") for g in result[bucket] for iid in g["invoice_ids"]}
+
+
+def merge_results(results: List[Dict[str, Any]], total_invoices: int) -> Dict[str, Any]:
+    """
+    Merge the responses of consecutive payment chunks into one /reconcile response.
+    Unmatched invoices are taken from the last chunk only, since every chunk re-sends
+    the invoices that are still open.
+    """
+    if len(results) == 1:
+        return results[0]
+    merged = {
+        "high_confidence": [g for r in results for g in r["high_confidence"]],
+        "hitl_review": [g for r in results for g in r["hitl_review"]],
+        "no_match": [g for r in results for g in r["no_match"] if g["payment_ids"]]
+                    + [g for g in results[-1]["no_match"] if not g["payment_ids"]],
+        "duplicates": [g for r in results for g in r.get("duplicates", [])],
+        "partial": any(r.get("partial", False) for r in results),
+        "skipped_stages": list(dict.fromkeys(s for r in results for s in r.get("skipped_stages", []))),
+        "unprocessed_payment_ids": [pid for r in results for pid in r.get("unprocessed_payment_ids", [])],
+    }
+    summary = {key: sum(r["summary"].get(key, 0) for r in results) for key in results[0]["summary"]}
+    summary["no_match_invoices"] = results[-1]["summary"]["no_match_invoices"]
+    summary["total_invoices_processed"] = total_invoices
+    merged["summary"] = summary
+    return merged
+
+
+def _next_chunk_payload(payload: Dict[str, Any], chunk: List[dict], open_items: List[dict]) -> Dict[str, Any]:
+    return {**payload, "payments": chunk, "open_items": open_items}
+
+
+class ARMatchingClient:
+    """Thread-safe synchronous client on a pooled requests.Session"""
+
+    def __init__(self, base_url: str = DEFAULT_BASE_URL, api_key: Optional[str] = None, timeout: float = 60.0,
+                 max_retries: int = 3, backoff: float = 0.5, max_concurrency: int = 4):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_concurrency = max_concurrency
+        self._limits = None
+
+        self.session = requests.Session()
+        # One pooled connection per concurrent call; retries are handled below so Retry-After is honored
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(max_concurrency, 1), max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"X-API-Key": api_key or os.getenv("API_KEY", ""), "Accept-Encoding": "gzip"})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.session.close()
+
+    def _request(self, method: str, path: str, **kwargs) -> Dict[str, Any]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(method, f"{self.base_url}{path}", timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(_retry_delay(attempt, self.backoff, None))
+                continue
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                time.sleep(_retry_delay(attempt, self.backoff, response.headers.get("Retry-After")))
+                continue
+            if response.status_code >= 400:
+                raise ARMatchingError(response.status_code, _error_detail(response))
+            return response.json()
+
+    def health(self) -> Dict[str, Any]:
+        return self._request("GET", "/health")
+
+    def metrics(self) -> Dict[str, Any]:
+        return self._request("GET", "/metrics")
+
+    def limits(self) -> Dict[str, int]:
+        if self._limits is None:
+            self._limits = _limits_from_health(self.health())
+        return self._limits
+
+    def _reconcile_once(self, payload: Dict[str, Any], top_k: int, deadline_ms: Optional[int], key: str) -> Dict[str, Any]:
+        headers = {"Idempotency-Key": key}
+        if deadline_ms:
+            headers["X-Deadline-Ms"] = str(deadline_ms)
+        return self._request("POST", "/reconcile", json=payload, params={"top_k": top_k}, headers=headers)
+
+    def reconcile(self, payload: Dict[str, Any], top_k: int = 0, deadline_ms: Optional[int] = None,
+                  idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """POST /reconcile, chunking payments that exceed the server limit"""
+        limits = self.limits()
+        _check_open_items(payload, limits)
+        key = idempotency_key or uuid.uuid4().hex
+        chunks = _payment_chunks(payload, limits)
+        if len(chunks) == 1:
+            return self._reconcile_once(payload, top_k, deadline_ms, key)
+
+        open_items = payload.get("open_items", [])
+        results = []
+        for n, chunk in enumerate(chunks):
+            result = self._reconcile_once(_next_chunk_payload(payload, chunk, open_items), top_k, deadline_ms, f"{key}-{n}")
+            matched = _matched_invoice_ids(result)
+            open_items = [inv for inv in open_items if inv["invoice_id"] not in matched]
+            results.append(result)
+        return merge_results(results, len(payload.get("open_items", [])))
+
+    def reconcile_many(self, payloads: List[Dict[str, Any]], **kwargs) -> List[Dict[str, Any]]:
+        """Reconcile independent payloads with at most max_concurrency calls in flight; results keep input order"""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            return list(pool.map(lambda p: self.reconcile(p, **kwargs), payloads))
+
+    def reconcile_batch(self, entities: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """POST /reconcile/batch in slices of the server's max entities; returns the per-entity results"""
+        size = self.limits()["max_batch_entities"]
+        results = []
+        for i in range(0, len(entities), size):
+            results.extend(self._request("POST", "/reconcile/batch", json={"entities": entities[i:i + size]})["results"])
+        return results
+
+
+class AsyncARMatchingClient:
+    """asyncio client on a pooled httpx.AsyncClient; max_concurrency bounds the calls in flight"""
+
+    def __init__(self, base_url: str = DEFAULT_BASE_URL, api_key: Optional[str] = None, timeout: float = 60.0,
+                 max_retries: int = 3, backoff: float = 0.5, max_concurrency: int = 8,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_concurrency = max_concurrency
+        self._limits = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.client = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            headers={"X-API-Key": api_key or os.getenv("API_KEY", ""), "Accept-Encoding": "gzip"},
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+            transport=transport,
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def _request(self, method: str, path: str, **kwargs) -> Dict[str, Any]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    response = await self.client.request(method, path, **kwargs)
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(_retry_delay(attempt, self.backoff, None))
+                continue
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                await asyncio.sleep(_retry_delay(attempt, self.backoff, response.headers.get("Retry-After")))
+                continue
+            if response.status_code >= 400:
+                raise ARMatchingError(response.status_code, _error_detail(response))
+            return response.json()
+
+    async def health(self) -> Dict[str, Any]:
+        return await self._request("GET", "/health")
+
+    async def metrics(self) -> Dict[str, Any]:
+        return await self._request("GET", "/metrics")
+
+    async def limits(self) -> Dict[str, int]:
+        if self._limits is None:
+            self._limits = _limits_from_health(await self.health())
+        return self._limits
+
+    async def _reconcile_once(self, payload: Dict[str, Any], top_k: int, deadline_ms: Optional[int], key: str) -> Dict[str, Any]:
+        headers = {"Idempotency-Key": key}
+        if deadline_ms:
+            headers["X-Deadline-Ms"] = str(deadline_ms)
+        return await self._request("POST", "/reconcile", json=payload, params={"top_k": top_k}, headers=headers)
+
+    async def reconcile(self, payload: Dict[str, Any], top_k: int = 0, deadline_ms: Optional[int] = None,
+                        idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """POST /reconcile, chunking payments that exceed the server limit"""
+        limits = await self.limits()
+        _check_open_items(payload, limits)
+        key = idempotency_key or uuid.uuid4().hex
+        chunks = _payment_chunks(payload, limits)
+        if len(chunks) == 1:
+            return await self._reconcile_once(payload, top_k, deadline_ms, key)
+
+        open_items = payload.get("open_items", [])
+        results = []
+        for n, chunk in enumerate(chunks):
+            result = await self._reconcile_once(_next_chunk_payload(payload, chunk, open_items), top_k, deadline_ms, f"{key}-{n}")
+            matched = _matched_invoice_ids(result)
+            open_items = [inv for inv in open_items if inv["invoice_id"] not in matched]
+            results.append(result)
+        return merge_results(results, len(payload.get("open_items", [])))
+
+    async def reconcile_many(self, payloads: List[Dict[str, Any]], **kwargs) -> List[Dict[str, Any]]:
+        """Reconcile independent payloads concurrently; results keep input order"""
+        return list(await asyncio.gather(*(self.reconcile(p, **kwargs) for p in payloads)))
+
+    async def reconcile_batch(self, entities: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """POST /reconcile/batch in slices of the server's max entities; returns the per-entity results"""
+        size = (await self.limits())["max_batch_entities"]
+        slices = [entities[i:i + size] for i in range(0, len(entities), size)]
+        responses = await asyncio.gather(*(self._request("POST", "/reconcile/batch", json={"entities": s}) for s in slices))
+        return [result for response in responses for result in response["results"]]
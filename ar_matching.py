@@ -1,16 +1,52 @@
-from fastapi import FastAPI, Request, HTTPException, Security, Depends
+from fastapi import FastAPI, Request, Response, HTTPException, Security, Depends, Header, Query
 from fastapi.security import APIKeyHeader
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from fastapi.responses import StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, ConfigDict, NonNegativeFloat, PrivateAttr
+from typing import List, Optional, Dict, Any, NamedTuple, Callable
 import uvicorn
-from rapidfuzz import fuzz
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+from rapidfuzz import fuzz, process
+from rapidfuzz.distance import OSA
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from collections.abc import Mapping
 import os
 from dotenv import load_dotenv
 import json
+import time
+import bisect
+import re
+import hashlib
+import hmac
+import random
+import string
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import sqlite3
+import mmap
+import struct
+import pickle
+import gzip
+import zlib
+import math
+import contextlib
+import tracemalloc
+import weakref
+from functools import lru_cache
+try:
+    import resource
+except ImportError:  # Windows (local runs)
+    resource = None
 load_dotenv()  # This loads API_KEY from .env when running locally
 app = FastAPI(title="AR Reconciliation Engine", version="11.0")
+# Responses for large reconciliations are mostly repeated keys and IDs; clients send Accept-Encoding: gzip
+app.add_middleware(GZipMiddleware, minimum_size=1000)
 
 
 # === DEBUG: Check if API_KEY is loaded ===
@@ -20,18 +56,107 @@ print(f"DEBUG: API_KEY value (first 10 chars): {os.getenv('API_KEY', 'NOT_SET')[
 # API Key Security
 API_KEY_NAME = "X-API-Key"
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=True)
+
+# Several callers (n8n workflows) each get their own key and quota, configured as JSON:
+#   API_KEYS='{"workflow-a": {"key": "...", "max_concurrent": 2, "kb_per_second": 1024, "burst_kb": 4096}}'
+# A plain API_KEY still works and becomes a single key named "default".
+DEFAULT_MAX_CONCURRENT = int(os.getenv("DEFAULT_MAX_CONCURRENT", "4"))
+DEFAULT_KB_PER_SECOND = float(os.getenv("DEFAULT_KB_PER_SECOND", "2048"))
+DEFAULT_BURST_KB = float(os.getenv("DEFAULT_BURST_KB", "8192"))
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "16"))  # per worker, across all keys
+
+
+class KeyQuota:
+    """Concurrency limit plus a token bucket refilled in request kilobytes per second"""
+
+    def __init__(self, name: str, max_concurrent: int, kb_per_second: float, burst_kb: float):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.kb_per_second = kb_per_second
+        self.burst_kb = burst_kb
+        self.tokens = burst_kb
+        self.refilled_at = time.monotonic()
+        self.in_flight = 0
+
+    def retry_after_for(self, cost_kb: float) -> Optional[float]:
+        """Seconds to wait before a request of cost_kb fits, or None if it fits now"""
+        now = time.monotonic()
+        self.tokens = min(self.burst_kb, self.tokens + (now - self.refilled_at) * self.kb_per_second)
+        self.refilled_at = now
+        cost_kb = min(cost_kb, self.burst_kb)  # a request larger than the burst must still get through eventually
+        if self.tokens >= cost_kb:
+            return None
+        return (cost_kb - self.tokens) / self.kb_per_second if self.kb_per_second > 0 else 60.0
+
+
+def load_key_quotas() -> Dict[str, KeyQuota]:
+    """Map of API key -> quota"""
+    quotas = {}
+    configured = os.getenv("API_KEYS")
+    if configured:
+        for name, cfg in json.loads(configured).items():
+            quotas[cfg["key"]] = KeyQuota(
+                name,
+                int(cfg.get("max_concurrent", DEFAULT_MAX_CONCURRENT)),
+                float(cfg.get("kb_per_second", DEFAULT_KB_PER_SECOND)),
+                float(cfg.get("burst_kb", DEFAULT_BURST_KB))
+            )
+    if os.getenv("API_KEY") and os.getenv("API_KEY") not in quotas:
+        quotas[os.getenv("API_KEY")] = KeyQuota("default", DEFAULT_MAX_CONCURRENT, DEFAULT_KB_PER_SECOND, DEFAULT_BURST_KB)
+    return quotas
+
+
+key_quotas = load_key_quotas()
+metrics: Dict[str, int] = defaultdict(int)  # counters, exposed on /metrics
+in_flight = 0
+
+
 def get_api_key(api_key: str = Security(api_key_header)):
     """Validate API key from header"""
 
-    correct_api_key = os.getenv("API_KEY")
-    if not correct_api_key:
+    if not key_quotas:
         raise HTTPException(status_code=500, detail="API_KEY not configured on server")
-    if api_key != correct_api_key:
+    if api_key not in key_quotas:
         raise HTTPException(
             status_code=401,
             detail="Invalid or missing API Key"
         )
     return api_key
+
+
+async def admit_request(request: Request, api_key: str = Depends(get_api_key)):
+    """
+    Admission control for the reconcile endpoints. Rejects fast instead of queueing:
+    503 when the worker is saturated, 429 when the key is over its concurrency or rate quota.
+    """
+    global in_flight
+    quota = key_quotas[api_key]
+    cost_kb = max(1.0, int(request.headers.get("content-length") or 0) / 1024.0)
+
+    if in_flight >= MAX_IN_FLIGHT:
+        metrics["rejected_overload"] += 1
+        metrics[f"rejected_overload:{quota.name}"] += 1
+        raise HTTPException(503, "Server busy - retry later", headers={"Retry-After": "1"})
+    if quota.in_flight >= quota.max_concurrent:
+        metrics["rejected_concurrency"] += 1
+        metrics[f"rejected_concurrency:{quota.name}"] += 1
+        raise HTTPException(429, f"Too many concurrent requests for key '{quota.name}'", headers={"Retry-After": "1"})
+    retry_after = quota.retry_after_for(cost_kb)
+    if retry_after is not None:
+        metrics["rejected_rate"] += 1
+        metrics[f"rejected_rate:{quota.name}"] += 1
+        raise HTTPException(429, f"Rate limit exceeded for key '{quota.name}'", headers={"Retry-After": str(math.ceil(retry_after))})
+
+    quota.tokens -= min(cost_kb, quota.burst_kb)
+    quota.in_flight += 1
+    in_flight += 1
+    metrics["admitted"] += 1
+    metrics[f"admitted:{quota.name}"] += 1
+    try:
+        yield quota
+    finally:
+        quota.in_flight -= 1
+        in_flight -= 1
 # === END OF SECURITY SECTION ===
 
 @app.get("/health")
@@ -39,7 +164,31 @@ async def health_check():
     return {
         "status": "healthy",
         "service": "ar-matching-api",
-        "version": "1.0.0"
+        "version": "1.0.0",
+        # Published so clients (ar_client.py) can chunk oversized requests instead of getting a 400
+        "limits": {
+            "max_payments": MAX_PAYMENTS_PER_REQUEST,
+            "max_open_items": MAX_OPEN_ITEMS_PER_REQUEST,
+            "max_batch_entities": BATCH_MAX_ENTITIES,
+        }
+    }
+
+@app.get("/metrics", dependencies=[Depends(get_api_key)])
+async def get_metrics():
+    """Admission and cache counters for this worker"""
+    profiles = payment_profiles.snapshot() if payment_profiles is not None else None
+    return {
+        "in_flight": in_flight,
+        "max_in_flight": MAX_IN_FLIGHT,
+        "keys": {
+            q.name: {"in_flight": q.in_flight, "max_concurrent": q.max_concurrent, "tokens_kb": round(q.tokens, 1)}
+            for q in key_quotas.values()
+        },
+        "memory": memory_report(),
+        "payment_profiles": {
+            "customers": profiles.customers, "profiled": len(profiles.windows), "version": profiles.version
+        } if profiles is not None else None,
+        "counters": dict(metrics)
     }
 
 # === 1. INPUT MODELS (NO FEES) ===
@@ -69,6 +218,19 @@ class ReconciliationRequest(BaseModel):
     open_items: List[OpenItem]
 
 # === 2. OUTPUT MODEL ===
+class CandidateScore(BaseModel):
+    payment_id: str
+    invoice_id: str
+    customer_name: str
+    total_open_amount: float
+    due_in_date: str
+    score: float
+    amount_score: float
+    name_score: float
+    date_score: float
+    memo_score: float
+    terms_score: float
+
 class MatchGroup(BaseModel):
     payment_ids: List[str]
     invoice_ids: List[str]
@@ -84,11 +246,14 @@ class MatchGroup(BaseModel):
     terms_scores: List[float]
     confidence: str
     reason: str = ""
+    stage: str = ""  # Engine stage: 1:1, N:1, 1:N, N:M, fuzzy, memo, duplicate, deadline or unmatched
     is_negative_payment: bool = False
     payment_memo_text: str = ""
     invoice_payment_terms: List[str] = []
     invoice_memo_lines: List[str] = []
     invoice_credit_flags: List[bool] = []
+    discount_applied: float = 0.0  # Early-payment discount deducted from the open amount ("2/10 NET 30")
+    candidates: List[CandidateScore] = []  # Only filled when /reconcile?top_k=N is requested
 
 class ReconciliationSummary(BaseModel):
     high_confidence_payments: int
@@ -97,12 +262,44 @@ class ReconciliationSummary(BaseModel):
     no_match_invoices: int
     total_payments_processed: int
     total_invoices_processed: int
+    unprocessed_payments: int = 0
+    duplicate_payments: int = 0
 
 class ReconciliationResponse(BaseModel):
     high_confidence: List[MatchGroup]
     hitl_review: List[MatchGroup]
     no_match: List[MatchGroup]
     summary: ReconciliationSummary
+    duplicates: List[MatchGroup] = []  # Likely double-delivered bank lines, kept out of matching
+    partial: bool = False  # True when X-Deadline-Ms ran out before all stages finished
+    skipped_stages: List[str] = []
+    unprocessed_payment_ids: List[str] = []
+    config_version: str = ""  # version of the scoring plan the scores were computed with
+    _json: Optional[bytes] = PrivateAttr(default=None)
+
+    def json_bytes(self) -> bytes:
+        """Serialized once, then shared by the HTTP response, cache hits and the decision log"""
+        if self._json is None:
+            self._json = self.model_dump_json().encode("utf-8")
+        return self._json
+
+# === BATCH MODELS (one entry per company code) ===
+class EntityReconciliationRequest(ReconciliationRequest):
+    entity_key: str
+
+class BatchReconciliationRequest(BaseModel):
+    entities: List[EntityReconciliationRequest]
+
+class EntityReconciliationResult(BaseModel):
+    entity_key: str
+    status: str  # "ok" or "error"
+    elapsed_ms: float
+    result: Optional[ReconciliationResponse] = None
+    error: Optional[str] = None
+
+class BatchReconciliationResponse(BaseModel):
+    results: List[EntityReconciliationResult]
+    elapsed_ms: float
 
 class ValidationError(BaseModel):
     location: str
@@ -118,9 +315,16 @@ class ValidationResponse(BaseModel):
     suggestions: Optional[List[str]] = None
 
 # === 3. SCORING FUNCTIONS ===
+NAME_SIMILARITY_CACHE_SIZE = int(os.getenv("NAME_SIMILARITY_CACHE_SIZE", "65536"))
+
+@lru_cache(maxsize=NAME_SIMILARITY_CACHE_SIZE)
+def _name_similarity(p1_upper: str, p2_upper: str) -> float:
+    # Customer names repeat heavily within a batch (grouping compares every payer to every group)
+    return fuzz.token_set_ratio(p1_upper, p2_upper)
+
 def name_score(p1: str, p2: str) -> float:
     if not p1 or not p2: return 0.0
-    s = fuzz.token_set_ratio(p1.upper(), p2.upper())
+    s = _name_similarity(p1.upper(), p2.upper())
     if s == 100: return 100.0
     if s >= 95: return 95.0
     if s >= 90: return 90.0
@@ -128,10 +332,15 @@ def name_score(p1: str, p2: str) -> float:
     if s >= 70: return 70.0
     return 0.0
 
+@lru_cache(maxsize=65536)
+def _parse_date(value: str) -> datetime:
+    # The same few hundred dates are parsed for every pair the fuzzy stage scores
+    return datetime.strptime(value, "%Y%m%d")
+
 def date_score(pay_date: str, due_date: str, value_date: Optional[str] = None) -> float:
     try:
-        pay = datetime.strptime(value_date or pay_date, "%Y%m%d")
-        due = datetime.strptime(due_date, "%Y%m%d")
+        pay = _parse_date(value_date or pay_date)
+        due = _parse_date(due_date)
         days = abs((pay - due).days)
         if days == 0: return 100.0
         if days <= 1: return 95.0
@@ -149,6 +358,7 @@ def memo_line_score(pay_memo: str, inv_memo: str) -> float:
     if score >= 70: return 70.0
     return 0.0
 
+@lru_cache(maxsize=4096)
 def payment_terms_score(pay_hint: str, inv_terms: str) -> float:
     if not inv_terms: return 0.0
     pay_norm = pay_hint.upper() if pay_hint else ""
@@ -158,6 +368,1101 @@ def payment_terms_score(pay_hint: str, inv_terms: str) -> float:
     if inv_norm in {"NET 30", "NET 15", "DUE ON RECEIPT", "2/10 NET 30"}: return 50.0
     return 0.0
 
+# Early-payment discounts: a customer paying "2/10 NET 30" within 10 days of the invoice date deducts
+# 2%, so the short payment is checked against the discounted open amount in Steps 1-3. The invoice
+# date is due_in_date minus the net days; DISCOUNT_GRACE_DAYS allows for clearing delays.
+TERMS_DISCOUNT_MATCHING = os.getenv("TERMS_DISCOUNT_MATCHING", "1") == "1"
+DISCOUNT_GRACE_DAYS = int(os.getenv("DISCOUNT_GRACE_DAYS", "2"))
+_DISCOUNT_TERMS = re.compile(r"(\d+(?:\.\d+)?)\s*%?\s*(?:/|\s)\s*(\d+)\s*,?\s*(?:NET|N)\s*(\d+)")
+_NET_TERMS = re.compile(r"(?:NET|N)\s*(\d+)")
+
+
+class PaymentTerms(NamedTuple):
+    discount_pct: float
+    discount_days: int
+    net_days: int
+
+
+@lru_cache(maxsize=4096)
+def parse_payment_terms(terms: str) -> Optional[PaymentTerms]:
+    """'2/10 NET 30', '1.5% 15 N45', 'NET 30', 'DUE ON RECEIPT' -> PaymentTerms; None if unrecognized"""
+    norm = " ".join(terms.upper().split())
+    if norm == "DUE ON RECEIPT":
+        return PaymentTerms(0.0, 0, 0)
+    match = _DISCOUNT_TERMS.fullmatch(norm)
+    if match:
+        pct, discount_days, net_days = float(match[1]), int(match[2]), int(match[3])
+        if 0 < pct < 100 and discount_days <= net_days:
+            return PaymentTerms(pct, discount_days, net_days)
+        return None
+    match = _NET_TERMS.fullmatch(norm)
+    return PaymentTerms(0.0, 0, int(match[1])) if match else None
+
+
+def early_payment_discount(pay: Payment, inv: OpenItem, inv_c: int) -> int:
+    """Cents the payer may deduct from inv under its terms; 0 outside the discount window"""
+    terms = parse_payment_terms(inv.payment_terms) if inv.payment_terms and not inv.is_credit else None
+    if terms is None or not terms.discount_pct:
+        return 0
+    try:
+        paid = _parse_date(pay.value_date or pay.payment_date)
+        due = _parse_date(inv.due_in_date)
+    except (TypeError, ValueError):
+        return 0
+    if (due - paid).days >= terms.net_days - terms.discount_days - DISCOUNT_GRACE_DAYS:
+        return int(round(inv_c * terms.discount_pct / 100.0))
+    return 0
+
+# === 3a. SCORING PLAN (stage weights and cut-offs) ===
+# The defaults are the engine's original values. SCORING_CONFIG_PATH may point to a JSON file that
+# overrides any of them, e.g. {"version": "2", "fuzzy": {"amount": 0.5, ...}, "thresholds": {"review": 78}};
+# it is re-read whenever it changes, and the version is reported in every response.
+SCORING_CONFIG_PATH = os.getenv("SCORING_CONFIG_PATH")
+SIGNALS = ("id", "amount", "name", "date", "memo", "terms")  # Order in which weighted terms are summed
+
+
+class StageWeights(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    id: NonNegativeFloat = 0.0
+    amount: NonNegativeFloat = 0.0
+    name: NonNegativeFloat = 0.0
+    date: NonNegativeFloat = 0.0
+    memo: NonNegativeFloat = 0.0
+    terms: NonNegativeFloat = 0.0
+
+
+class ScoringThresholds(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    high: float = 90.0            # Explicit-ID matches: high confidence (amount must also be exact)
+    review: float = 80.0          # N:1 / 1:N: HITL at or above, no_match below
+    name_review: float = 85.0     # Explicit-ID matches with a weaker customer name go to HITL
+    name_mismatch: float = 40.0   # ... and below this the reason calls it a name mismatch
+    fuzzy_high: float = 85.0      # Step 4.5: high confidence (amount must also be exact)
+    fuzzy_review: float = 75.0    # Step 4.5: lowest score that is proposed at all
+    customer_group: float = 90.0  # Step 4.5: name similarity to join a customer group
+
+
+class ScoringConfig(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    version: str = "1"
+    explicit: StageWeights = StageWeights(id=0.50, amount=0.40, name=0.05, date=0.025, memo=0.015, terms=0.01)
+    fuzzy: StageWeights = StageWeights(amount=0.40, name=0.25, date=0.20, memo=0.10, terms=0.05)
+    thresholds: ScoringThresholds = ScoringThresholds()
+
+
+class ScoringPlan:
+    """A ScoringConfig compiled once: per-stage (signal, weight) tuples in summation order plus the cut-offs"""
+
+    def __init__(self, config: ScoringConfig):
+        self.config = config
+        self.version = config.version
+        digest = hashlib.sha256(config.model_dump_json().encode("utf-8")).hexdigest()
+        self.fingerprint = f"{config.version}:{digest[:12]}"
+        self.thresholds = config.thresholds
+        self.weights = {}
+        for stage in ("explicit", "fuzzy"):
+            stage_weights = getattr(config, stage)
+            self.weights[stage] = tuple((signal, getattr(stage_weights, signal)) for signal in SIGNALS
+                                        if getattr(stage_weights, signal))
+        # Outside a due-date window of 10+ days date_score is at most 50. If a candidate more than 5.00
+        # off in amount (amount score 60) can't reach fuzzy_review even then, Step 4.5 skips those.
+        fuzzy = dict(self.weights["fuzzy"])
+        best_far = sum(w * (60.0 if s == "amount" else 50.0 if s == "date" else 100.0) for s, w in fuzzy.items())
+        self.prune_far_amounts = min(100.0, best_far) < self.thresholds.fuzzy_review
+
+    def combine(self, stage: str, **signals):
+        """
+        Weighted score capped at 100. Signals are scalars or equally shaped numpy arrays, so one call
+        scores a whole candidate array. Terms are added in SIGNALS order, so the default plan reproduces
+        the original scores bit for bit.
+        """
+        total = 0.0
+        for signal, weight in self.weights[stage]:
+            total = total + weight * signals[signal]
+        if isinstance(total, np.ndarray):
+            return np.minimum(100.0, total)
+        return min(100.0, total)
+
+
+def load_scoring_config(path: str) -> ScoringConfig:
+    with open(path, "r", encoding="utf-8") as f:
+        return ScoringConfig(**json.load(f))
+
+
+_scoring_plan = ScoringPlan(ScoringConfig())
+_scoring_config_mtime = None
+
+
+def scoring_plan() -> ScoringPlan:
+    """The current plan; SCORING_CONFIG_PATH is re-read when its mtime changes, a bad file keeps the old plan"""
+    global _scoring_plan, _scoring_config_mtime
+    if not SCORING_CONFIG_PATH:
+        return _scoring_plan
+    try:
+        mtime = os.stat(SCORING_CONFIG_PATH).st_mtime_ns
+    except OSError:
+        return _scoring_plan
+    if mtime != _scoring_config_mtime:
+        _scoring_config_mtime = mtime
+        try:
+            _scoring_plan = ScoringPlan(load_scoring_config(SCORING_CONFIG_PATH))
+            print(f"Scoring config {_scoring_plan.fingerprint} loaded from {SCORING_CONFIG_PATH}")
+        except Exception as e:
+            metrics["scoring_config_errors"] += 1
+            print(f"Scoring config {SCORING_CONFIG_PATH} rejected, keeping {_scoring_plan.fingerprint}: {e}")
+    return _scoring_plan
+
+
+# === 3b. N:M COMPONENTS (payments referencing overlapping invoice sets) ===
+NM_EXACT_MAX_ITEMS = int(os.getenv("NM_EXACT_MAX_ITEMS", "14"))
+NM_HEURISTIC_MAX_STEPS = int(os.getenv("NM_HEURISTIC_MAX_STEPS", "5000"))
+
+
+def connected_components(edges: List[tuple]) -> List[tuple]:
+    """
+    Split a bipartite graph given as (left, right) edges into connected components.
+    Returns [(lefts, rights), ...] with nodes in first-seen order.
+    """
+    parent: Dict[tuple, tuple] = {}
+
+    def find(node):
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    for left, right in edges:
+        a, b = ("L", left), ("R", right)
+        parent.setdefault(a, a)
+        parent.setdefault(b, b)
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[rb] = ra
+
+    components: Dict[tuple, tuple] = {}
+    for node in parent:  # dicts keep insertion order, so output follows the input order
+        lefts, rights = components.setdefault(find(node), ([], []))
+        (lefts if node[0] == "L" else rights).append(node[1])
+    return list(components.values())
+
+
+# Amounts are converted once to integer cents; sums and tolerance checks are exact and hashable.
+AMOUNT_EXACT_CENTS = 100   # |diff| <= 1.00 counts as an exact amount match
+AMOUNT_CLOSE_CENTS = 500   # |diff| <= 5.00 counts as close
+
+
+def to_cents(amount: float) -> int:
+    return int(round(amount * 100))
+
+
+def from_cents(cents: int) -> float:
+    return cents / 100.0
+
+
+def amount_score_cents(diff_cents: int) -> float:
+    return 100.0 if diff_cents <= AMOUNT_EXACT_CENTS else 95.0 if diff_cents <= AMOUNT_CLOSE_CENTS else 60.0
+
+
+def discounted_net_diff(net_pay: int, net_open: int, discount: int) -> tuple:
+    """(net_diff, discount taken): an early-payment discount only counts when it makes the match exact"""
+    net_diff = abs(net_pay - net_open)
+    if discount and net_diff > AMOUNT_EXACT_CENTS and abs(net_pay - (net_open - discount)) <= AMOUNT_EXACT_CENTS:
+        return abs(net_pay - (net_open - discount)), discount
+    return net_diff, 0
+
+
+def _subset_sums(values: List[int]) -> List[tuple]:
+    """All non-empty subset sums as (sum, mask), sorted by sum"""
+    sums = [(0, 0)]
+    for i, v in enumerate(values):
+        bit = 1 << i
+        sums += [(total + v, mask | bit) for total, mask in sums]
+    return sorted(sums[1:])
+
+
+def solve_nm_component(pay_cents: List[int], inv_cents: List[int], refs: List[set],
+                       tolerance_cents: int = AMOUNT_EXACT_CENTS) -> Optional[tuple]:
+    """
+    Find the largest payment subset and invoice subset of one component whose signed nets agree
+    within tolerance. pay_cents/inv_cents are signed amounts; refs[i] holds the invoice indexes
+    payment i references. Returns (payment_indexes, invoice_indexes) or None.
+    Small components are solved exactly, large ones with a bounded greedy heuristic.
+    """
+    n_pay, n_inv = len(pay_cents), len(inv_cents)
+    if abs(sum(pay_cents) - sum(inv_cents)) <= tolerance_cents:
+        return list(range(n_pay)), list(range(n_inv))
+
+    if n_pay + n_inv <= NM_EXACT_MAX_ITEMS:
+        inv_sums = _subset_sums(inv_cents)
+        inv_keys = [total for total, _ in inv_sums]
+        best = None
+        for pay_total, pay_mask in _subset_sums(pay_cents):
+            lo = bisect.bisect_left(inv_keys, pay_total - tolerance_cents)
+            hi = bisect.bisect_right(inv_keys, pay_total + tolerance_cents)
+            pay_idx = [i for i in range(n_pay) if pay_mask >> i & 1]
+            for inv_total, inv_mask in inv_sums[lo:hi]:
+                inv_idx = [j for j in range(n_inv) if inv_mask >> j & 1]
+                # Every selected payment must reference a selected invoice and vice versa
+                if not all(any(inv_mask >> j & 1 for j in refs[i]) for i in pay_idx):
+                    continue
+                if not all(any(j in refs[i] for i in pay_idx) for j in inv_idx):
+                    continue
+                rank = (len(pay_idx) + len(inv_idx), -abs(pay_total - inv_total))
+                if best is None or rank > best[0]:
+                    best = (rank, pay_idx, inv_idx)
+        return (best[1], best[2]) if best else None
+
+    # Large component: drop the single item that balances the nets, else fill invoices greedily
+    pay_total, inv_total = sum(pay_cents), sum(inv_cents)
+    for j in range(n_inv):
+        if abs(pay_total - (inv_total - inv_cents[j])) <= tolerance_cents:
+            return list(range(n_pay)), [k for k in range(n_inv) if k != j]
+    for i in range(n_pay):
+        if abs((pay_total - pay_cents[i]) - inv_total) <= tolerance_cents:
+            return [k for k in range(n_pay) if k != i], list(range(n_inv))
+
+    order = sorted(range(n_inv), key=lambda j: -abs(inv_cents[j]))
+    chosen, running, steps = [], 0, 0
+    for j in order:
+        steps += 1
+        if steps > NM_HEURISTIC_MAX_STEPS:
+            break
+        if abs(pay_total - (running + inv_cents[j])) < abs(pay_total - running):
+            chosen.append(j)
+            running += inv_cents[j]
+            if abs(pay_total - running) <= tolerance_cents:
+                return list(range(n_pay)), sorted(chosen)
+    return None
+
+
+# === 3c. INVOICE REFERENCES FROM MEMO TEXT ===
+class AhoCorasick:
+    """Multi-pattern matcher: one pass over a text finds every occurrence of every pattern"""
+
+    def __init__(self, patterns: Dict[str, Any]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[tuple]] = [[]]
+        for pattern, payload in patterns.items():
+            state = 0
+            for ch in pattern:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = nxt
+            self._out[state].append((pattern, payload))
+
+        # Breadth-first failure links; each state inherits the outputs of its failure state
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def iter_matches(self, text: str):
+        """Yield (start, end, pattern, payload) for every match, end exclusive"""
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(ch, 0)
+            for pattern, payload in self._out[state]:
+                yield i + 1 - len(pattern), i + 1, pattern, payload
+
+
+MEMO_REF_MIN_LENGTH = 4
+_ID_PREFIX = re.compile(r"^[A-Z]+[-_ /#.:]*")
+
+
+def invoice_id_variants(invoice_id: str) -> set:
+    """Spellings of an invoice ID that show up in remittance memos: INV-1001, INV1001, 1001"""
+    upper = invoice_id.strip().upper()
+    variants = {upper, re.sub(r"[^A-Z0-9]", "", upper)}
+    core = _ID_PREFIX.sub("", upper)
+    if core != upper and any(c.isdigit() for c in core):
+        variants.add(core)
+    return {v for v in variants if len(v) >= MEMO_REF_MIN_LENGTH}
+
+
+def build_memo_reference_matcher(invoice_ids: List[str]) -> Optional[AhoCorasick]:
+    patterns: Dict[str, str] = {}
+    ambiguous = set()
+    for iid in invoice_ids:
+        for variant in invoice_id_variants(iid):
+            if variant in patterns and patterns[variant] != iid:
+                ambiguous.add(variant)  # e.g. the same number under two prefixes
+            patterns.setdefault(variant, iid)
+    for variant in ambiguous:
+        del patterns[variant]
+    return AhoCorasick(patterns) if patterns else None
+
+
+def extract_memo_references(matcher: AhoCorasick, memo_text: str) -> List[str]:
+    """Invoice IDs named in a memo, in order of appearance; matches must sit on token boundaries"""
+    text = memo_text.upper()
+    found: Dict[str, None] = {}
+    for start, end, pattern, iid in matcher.iter_matches(text):
+        if start > 0 and text[start - 1].isalnum():
+            continue
+        if end < len(text) and text[end].isalnum():
+            continue
+        if pattern.isdigit():
+            # Skip numbers that are part of an amount such as 1001.50 or 2,1001
+            if end + 1 < len(text) and text[end] in ".," and text[end + 1].isdigit():
+                continue
+            if start >= 2 and text[start - 1] in ".," and text[start - 2].isdigit():
+                continue
+        found.setdefault(iid, None)
+    return list(found)
+
+
+# === 3d. NEAR-MISS INVOICE REFERENCES (typos, prefix variants) ===
+FUZZY_ID_MAX_DISTANCE = int(os.getenv("FUZZY_ID_MAX_DISTANCE", "1"))
+
+
+class BKTree:
+    """Burkhard-Keller tree: finds all strings within an edit distance without a full scan"""
+
+    def __init__(self, distance=OSA.distance):
+        self._distance = distance
+        self._root = None  # [item, {distance: child}]
+
+    def add(self, item: str) -> None:
+        if self._root is None:
+            self._root = [item, {}]
+            return
+        node = self._root
+        while True:
+            d = self._distance(item, node[0])
+            if d == 0:
+                return
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = [item, {}]
+                return
+            node = child
+
+    def search(self, query: str, max_distance: int) -> List[tuple]:
+        """All (distance, item) with distance <= max_distance"""
+        found = []
+        stack = [self._root] if self._root else []
+        while stack:
+            item, children = stack.pop()
+            d = self._distance(query, item)
+            if d <= max_distance:
+                found.append((d, item))
+            # Triangle inequality: only subtrees at distance d +/- max_distance can hold matches
+            for child_d, child in children.items():
+                if d - max_distance <= child_d <= d + max_distance:
+                    stack.append(child)
+        return found
+
+
+def _compact_id(invoice_id: str) -> str:
+    return re.sub(r"[^A-Z0-9]", "", invoice_id.upper())
+
+
+class InvoiceIdIndex:
+    """Resolves invoice references that are not exact keys: prefix/separator variants, then typos"""
+
+    def __init__(self, invoice_ids: List[str]):
+        self._variants: Dict[str, Optional[str]] = {}
+        self._compact: Dict[str, Optional[str]] = {}
+        for iid in invoice_ids:
+            for variant in invoice_id_variants(iid):
+                self._variants[variant] = iid if self._variants.get(variant, iid) == iid else None
+            compact = _compact_id(iid)
+            self._compact[compact] = iid if self._compact.get(compact, iid) == iid else None
+        self._tree = BKTree()
+        for compact, iid in self._compact.items():
+            if iid is not None:
+                self._tree.add(compact)
+
+    def resolve(self, reference: str) -> Optional[tuple]:
+        """(invoice_id, "normalized" | "fuzzy") for an unambiguous near-miss, else None"""
+        upper = reference.strip().upper()
+        for key in (upper, _compact_id(upper), _ID_PREFIX.sub("", upper)):
+            iid = self._variants.get(key)
+            if iid is not None:
+                return iid, "normalized"
+
+        compact = _compact_id(upper)
+        if len(compact) < MEMO_REF_MIN_LENGTH or FUZZY_ID_MAX_DISTANCE <= 0:
+            return None
+        hits = self._tree.search(compact, FUZZY_ID_MAX_DISTANCE)
+        if not hits:
+            return None
+        best = min(d for d, _ in hits)
+        nearest = [item for d, item in hits if d == best]
+        if len(nearest) != 1:
+            return None  # Equally close to two invoices - don't guess
+        return self._compact[nearest[0]], "fuzzy"
+
+
+def plausible_resolution(pay_c: int, inv_c: int, only_reference: bool, discount: int = 0) -> bool:
+    """A typo-resolved invoice must fit the payment: all of it when it is the only reference, else a part"""
+    if only_reference:
+        return discounted_net_diff(pay_c, inv_c, discount)[0] <= AMOUNT_CLOSE_CENTS
+    return inv_c <= pay_c + AMOUNT_CLOSE_CENTS
+
+
+# === 3e. CANDIDATE SUGGESTIONS (top-k invoices for HITL / no-match payments) ===
+MAX_TOP_K = 20
+SUGGESTION_CHUNK_CELLS = 4_000_000  # payment x invoice cells scored per batch
+NAME_TIERS = [(100, 100.0), (95, 95.0), (90, 90.0), (80, 80.0), (70, 70.0)]
+MEMO_TIERS = [(90, 100.0), (70, 70.0)]
+DATE_TIERS = [(0, 100.0), (1, 95.0), (3, 90.0), (7, 80.0), (10, 70.0), (30, 50.0)]
+
+
+@lru_cache(maxsize=65536)
+def _date_ordinal(value: Optional[str]) -> float:
+    try:
+        return float(datetime.strptime(value, "%Y%m%d").toordinal())
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _similarity_tiers(left: List[str], right: List[str], tiers: List[tuple]) -> tuple:
+    """
+    Tiered token_set_ratio between every unique left and right string (vectorized with cdist).
+    Returns (matrix, left_index, right_index) so the score of pair (i, j) is
+    matrix[left_index[i], right_index[j]]. Empty strings score 0, as in name_score/memo_line_score.
+    """
+    left_unique = list(dict.fromkeys(s.upper() for s in left))
+    right_unique = list(dict.fromkeys(s.upper() for s in right))
+    left_pos = {s: i for i, s in enumerate(left_unique)}
+    right_pos = {s: i for i, s in enumerate(right_unique)}
+    # float64: float32 ratios can round across a tier boundary and disagree with name_score
+    raw = process.cdist(left_unique, right_unique, scorer=fuzz.token_set_ratio, workers=-1, dtype=np.float64)
+    matrix = np.select([raw >= cutoff for cutoff, _ in tiers], [score for _, score in tiers], default=0.0)
+    matrix[[i for i, s in enumerate(left_unique) if not s.strip()], :] = 0.0
+    matrix[:, [j for j, s in enumerate(right_unique) if not s.strip()]] = 0.0
+    return (
+        matrix,
+        np.array([left_pos[s.upper()] for s in left], dtype=np.intp),
+        np.array([right_pos[s.upper()] for s in right], dtype=np.intp)
+    )
+
+
+SCORE_VECTOR_MIN_CANDIDATES = 12
+SCORED_FIELDS = ("amount_diff", "amount", "name", "date", "memo", "terms", "total")
+
+
+def _tier_lookup(tiers: List[tuple], default: float, at_least: bool) -> tuple:
+    """(ascending cut-offs, score table) so one np.searchsorted applies a descending tier list"""
+    cutoffs = np.array(sorted(cutoff for cutoff, _ in tiers), dtype=np.float64)
+    scores = [score for _, score in sorted(tiers)]
+    return cutoffs, np.array([default] + scores if at_least else scores + [default], dtype=np.float64)
+
+
+_NAME_LOOKUP = _tier_lookup(NAME_TIERS, 0.0, at_least=True)     # ratio >= cut-off
+_MEMO_LOOKUP = _tier_lookup(MEMO_TIERS, 0.0, at_least=True)
+_DATE_LOOKUP = _tier_lookup(DATE_TIERS, 20.0, at_least=False)   # days <= cut-off
+
+
+def _date_tiers(days: np.ndarray) -> np.ndarray:
+    """date_score over an array of day differences; NaN (unparseable date) scores 50"""
+    cutoffs, table = _DATE_LOOKUP
+    scores = table[np.searchsorted(cutoffs, days, side="left")]
+    scores[np.isnan(days)] = 50.0
+    return scores
+
+
+def _amount_tiers(amount_diff: np.ndarray) -> np.ndarray:
+    """amount_score_cents over an array of cent differences"""
+    return np.where(amount_diff <= AMOUNT_EXACT_CENTS, 100.0, np.where(amount_diff <= AMOUNT_CLOSE_CENTS, 95.0, 60.0))
+
+
+def _name_tiers(query: str, choices: List[str]) -> np.ndarray:
+    """name_score of one name against many; ratios come from the same cache name_score uses"""
+    if not query:
+        return np.zeros(len(choices))
+    q = query.upper()
+    raw = np.array([_name_similarity(q, c.upper()) if c else -1.0 for c in choices], dtype=np.float64)
+    cutoffs, table = _NAME_LOOKUP
+    return table[np.searchsorted(cutoffs, raw, side="right")]
+
+
+def _memo_tiers(query: str, choices: List[str]) -> np.ndarray:
+    """memo_line_score of one memo against many (one cdist call)"""
+    if not query or not choices:
+        return np.zeros(len(choices))
+    raw = process.cdist([query.upper()], [c.upper() for c in choices], scorer=fuzz.token_set_ratio, dtype=np.float64)[0]
+    raw[[j for j, c in enumerate(choices) if not c]] = -1.0
+    cutoffs, table = _MEMO_LOOKUP
+    return table[np.searchsorted(cutoffs, raw, side="right")]
+
+
+def score_candidates(plan: "ScoringPlan", pay: Payment, pay_c: int, invoices: List[OpenItem],
+                     inv_cents: Dict[str, int]) -> Dict[str, np.ndarray]:
+    """
+    Step 4.5 signals of one payment against a whole candidate array, plus the weighted "total".
+    Same tiers as the scalar scoring functions, so the scores are identical - just computed in bulk.
+    Below SCORE_VECTOR_MIN_CANDIDATES numpy's per-call overhead outweighs the work, so small
+    candidate sets go through the scalar functions and only the results become arrays.
+    """
+    if len(invoices) < SCORE_VECTOR_MIN_CANDIDATES:
+        rows = []
+        for inv in invoices:
+            amount_diff = abs(pay_c - inv_cents[inv.invoice_id])
+            row = {
+                "amount_diff": amount_diff,
+                "amount": amount_score_cents(amount_diff),
+                "name": name_score(pay.customer_name, inv.customer_name),
+                "date": date_score(pay.payment_date, inv.due_in_date, pay.value_date),
+                "memo": memo_line_score(pay.memo_text, inv.memo_line),
+                "terms": payment_terms_score(pay.payment_terms_hint, inv.payment_terms),
+            }
+            row["total"] = plan.combine("fuzzy", **row)
+            rows.append(row)
+        return {key: np.array([row[key] for row in rows]) for key in SCORED_FIELDS}
+
+    amount_diff = np.abs(pay_c - np.array([inv_cents[inv.invoice_id] for inv in invoices], dtype=np.int64))
+    days = np.abs(_date_ordinal(pay.value_date or pay.payment_date) - np.array([_date_ordinal(inv.due_in_date) for inv in invoices]))
+    signals = {
+        "amount_diff": amount_diff,
+        "amount": _amount_tiers(amount_diff),
+        "name": _name_tiers(pay.customer_name, [inv.customer_name for inv in invoices]),
+        "date": _date_tiers(days),
+        "memo": _memo_tiers(pay.memo_text, [inv.memo_line for inv in invoices]),
+        "terms": np.array([payment_terms_score(pay.payment_terms_hint, inv.payment_terms) for inv in invoices]),
+    }
+    signals["total"] = plan.combine("fuzzy", **signals)
+    return signals
+
+
+class CandidatePool(NamedTuple):
+    """
+    The open items Step 5 ranks, as columns. describe(j) gives (invoice_id, customer_name, due_in_date)
+    of candidate j, needed only for the k picked per payment.
+    """
+    names: List[str]
+    memos: List[str]
+    terms: List[str]
+    cents: np.ndarray
+    due_days: np.ndarray
+    describe: Callable[[int], tuple]
+
+
+def candidate_pool(invoices: List[OpenItem], inv_cents: Dict[str, int]) -> CandidatePool:
+    return CandidatePool(
+        names=[i.customer_name for i in invoices],
+        memos=[i.memo_line for i in invoices],
+        terms=[i.payment_terms for i in invoices],
+        cents=np.array([inv_cents[i.invoice_id] for i in invoices], dtype=np.int64),
+        due_days=np.array([_date_ordinal(i.due_in_date) for i in invoices]),
+        describe=lambda j: (invoices[j].invoice_id, invoices[j].customer_name, invoices[j].due_in_date)
+    )
+
+
+def suggest_candidates(payments: List[Payment], pool: CandidatePool, top_k: int, pay_cents: Dict[str, int],
+                       plan: Optional["ScoringPlan"] = None) -> Dict[str, List[CandidateScore]]:
+    """
+    Top-k invoices per payment under the Step 4.5 weights. Scores are computed in batches of
+    payment rows as whole arrays; each row keeps only its k best via a partial sort.
+    """
+    n_inv = len(pool.cents)
+    if not payments or not n_inv or top_k <= 0:
+        return {}
+    plan = plan or scoring_plan()
+    k = min(top_k, n_inv)
+
+    name_mat, pay_name_idx, inv_name_idx = _similarity_tiers([p.customer_name for p in payments], pool.names, NAME_TIERS)
+    memo_mat, pay_memo_idx, inv_memo_idx = _similarity_tiers([p.memo_text for p in payments], pool.memos, MEMO_TIERS)
+
+    hints = list(dict.fromkeys(p.payment_terms_hint for p in payments))
+    terms = list(dict.fromkeys(pool.terms))
+    terms_mat = np.array([[payment_terms_score(h, t) for t in terms] for h in hints])
+    hint_pos = {h: n for n, h in enumerate(hints)}
+    terms_pos = {t: n for n, t in enumerate(terms)}
+    pay_hint_idx = np.array([hint_pos[p.payment_terms_hint] for p in payments], dtype=np.intp)
+    inv_terms_idx = np.array([terms_pos[t] for t in pool.terms], dtype=np.intp)
+
+    pay_amount = np.array([pay_cents[p.payment_id] for p in payments], dtype=np.int64)
+    inv_amount = pool.cents
+    pay_day = np.array([_date_ordinal(p.value_date or p.payment_date) for p in payments])
+    inv_day = pool.due_days
+
+    suggestions: Dict[str, List[CandidateScore]] = {}
+    chunk = max(1, SUGGESTION_CHUNK_CELLS // n_inv)
+    for start in range(0, len(payments), chunk):
+        rows = slice(start, start + chunk)
+        amount_diff = np.abs(pay_amount[rows, None] - inv_amount[None, :])
+        amount_s = _amount_tiers(amount_diff)
+        name_s = name_mat[pay_name_idx[rows]][:, inv_name_idx]
+        memo_s = memo_mat[pay_memo_idx[rows]][:, inv_memo_idx]
+        terms_s = terms_mat[pay_hint_idx[rows]][:, inv_terms_idx]
+        date_s = _date_tiers(np.abs(pay_day[rows, None] - inv_day[None, :]))
+
+        total = plan.combine("fuzzy", amount=amount_s, name=name_s, date=date_s, memo=memo_s, terms=terms_s)
+
+        # Bounded selection: O(n) partition to the k best, then order just those k
+        if k < total.shape[1]:
+            best = np.argpartition(-total, k - 1, axis=1)[:, :k]
+        else:
+            best = np.tile(np.arange(total.shape[1]), (total.shape[0], 1))
+        order = np.argsort(-np.take_along_axis(total, best, axis=1), axis=1, kind="stable")
+        best = np.take_along_axis(best, order, axis=1)
+
+        for r, pay in enumerate(payments[rows]):
+            suggestions[pay.payment_id] = [
+                CandidateScore(
+                    payment_id=pay.payment_id,
+                    invoice_id=invoice_id,
+                    customer_name=customer_name,
+                    total_open_amount=from_cents(int(inv_amount[j])),
+                    due_in_date=due_in_date,
+                    score=round(float(total[r, j]), 2),
+                    amount_score=float(amount_s[r, j]),
+                    name_score=float(name_s[r, j]),
+                    date_score=float(date_s[r, j]),
+                    memo_score=float(memo_s[r, j]),
+                    terms_score=float(terms_s[r, j])
+                )
+                for j in best[r].tolist()
+                for invoice_id, customer_name, due_in_date in [pool.describe(j)]
+            ]
+    return suggestions
+
+
+# === 3f. DUPLICATE PAYMENTS ===
+DUPLICATE_DETECTION = os.getenv("DUPLICATE_DETECTION", "1") == "1"
+
+
+def _normalize_text(value: str) -> str:
+    return " ".join(re.sub(r"[^A-Z0-9]+", " ", value.upper()).split())
+
+
+def payment_fingerprint(pay: Payment) -> tuple:
+    """
+    Composite key a bank feed repeats verbatim when it delivers the same payment twice.
+    Invoice references are part of it: two equal payments against different invoices are legitimate.
+    """
+    cents = to_cents(pay.amount)
+    return (
+        _normalize_text(pay.customer_name),
+        -cents if pay.is_negative_payment else cents,
+        pay.payment_date,
+        _normalize_text(pay.memo_text),
+        tuple(sorted(_compact_id(iid) for iid in pay.invoice_ids))
+    )
+
+
+def find_duplicate_payments(payments: List[Payment]) -> Dict[str, str]:
+    """payment_id of each repeat -> payment_id of the first occurrence, in one hashing pass"""
+    first_seen: Dict[tuple, str] = {}
+    duplicates: Dict[str, str] = {}
+    for pay in payments:
+        original = first_seen.setdefault(payment_fingerprint(pay), pay.payment_id)
+        if original != pay.payment_id:
+            duplicates[pay.payment_id] = original
+    return duplicates
+
+
+# === 3g. DUE-DATE WINDOW FOR FUZZY CANDIDATES ===
+# date_score is flat (20) beyond 30 days, so by default Step 4.5 only scores open items due within
+# FUZZY_DATE_WINDOW_DAYS of the payment's value/payment date. 0 scores every item as before.
+FUZZY_DATE_WINDOW_DAYS = int(os.getenv("FUZZY_DATE_WINDOW_DAYS", "30"))
+
+
+class DueDateIndex:
+    """Open items of one customer group sorted by due-date ordinal, for date-window candidate lookups"""
+
+    def __init__(self, invoices: List[OpenItem], inv_cents: Dict[str, int], window_days: Optional[int] = None,
+                 prune_far_amounts: bool = True):
+        self.window_days = FUZZY_DATE_WINDOW_DAYS if window_days is None else window_days
+        self.prune_far_amounts = prune_far_amounts
+        self._invoices = invoices
+        dated, self._undated = [], []
+        for pos, inv in enumerate(invoices):
+            day = _date_ordinal(inv.due_in_date)
+            if np.isnan(day):
+                self._undated.append(pos)  # date_score gives these 50 for any payment - always a candidate
+            else:
+                dated.append((int(day), pos))
+        dated.sort()
+        self._days = [day for day, _ in dated]
+        self._positions = [pos for _, pos in dated]
+        by_amount = sorted((inv_cents[invoices[pos].invoice_id], pos, day) for day, pos in dated)
+        self._amounts = [amount for amount, _, _ in by_amount]
+        self._by_amount = [(pos, day) for _, pos, day in by_amount]
+
+    def candidate_passes(self, pay: Payment, pay_cents: int, lag_window: Optional[tuple] = None):
+        """
+        Yield the in-window candidates, then (lazily) the out-of-window fallback, in group order.
+        With the customer's lag_window (usual lag, half-width) the items due around the payment date
+        minus the usual lag come first as their own pass, most likely lag first.
+        """
+        anchor = _date_ordinal(pay.value_date or pay.payment_date)
+        if np.isnan(anchor):
+            yield self._invoices  # No usable payment date: every item scores date 50, nothing to prune
+            return
+        likely = set()
+        if lag_window is not None:
+            expected = anchor - lag_window[0]
+            l_lo = bisect.bisect_left(self._days, expected - lag_window[1])
+            l_hi = bisect.bisect_right(self._days, expected + lag_window[1])
+            ranked = sorted(range(l_lo, l_hi), key=lambda i: (abs(self._days[i] - expected), self._positions[i]))
+            likely = {self._positions[i] for i in ranked}
+            yield [self._invoices[self._positions[i]] for i in ranked]
+        lo = bisect.bisect_left(self._days, anchor - self.window_days)
+        hi = bisect.bisect_right(self._days, anchor + self.window_days)
+        yield [self._invoices[pos] for pos in sorted(self._positions[lo:hi] + self._undated) if pos not in likely]
+
+        # Fallback: outside the window date_score is at most 50, so under the default plan a candidate
+        # can only reach fuzzy_review with an amount within 5.00 - look those up by amount instead of scanning
+        if self.window_days >= 10 and self.prune_far_amounts:
+            a_lo = bisect.bisect_left(self._amounts, pay_cents - AMOUNT_CLOSE_CENTS)
+            a_hi = bisect.bisect_right(self._amounts, pay_cents + AMOUNT_CLOSE_CENTS)
+            fallback = [pos for pos, day in self._by_amount[a_lo:a_hi] if abs(day - anchor) > self.window_days]
+        else:
+            fallback = [self._positions[i] for i in range(len(self._positions)) if i < lo or i >= hi]
+        yield [self._invoices[pos] for pos in sorted(fallback) if pos not in likely]
+
+
+# === 3h. FUZZY ASSIGNMENT ===
+# "optimal" (the default) solves a maximum-weight matching over all payment x open item pairs of a
+# customer group that reach the plan's fuzzy_review score, so an early weak match no longer takes the
+# invoice a later payment needed. "greedy" is the fallback: the original first-come, best-unused-invoice order.
+FUZZY_ASSIGNMENT = os.getenv("FUZZY_ASSIGNMENT", "optimal").lower()
+
+
+def fuzzy_signals(inv: OpenItem, scored: Dict[str, np.ndarray], j: int) -> tuple:
+    """Candidate j of a score_candidates() result as (inv, amount_diff, amount, name, date, memo, terms)"""
+    return (inv, int(scored["amount_diff"][j]), *(float(scored[signal][j]) for signal in ("amount", "name", "date", "memo", "terms")))
+
+
+def max_weight_assignment(edges: List[tuple]) -> List[tuple]:
+    """
+    Maximum-weight 1:1 assignment on a sparse bipartite graph of (left, right, weight) edges.
+    The graph is split into connected components first; a component with a single payment or a
+    single invoice just takes its heaviest edge (first one on ties). The rest are solved together
+    with scipy's sparse min_weight_full_bipartite_matching on the candidate edges only: weights
+    become costs (top - weight) and every left node gets a private "unassigned" column at cost
+    top, so a full matching always exists and leaving a payment out is never cheaper than an edge.
+    """
+    components = connected_components([(left, right) for left, right, _ in edges])
+    component_of = {left: n for n, (lefts, _) in enumerate(components) for left in lefts}
+    component_edges = defaultdict(list)
+    for edge in edges:
+        component_edges[component_of[edge[0]]].append(edge)
+
+    pairs = []
+    contested = []
+    for n, (lefts, rights) in enumerate(components):
+        if len(lefts) == 1 or len(rights) == 1:
+            left, right, _ = max(component_edges[n], key=lambda edge: edge[2])
+            pairs.append((left, right))
+        else:
+            contested.extend(component_edges[n])
+    if not contested:
+        return pairs
+
+    lefts = list(dict.fromkeys(left for left, _, _ in contested))
+    rights = list(dict.fromkeys(right for _, right, _ in contested))
+    row_of = {left: i for i, left in enumerate(lefts)}
+    col_of = {right: j for j, right in enumerate(rights)}
+    top = max(weight for _, _, weight in contested) + 1.0
+    rows = [row_of[left] for left, _, _ in contested] + list(range(len(lefts)))
+    cols = [col_of[right] for _, right, _ in contested] + [len(rights) + i for i in range(len(lefts))]
+    costs = [top - weight for _, _, weight in contested] + [top] * len(lefts)
+    biadjacency = sparse.csr_matrix((np.array(costs), (rows, cols)), shape=(len(lefts), len(rights) + len(lefts)))
+    matched_rows, matched_cols = min_weight_full_bipartite_matching(biadjacency)
+    pairs.extend((lefts[i], rights[j]) for i, j in zip(matched_rows, matched_cols) if j < len(rights))
+    return pairs
+
+
+# === 3i. CROSS-CUSTOMER MEMO MATCHING (third-party payers) ===
+# A parent company or factor pays under its own name, so Step 4.5 never puts the payment in the
+# invoice's customer group. Step 4.6 compares what is left by memo text alone, across the whole
+# open-item book: TF-IDF weighted character n-grams, cosine similarity from one sparse product.
+# A match needs a close amount and a clear lead over the payment's runner-up, and always goes to HITL.
+MEMO_TFIDF_MATCHING = os.getenv("MEMO_TFIDF_MATCHING", "1") == "1"
+MEMO_TFIDF_NGRAM = int(os.getenv("MEMO_TFIDF_NGRAM", "3"))
+MEMO_TFIDF_MIN_SIMILARITY = float(os.getenv("MEMO_TFIDF_MIN_SIMILARITY", "0.6"))
+MEMO_TFIDF_MARGIN = float(os.getenv("MEMO_TFIDF_MARGIN", "0.05"))  # Lead over the next candidate
+MEMO_TFIDF_CHUNK_ROWS = 512  # payment rows per sparse product, bounds the similarity matrix
+
+
+def _char_ngrams(text: str, n: int) -> List[str]:
+    padded = f" {_normalize_text(text)} "
+    return [padded[i:i + n] for i in range(len(padded) - n + 1)] if padded.strip() else []
+
+
+def tfidf_matrices(queries: List[str], documents: List[str], n: int = MEMO_TFIDF_NGRAM) -> tuple:
+    """
+    L2-normalized sparse TF-IDF rows for queries and documents over character n-grams.
+    IDF comes from the documents (the open-item book); query n-grams the book never uses get the
+    highest IDF, so extra text in a memo lowers its similarity instead of being ignored.
+    """
+    vocabulary: Dict[str, int] = {}
+    doc_grams = []
+    for text in documents:
+        counts: Dict[int, int] = defaultdict(int)
+        for gram in _char_ngrams(text, n):
+            counts[vocabulary.setdefault(gram, len(vocabulary))] += 1
+        doc_grams.append(counts)
+    query_grams = []
+    for text in queries:
+        counts = defaultdict(int)
+        for gram in _char_ngrams(text, n):
+            counts[vocabulary.setdefault(gram, len(vocabulary))] += 1
+        query_grams.append(counts)
+
+    doc_freq = np.zeros(len(vocabulary))
+    for counts in doc_grams:
+        doc_freq[list(counts)] += 1
+    idf = np.log((1.0 + len(documents)) / (1.0 + doc_freq)) + 1.0
+
+    def to_matrix(rows):
+        indptr, indices, data = [0], [], []
+        for counts in rows:
+            indices.extend(counts)
+            data.extend(counts.values())
+            indptr.append(len(indices))
+        matrix = sparse.csr_matrix((np.array(data, dtype=np.float64), np.array(indices, dtype=np.int64), indptr),
+                                   shape=(len(rows), len(vocabulary)))
+        matrix.data = 1.0 + np.log(matrix.data)  # Sublinear tf: a repeated n-gram is not 5x the evidence
+        matrix = matrix.multiply(idf).tocsr()
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        return sparse.diags(1.0 / norms) @ matrix
+
+    return to_matrix(query_grams), to_matrix(doc_grams)
+
+
+def memo_similarity_matches(payments: List[Payment], memo_lines: List[str], inv_amount: np.ndarray,
+                            pay_cents: Dict[str, int]) -> List[tuple]:
+    """
+    (payment, j, similarity) for payments whose memo clearly points at one open item (memo_lines[j],
+    inv_amount[j] in cents) with an amount within AMOUNT_CLOSE_CENTS. Pairs are taken by descending
+    similarity, each invoice once.
+    """
+    if not payments or not memo_lines:
+        return []
+    pay_matrix, inv_matrix = tfidf_matrices([p.memo_text for p in payments], memo_lines)
+    inv_matrix_t = inv_matrix.T.tocsc()
+
+    proposals = []
+    for start in range(0, len(payments), MEMO_TFIDF_CHUNK_ROWS):
+        similarity = (pay_matrix[start:start + MEMO_TFIDF_CHUNK_ROWS] @ inv_matrix_t).tocsr()
+        for r in range(similarity.shape[0]):
+            pay = payments[start + r]
+            cols = similarity.indices[similarity.indptr[r]:similarity.indptr[r + 1]]
+            sims = similarity.data[similarity.indptr[r]:similarity.indptr[r + 1]]
+            close = np.abs(inv_amount[cols] - pay_cents[pay.payment_id]) <= AMOUNT_CLOSE_CENTS
+            cols, sims = cols[close], sims[close]
+            if not len(cols):
+                continue
+            order = np.lexsort((cols, -sims))  # Best first, book order on ties
+            best = sims[order[0]]
+            runner_up = sims[order[1]] if len(order) > 1 else 0.0
+            if best >= MEMO_TFIDF_MIN_SIMILARITY and best - runner_up >= MEMO_TFIDF_MARGIN:
+                proposals.append((float(best), start + r, int(cols[order[0]])))
+
+    matches, taken = [], set()
+    for sim, p, j in sorted(proposals, key=lambda proposal: (-proposal[0], proposal[1])):
+        if j not in taken:
+            taken.add(j)
+            matches.append((payments[p], j, sim))
+    return matches
+
+
+# === 3j. PAYMENT-LAG PROFILES (learned per customer) ===
+# Customers pay on a characteristic lag (payment/value date minus due date), some reliably 12 days
+# late. With PAYMENT_PROFILE_PATH set, the lag of every high-confidence explicit-ID match (Steps 1-3,
+# each payment_id once) is folded into a per-customer mean/variance (Welford) kept in SQLite. Once a
+# customer has PAYMENT_PROFILE_MIN_MATCHES matches, Step 4.5 first scores the open items due around
+# the payment date minus the usual lag, most likely lag first, and stops there when one reaches
+# fuzzy_review. date_score itself is unchanged. Each worker learns in memory and a background thread
+# merges into the file every PAYMENT_PROFILE_REFRESH_SECONDS; the merged profiles are served until
+# the next refresh, so a run sees one fixed snapshot (part of the result cache key).
+PAYMENT_PROFILE_PATH = os.getenv("PAYMENT_PROFILE_PATH")
+PAYMENT_PROFILE_MIN_MATCHES = int(os.getenv("PAYMENT_PROFILE_MIN_MATCHES", "5"))
+PAYMENT_PROFILE_SIGMAS = float(os.getenv("PAYMENT_PROFILE_SIGMAS", "2.5"))
+PAYMENT_PROFILE_MIN_WINDOW_DAYS = int(os.getenv("PAYMENT_PROFILE_MIN_WINDOW_DAYS", "3"))
+PAYMENT_PROFILE_REFRESH_SECONDS = float(os.getenv("PAYMENT_PROFILE_REFRESH_SECONDS", "60"))
+PAYMENT_PROFILE_MAX_LAG_DAYS = 120  # one-off outliers (a disputed invoice paid months late) are clipped
+
+
+def merge_lag_stats(a: tuple, b: tuple) -> tuple:
+    """Combine two (n, mean, m2) Welford accumulators (Chan et al.)"""
+    n = a[0] + b[0]
+    if n == 0:
+        return 0, 0.0, 0.0
+    delta = b[1] - a[1]
+    return n, a[1] + delta * b[0] / n, a[2] + b[2] + delta * delta * a[0] * b[0] / n
+
+
+class PaymentProfiles:
+    """Immutable lag windows of one snapshot: customer key -> (usual lag, half-width) in days"""
+
+    def __init__(self, stats: Dict[str, tuple]):
+        self.customers = len(stats)
+        self.windows = {}
+        for key, (n, mean, m2) in stats.items():
+            if n >= max(PAYMENT_PROFILE_MIN_MATCHES, 2):
+                spread = math.ceil(PAYMENT_PROFILE_SIGMAS * math.sqrt(m2 / (n - 1)))
+                half_width = min(max(PAYMENT_PROFILE_MIN_WINDOW_DAYS, spread), max(FUZZY_DATE_WINDOW_DAYS, 1))
+                self.windows[key] = (int(round(mean)), half_width)
+        self.version = hashlib.sha256(json.dumps(sorted(self.windows.items())).encode("utf-8")).hexdigest()[:12]
+
+    def window(self, customer_name: str) -> Optional[tuple]:
+        return self.windows.get(_normalize_text(customer_name))
+
+
+class PaymentProfileStore:
+    """
+    Per-customer (n, mean, m2) of the payment lag in SQLite, shared by the workers on a host.
+    learn() and snapshot() run on the event loop and never touch the file: a daemon thread, started
+    on first use, merges the pending lags into it and re-reads it every PAYMENT_PROFILE_REFRESH_SECONDS.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._pending: Dict[str, tuple] = {}  # payment_id -> (customer key, lags)
+        self._profiles = PaymentProfiles({})
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS payment_profiles ("
+                "customer TEXT PRIMARY KEY, n INTEGER NOT NULL, mean REAL NOT NULL, m2 REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            # Payments already folded in: a payment seen again (retry, batch and /reconcile, new config) counts once
+            conn.execute("CREATE TABLE IF NOT EXISTS payment_profile_sources (payment_id TEXT PRIMARY KEY, learned_at REAL NOT NULL)")
+            self._conn = conn
+        return self._conn
+
+    def _load(self) -> PaymentProfiles:
+        rows = self._connect().execute("SELECT customer, n, mean, m2 FROM payment_profiles").fetchall()
+        return PaymentProfiles({customer: (n, mean, m2) for customer, n, mean, m2 in rows})
+
+    def _start_refresher(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self.refresh()
+            if self._stop.wait(max(PAYMENT_PROFILE_REFRESH_SECONDS, 0.1)):
+                return
+
+    def learn(self, request: ReconciliationRequest, response: ReconciliationResponse,
+              ledger: Optional["LedgerSnapshot"] = None) -> None:
+        """
+        Queue the lags of the response's high-confidence explicit-ID matches (group.stage 1:1, N:1 or
+        1:N). Fuzzy matches are left out: Step 4.5 ranks its candidates by these profiles, so learning
+        from them would only confirm the profiles' own guesses. ledger: the snapshot the request was
+        matched against. The callers learn from computed responses only: a payload answered from the
+        result cache (or coalesced into a running computation) teaches nothing new, so it is not
+        learned again - its payments were folded in when it was computed.
+        """
+        self._start_refresher()
+        pay_map = inv_map = None
+        learned = {}
+        for group in response.high_confidence:
+            if group.stage not in ("1:1", "N:1", "1:N"):
+                continue  # N:M (which payment settled which invoice is not known) and fuzzy matches
+            if pay_map is None:
+                pay_map = {pay.payment_id: pay for pay in request.payments}
+                inv_map = {inv.invoice_id: inv for inv in request.open_items} if ledger is None else None
+            for pid in group.payment_ids:
+                pay = pay_map[pid]
+                key = _normalize_text(pay.customer_name)
+                paid = _date_ordinal(pay.value_date or pay.payment_date)
+                if not key or np.isnan(paid):
+                    continue
+                lags = []
+                for iid in group.invoice_ids:
+                    due = _date_ordinal(inv_map[iid].due_in_date) if ledger is None else ledger.due_ordinal(iid)
+                    if not np.isnan(due):
+                        lags.append(min(max(paid - due, -PAYMENT_PROFILE_MAX_LAG_DAYS), PAYMENT_PROFILE_MAX_LAG_DAYS))
+                if lags:
+                    learned[pid] = (key, lags)
+        if learned:
+            with self._lock:
+                for pid, entry in learned.items():
+                    self._pending.setdefault(pid, entry)
+
+    def flush(self) -> None:
+        """Merge the pending lags into the file in one transaction, so concurrent workers don't lose updates"""
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            merged: Dict[str, tuple] = {}
+            for pid, (key, lags) in pending.items():
+                if conn.execute("INSERT OR IGNORE INTO payment_profile_sources (payment_id, learned_at) VALUES (?, ?)",
+                                (pid, now)).rowcount:
+                    for lag in lags:
+                        merged[key] = merge_lag_stats(merged.get(key, (0, 0.0, 0.0)), (1, lag, 0.0))
+            for key, stats in merged.items():
+                row = conn.execute("SELECT n, mean, m2 FROM payment_profiles WHERE customer = ?", (key,)).fetchone()
+                n, mean, m2 = merge_lag_stats(row or (0, 0.0, 0.0), stats)
+                conn.execute("INSERT OR REPLACE INTO payment_profiles (customer, n, mean, m2, updated_at) "
+                             "VALUES (?, ?, ?, ?, ?)", (key, n, mean, m2, now))
+            conn.execute("COMMIT")
+            metrics["profile_lags_learned"] += sum(stats[0] for stats in merged.values())
+        except sqlite3.Error as e:
+            if self._conn is not None and self._conn.in_transaction:
+                self._conn.execute("ROLLBACK")
+            with self._lock:  # Kept for the next refresh
+                for pid, entry in pending.items():
+                    self._pending.setdefault(pid, entry)
+            metrics["profile_write_errors"] += 1
+            print(f"Payment profiles: merge into {self.path} failed: {e}")
+
+    def refresh(self) -> None:
+        self.flush()
+        try:
+            self._profiles = self._load()
+        except sqlite3.Error as e:
+            print(f"Payment profiles: reload from {self.path} failed, keeping {self._profiles.version}: {e}")
+
+    def snapshot(self) -> PaymentProfiles:
+        """The profiles to run with: those of the last refresh (empty until the first one has read the file)"""
+        self._start_refresher()
+        return self._profiles
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self.flush()
+        if self._conn is not None:
+            self._conn.close()
+
+
+payment_profiles = PaymentProfileStore(PAYMENT_PROFILE_PATH) if PAYMENT_PROFILE_PATH else None
+
+
+@app.on_event("shutdown")
+def close_payment_profiles():
+    if payment_profiles is not None:
+        payment_profiles.close()
+
 
 def create_detailed_error_message(validation_error) -> Dict[str, Any]:
     """Convert Pydantic validation errors into LLM-friendly instructions"""
@@ -339,55 +1644,1563 @@ async def get_schema():
     }
 
 
+# === RESULT CACHE (idempotent retries) ===
+# n8n retries failed/timed-out steps with the exact same payload. Results are keyed on a hash of
+# the canonicalized request plus engine version and scoring plan fingerprint, so a repeat is served
+# from memory - and a new scoring config never returns results computed under the old one.
+ENGINE_VERSION = app.version
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "900"))
+RESULT_CACHE_TRIM_EVERY = int(os.getenv("RESULT_CACHE_TRIM_EVERY", "64"))  # SQLite puts between LRU trims
+
+
+class ResultCache:
+    """Bounded LRU cache with a per-entry TTL"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    # The event loop calls these; a dict lookup is cheaper than a hop to the threadpool
+    async def aget(self, key: str):
+        return self.get(key)
+
+    async def aput(self, key: str, value) -> None:
+        self.put(key, value)
+
+
+class SqliteResultCache:
+    """
+    ResultCache backed by a local SQLite file so all uvicorn workers on a host share it. The LRU
+    trim runs every RESULT_CACHE_TRIM_EVERY puts of this worker, so the file may briefly hold a
+    few more than max_entries; expired rows go with the same trim.
+    """
+
+    def __init__(self, path: str, max_entries: int, ttl_seconds: float, trim_every: int = RESULT_CACHE_TRIM_EVERY):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.trim_every = max(1, trim_every)
+        self._local = threading.local()
+        self._puts = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Opened on first use, so batch pool processes (which re-import this module) never touch the file
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS result_cache ("
+                "key TEXT PRIMARY KEY, expires_at REAL NOT NULL, accessed_at REAL NOT NULL, value BLOB NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS result_cache_accessed ON result_cache (accessed_at)")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str):
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute("SELECT expires_at, value FROM result_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[0] < now:
+            conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE result_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return pickle.loads(row[1])
+
+    def put(self, key: str, value) -> None:
+        if self.max_entries <= 0:
+            return
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO result_cache (key, expires_at, accessed_at, value) VALUES (?, ?, ?, ?)",
+            (key, now + self.ttl_seconds, now, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        )
+        with self._lock:
+            self._puts += 1
+            trim = self._puts % self.trim_every == 0
+        if trim:
+            self.trim()
+
+    def trim(self) -> None:
+        conn = self._connect()
+        conn.execute("DELETE FROM result_cache WHERE expires_at < ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM result_cache WHERE key IN ("
+            "SELECT key FROM result_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    # Every get writes accessed_at and every put commits: keep the file I/O off the event loop
+    async def aget(self, key: str):
+        return await run_in_threadpool(self.get, key)
+
+    async def aput(self, key: str, value) -> None:
+        await run_in_threadpool(self.put, key, value)
+
+
+# With several workers (WEB_CONCURRENCY > 1) set RESULT_CACHE_PATH so a retry that lands on
+# another worker is still served from cache. Coalescing of in-flight requests stays per worker.
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH")
+if RESULT_CACHE_PATH:
+    result_cache = SqliteResultCache(RESULT_CACHE_PATH, RESULT_CACHE_SIZE, RESULT_CACHE_TTL_SECONDS)
+else:
+    result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL_SECONDS)
+_inflight: Dict[str, asyncio.Future] = {}
+
+# An Idempotency-Key pins the payload it was first sent with, per API key (two workflows may pick
+# the same key). Pins live in their own store: an LRU entry pushed out by result traffic would let
+# a reused key through with a different payload. They expire after IDEMPOTENCY_TTL_SECONDS only,
+# which must cover the client's whole retry window; expired pins go every IDEMPOTENCY_TRIM_EVERY pins.
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_TRIM_EVERY = int(os.getenv("IDEMPOTENCY_TRIM_EVERY", "256"))
+
+
+class IdempotencyStore:
+    """Idempotency-Key -> payload hash pins with a TTL and no size bound"""
+
+    def __init__(self, ttl_seconds: float, trim_every: int = IDEMPOTENCY_TRIM_EVERY):
+        self.ttl_seconds = ttl_seconds
+        self.trim_every = max(1, trim_every)
+        self._pins: Dict[str, tuple] = {}
+        self._pinned = 0
+        self._lock = threading.Lock()
+
+    def pin(self, key: str, payload: str) -> str:
+        """Pin payload to key unless a live pin exists; returns the payload the key is pinned to"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._pins.get(key)
+            if entry is not None and entry[0] >= now:
+                return entry[1]
+            self._pins[key] = (now + self.ttl_seconds, payload)
+            self._pinned += 1
+            if self._pinned % self.trim_every == 0:
+                self._pins = {k: v for k, v in self._pins.items() if v[0] >= now}
+            return payload
+
+    async def apin(self, key: str, payload: str) -> str:
+        return self.pin(key, payload)
+
+
+class SqliteIdempotencyStore:
+    """IdempotencyStore in the result cache's SQLite file, so a retry on another worker sees the pin"""
+
+    def __init__(self, path: str, ttl_seconds: float, trim_every: int = IDEMPOTENCY_TRIM_EVERY):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.trim_every = max(1, trim_every)
+        self._local = threading.local()
+        self._pinned = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency_pins ("
+                "key TEXT PRIMARY KEY, expires_at REAL NOT NULL, payload TEXT NOT NULL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def pin(self, key: str, payload: str) -> str:
+        conn = self._connect()
+        now = time.time()
+        # One statement, so two workers racing on a fresh key agree on the winner
+        conn.execute(
+            "INSERT INTO idempotency_pins (key, expires_at, payload) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET expires_at = excluded.expires_at, payload = excluded.payload "
+            "WHERE idempotency_pins.expires_at < ?",
+            (key, now + self.ttl_seconds, payload, now)
+        )
+        pinned = conn.execute("SELECT payload FROM idempotency_pins WHERE key = ?", (key,)).fetchone()[0]
+        with self._lock:
+            self._pinned += 1
+            trim = self._pinned % self.trim_every == 0
+        if trim:
+            conn.execute("DELETE FROM idempotency_pins WHERE expires_at < ?", (now,))
+        return pinned
+
+    async def apin(self, key: str, payload: str) -> str:
+        return await run_in_threadpool(self.pin, key, payload)
+
+
+if RESULT_CACHE_PATH:
+    idempotency_pins = SqliteIdempotencyStore(RESULT_CACHE_PATH, IDEMPOTENCY_TTL_SECONDS)
+else:
+    idempotency_pins = IdempotencyStore(IDEMPOTENCY_TTL_SECONDS)
+
+
+def _canonical_request(request: ReconciliationRequest) -> bytes:
+    return json.dumps(request.model_dump(mode="json"), sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def request_hash(request: ReconciliationRequest, *options) -> str:
+    """Hash of the canonicalized request, engine version and options (scoring plan, response options)"""
+    option_part = "|".join(str(o) for o in options)
+    digest = hashlib.sha256(f"{ENGINE_VERSION}|{option_part}|".encode("utf-8"))
+    digest.update(_canonical_request(request))
+    return digest.hexdigest()
+
+
+def payload_hash(request: ReconciliationRequest) -> str:
+    """Hash of the canonicalized request alone: what an Idempotency-Key pins"""
+    return hashlib.sha256(_canonical_request(request)).hexdigest()
+
+
+
+def cache_options(plan: ScoringPlan, profiles: Optional[PaymentProfiles], top_k: int = 0,
+                  snapshot: Optional["LedgerSnapshot"] = None) -> List[str]:
+    """request_hash options of one computation; /reconcile and the batch path share them, so equal work shares a key"""
+    options = [f"config={plan.fingerprint}", f"top_k={top_k}"]
+    if profiles is not None:
+        options.append(f"profiles={profiles.version}")
+    if snapshot is not None:
+        options.append(f"ledger={snapshot.digest}")
+    return options
+
+
+MAX_PAYMENTS_PER_REQUEST = int(os.getenv("MAX_PAYMENTS_PER_REQUEST", "1000"))
+MAX_OPEN_ITEMS_PER_REQUEST = int(os.getenv("MAX_OPEN_ITEMS_PER_REQUEST", "1000"))
+
+
+def check_request_limits(request: ReconciliationRequest) -> None:
+    if len(request.payments) > MAX_PAYMENTS_PER_REQUEST or len(request.open_items) > MAX_OPEN_ITEMS_PER_REQUEST:
+        raise HTTPException(400, f"Max {MAX_PAYMENTS_PER_REQUEST} payments and {MAX_OPEN_ITEMS_PER_REQUEST} open items")
+
+
+# === MEMORY BUDGET (per-request accounting and admission) ===
+# Every computation reserves an up-front estimate of its peak memory against MEMORY_BUDGET_MB, the
+# share of the container this worker may spend on engine working sets. A request that can never
+# fit is rejected with 413 (split it); one that does not fit next to the requests already running
+# gets 503 + Retry-After, so the client retries here or on another worker once memory is released.
+# Batch entities are already accepted, so they queue for the budget instead. 0 = no budget, the
+# reservations are still tracked for /metrics.
+#
+# The estimate is calibrated with tracemalloc on synthetic_data payloads: engine state, request
+# model and response groups cost a few KB per payment or open item; top_k adds the similarity
+# matrices over unique names and memos (unbounded) and the score arrays of one suggestion chunk.
+# MEMORY_PROFILING=1 traces allocations and records the peak of every engine stage. tracemalloc
+# slows the engine down 2-3x and its peak is process-wide, so profile on a worker with
+# MAX_IN_FLIGHT=1 to get exact per-request figures. Without it there is no per-request measurement,
+# only the estimate; as a cross-check every run samples the process RSS at its stage boundaries,
+# and a run that had the process to itself compares its RSS growth with its estimate
+# (memory_estimate_low_rss). RSS growth is a lower bound of the run's peak - memory the allocator
+# already held is reused without growing RSS - so it can show an estimate is low, never that it is high.
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", "0"))
+MEMORY_PROFILING = os.getenv("MEMORY_PROFILING", "0") == "1"
+MEMORY_ROW_BYTES = 4_800               # per payment / open item
+MEMORY_SIMILARITY_CELL_BYTES = 24      # cdist ratios + tiered scores per unique name / memo pair
+MEMORY_SUGGESTION_CELL_BYTES = 80      # float64 score arrays per payment x invoice cell of a chunk
+MEMORY_CANDIDATE_BYTES = 1_400         # one CandidateScore in the response
+MEMORY_LEDGER_ROW_BYTES = 1_500        # per ledger snapshot row a ledger=true run decodes (memo TF-IDF, Step 5 pool)
+MEMORY_LEDGER_WRITE_BYTES = 1_500      # per open item while POST /ledger/snapshot builds the columns
+MEMORY_RSS_SLACK_BYTES = 4 * 1048576    # RSS a run may grow by regardless of size (allocator arenas, first-use caches)
+memory_peaks: Dict[str, int] = defaultdict(int)  # stage -> largest traced peak (MEMORY_PROFILING)
+rss_growth_peaks: Dict[str, int] = defaultdict(int)  # stage -> largest RSS growth of a run that ran alone
+_engine_runs: "weakref.WeakSet[StageMemory]" = weakref.WeakSet()  # runs in this process (a failed run drops out)
+_engine_starts = 0
+_engine_lock = threading.Lock()
+
+if MEMORY_PROFILING:
+    tracemalloc.start()
+
+
+def estimate_request_bytes(request: ReconciliationRequest, top_k: int = 0,
+                           ledger: Optional["LedgerSnapshot"] = None) -> int:
+    """Expected peak memory of run_reconciliation for this request (against ledger's book), from sizes alone"""
+    n_pay = len(request.payments)
+    if ledger is not None:
+        n_inv = ledger.meta["open_rows"]
+        estimate = MEMORY_ROW_BYTES * n_pay + MEMORY_LEDGER_ROW_BYTES * ledger.rows
+    else:
+        n_inv = len(request.open_items)
+        estimate = MEMORY_ROW_BYTES * (n_pay + n_inv)
+    if top_k > 0 and n_pay and n_inv:
+        if ledger is not None:
+            inv_names, inv_memos = ledger.meta["unique_names"], ledger.meta["unique_memos"]
+        else:
+            inv_names = len({i.customer_name.upper() for i in request.open_items})
+            inv_memos = len({i.memo_line.upper() for i in request.open_items})
+        names = len({p.customer_name.upper() for p in request.payments}) * inv_names
+        memos = len({p.memo_text.upper() for p in request.payments}) * inv_memos
+        chunk_cells = min(n_pay, max(1, SUGGESTION_CHUNK_CELLS // n_inv)) * n_inv
+        estimate += (MEMORY_SIMILARITY_CELL_BYTES * (names + memos) + MEMORY_SUGGESTION_CELL_BYTES * chunk_cells
+                     + MEMORY_CANDIDATE_BYTES * n_pay * min(top_k, n_inv))
+    return estimate
+
+
+class MemoryBudget:
+    """Estimated bytes reserved by the computations running on this worker (event loop only)"""
+
+    def __init__(self, limit_mb: float):
+        self.limit = int(limit_mb * 1024 * 1024)
+        self.reserved = 0
+        self.peak_reserved = 0
+        self.largest_estimate = 0
+        self._released: Optional[asyncio.Condition] = None
+
+    def check(self, nbytes: int) -> None:
+        """413 for a request that exceeds the whole budget on its own"""
+        self.largest_estimate = max(self.largest_estimate, nbytes)
+        if self.limit and nbytes > self.limit:
+            metrics["rejected_memory_oversize"] += 1
+            raise HTTPException(413, f"Request needs an estimated {nbytes / 1048576:.0f} MB, over this worker's "
+                                     f"{self.limit / 1048576:.0f} MB memory budget - send fewer payments or open items")
+
+    @contextlib.asynccontextmanager
+    async def hold(self, nbytes: int, wait: bool = False):
+        """Reserve nbytes for the block; over budget: 503 + Retry-After, or with wait=True queue for it"""
+        self.check(nbytes)
+        if self.limit and self.reserved + nbytes > self.limit:
+            if not wait:
+                metrics["rejected_memory"] += 1
+                raise HTTPException(503, "Memory budget in use - retry later", headers={"Retry-After": "1"})
+            metrics["memory_waits"] += 1
+            if self._released is None:
+                self._released = asyncio.Condition()
+            async with self._released:
+                await self._released.wait_for(lambda: self.reserved + nbytes <= self.limit)
+        self.reserved += nbytes
+        self.peak_reserved = max(self.peak_reserved, self.reserved)
+        try:
+            yield
+        finally:
+            self.reserved -= nbytes
+            if self._released is not None:
+                async with self._released:
+                    self._released.notify_all()
+
+
+memory_budget = MemoryBudget(MEMORY_BUDGET_MB)
+
+
+class StageMemory:
+    """
+    Memory of one engine run per stage. RSS growth since the start of the run is sampled at every
+    stage boundary (one /proc read, always on); under MEMORY_PROFILING the traced peak is kept too.
+    """
+
+    def __init__(self, ledger: Optional["LedgerSnapshot"] = None):
+        global _engine_starts
+        self.ledger = ledger
+        self.stage = "setup"
+        self.traced = tracemalloc.is_tracing()
+        self.rss_start, self.peak_rss_start = rss_bytes()
+        self.rss_growth: Dict[str, int] = {}
+        self.peaks: Dict[str, int] = {}
+        with _engine_lock:
+            _engine_starts += 1
+            _engine_runs.add(self)
+            self.started = _engine_starts
+            self.alone = len(_engine_runs) == 1
+        if self.traced:
+            self.start, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+
+    def enter(self, stage: str) -> None:
+        rss, _ = rss_bytes()
+        if rss is not None and self.rss_start is not None:
+            self.rss_growth[self.stage] = max(self.rss_growth.get(self.stage, 0), rss - self.rss_start)
+        if self.traced:
+            _, peak = tracemalloc.get_traced_memory()
+            self.peaks[self.stage] = max(self.peaks.get(self.stage, 0), peak - self.start)
+            tracemalloc.reset_peak()
+        self.stage = stage
+
+    def finish(self, request: ReconciliationRequest, top_k: int) -> None:
+        self.enter("done")
+        with _engine_lock:
+            alone = self.alone and _engine_starts == self.started
+            _engine_runs.discard(self)
+        estimate = estimate_request_bytes(request, top_k, self.ledger)
+        if self.peaks:
+            request_peak = max(self.peaks.values())
+            for stage, peak in list(self.peaks.items()) + [("request", request_peak)]:
+                memory_peaks[stage] = max(memory_peaks[stage], peak)
+            if request_peak > estimate:
+                metrics["memory_estimate_low"] += 1
+        if not alone or not self.rss_growth:
+            return  # Another run moved the process RSS too; its growth says nothing about this one
+        growth = max(self.rss_growth.values())
+        _, peak_rss = rss_bytes()
+        if peak_rss is not None and self.peak_rss_start is not None and peak_rss > self.peak_rss_start:
+            growth = max(growth, peak_rss - self.rss_start)  # A new process high inside a stage
+        for stage, stage_growth in self.rss_growth.items():
+            rss_growth_peaks[stage] = max(rss_growth_peaks[stage], stage_growth)
+        rss_growth_peaks["request"] = max(rss_growth_peaks["request"], growth)
+        metrics["memory_rss_checked"] += 1
+        if growth > estimate + MEMORY_RSS_SLACK_BYTES:
+            metrics["memory_estimate_low_rss"] += 1
+
+
+def rss_bytes() -> tuple:
+    """(current, peak) resident set size of this process; None where the platform doesn't say"""
+    current = peak = None
+    try:
+        with open("/proc/self/statm", "r") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KB on Linux
+    return current, peak
+
+
+def memory_report() -> Dict[str, Any]:
+    mb = lambda n: None if n is None else round(n / 1048576, 1)
+    rss, peak_rss = rss_bytes()
+    return {
+        "budget_mb": mb(memory_budget.limit) if memory_budget.limit else None,
+        "reserved_mb": mb(memory_budget.reserved),
+        "peak_reserved_mb": mb(memory_budget.peak_reserved),
+        "largest_estimate_mb": mb(memory_budget.largest_estimate),
+        "rss_mb": mb(rss),
+        "peak_rss_mb": mb(peak_rss),
+        "profiling": MEMORY_PROFILING,
+        "measured": ("traced peak per stage (tracemalloc, process-wide)" if MEMORY_PROFILING else
+                     "estimate only; RSS growth of runs that ran alone as a lower bound"),
+        "stage_peak_mb": {stage: mb(peak) for stage, peak in memory_peaks.items()},
+        "stage_rss_growth_mb": {stage: mb(growth) for stage, growth in rss_growth_peaks.items()},
+    }
+
+
+# === DECISION LOG (write-behind audit trail of every MatchGroup) ===
+# Set DECISION_LOG_PATH to keep an append-only record of every decision the engine makes. Each
+# computed response becomes one entry: request hash, source, scoring config version, the stage of
+# every MatchGroup and the response body itself (bucket, reason and scores per group). A path ending
+# in ".jsonl.gz" gets gzip JSONL, one gzip member per batch; anything else is SQLite with a payment
+# index, so "why did PAY-123 go to hitl_review last Tuesday" is one lookup:
+#   for d in read_decisions("decisions.db", payment_id="PAY-123"): print(d["logged_at"], d["bucket"], d["reason"])
+# The request path hands over the serialized body /reconcile sends anyway (json_bytes) plus the
+# stage of each group; a background thread compresses and writes them in batches. Only bytes are
+# buffered - keeping the response objects alive until the flush measurably slowed the engine's
+# own allocations. When the buffer is full, entries are dropped and counted (decision_log_dropped).
+DECISION_LOG_PATH = os.getenv("DECISION_LOG_PATH")
+DECISION_LOG_MAX_PENDING_BYTES = int(float(os.getenv("DECISION_LOG_MAX_PENDING_MB", "64")) * 1_000_000)
+DECISION_LOG_BATCH_BYTES = int(float(os.getenv("DECISION_LOG_BATCH_MB", "8")) * 1_000_000)
+DECISION_LOG_FLUSH_SECONDS = float(os.getenv("DECISION_LOG_FLUSH_SECONDS", "2.0"))
+DECISION_BUCKETS = ("high_confidence", "hitl_review", "no_match", "duplicates")
+
+
+def append_gzip_member(path: str, data: bytes) -> None:
+    """
+    data as one complete gzip member in a single O_APPEND write, so several workers can share the
+    file; concatenated members read back as one stream (gzip.open / zcat)
+    """
+    compressed = gzip.compress(data, compresslevel=1)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, compressed)
+    finally:
+        os.close(fd)
+
+
+class DecisionLog:
+    """Bounded in-memory buffer of serialized responses plus a daemon thread that writes them in batches"""
+
+    def __init__(self, path: str, max_pending_bytes: int = DECISION_LOG_MAX_PENDING_BYTES,
+                 batch_bytes: int = DECISION_LOG_BATCH_BYTES, flush_seconds: float = DECISION_LOG_FLUSH_SECONDS):
+        self.path = path
+        self.max_pending_bytes = max_pending_bytes
+        self.batch_bytes = batch_bytes
+        self.flush_seconds = flush_seconds
+        self.gzip_jsonl = path.endswith(".jsonl.gz")
+        self._pending: List[tuple] = []
+        self._pending_bytes = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._conn = None
+        self._thread: Optional[threading.Thread] = None  # Started by the first submit, never in batch pool processes
+
+    def submit(self, request_key: str, response: ReconciliationResponse, source: str = "reconcile") -> bool:
+        """Cheap on the request path; False when the buffer is full and the entry was dropped"""
+        body = response.json_bytes()
+        stages = {bucket: [g.stage for g in getattr(response, bucket)] for bucket in DECISION_BUCKETS}
+        payments = None if self.gzip_jsonl else [
+            (pid, bucket, stage)
+            for bucket in DECISION_BUCKETS
+            for group, stage in zip(getattr(response, bucket), stages[bucket])
+            for pid in group.payment_ids
+        ]
+        with self._lock:
+            if self._stopped or self._pending_bytes + len(body) > self.max_pending_bytes:
+                metrics["decision_log_dropped"] += 1
+                return False
+            self._pending.append((time.time(), request_key, source, response.config_version, stages, payments, body))
+            self._pending_bytes += len(body)
+            self._start_writer()
+            full = self._pending_bytes >= self.batch_bytes
+        if full:
+            self._wake.set()
+        return True
+
+    def close(self) -> None:
+        """Stop accepting decisions and write out what is buffered"""
+        with self._lock:
+            self._stopped = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+
+    def _start_writer(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            with self._lock:
+                batch, self._pending, self._pending_bytes = self._pending, [], 0
+                stopped = self._stopped
+            if batch:
+                try:
+                    self._write_jsonl(batch) if self.gzip_jsonl else self._write_sqlite(batch)
+                    metrics["decision_log_entries"] += len(batch)
+                except Exception as e:
+                    metrics["decision_log_write_errors"] += 1
+                    print(f"Decision log write to {self.path} failed, {len(batch)} responses lost: {e}")
+            if stopped:
+                return
+
+    def _write_jsonl(self, batch: List[tuple]) -> None:
+        lines = []
+        for logged_at, key, source, config_version, stages, _, body in batch:
+            head = '{"logged_at":%.3f,"request_hash":%s,"source":%s,"config_version":%s,"stages":%s,"response":' % (
+                logged_at, json.dumps(key), json.dumps(source), json.dumps(config_version), json.dumps(stages))
+            lines += [head.encode("utf-8"), body, b"}\n"]
+        append_gzip_member(self.path, b"".join(lines))
+
+    def _write_sqlite(self, batch: List[tuple]) -> None:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS decision_responses ("
+                "id INTEGER PRIMARY KEY, logged_at REAL NOT NULL, request_hash TEXT NOT NULL, source TEXT NOT NULL, "
+                "config_version TEXT, stages TEXT NOT NULL, response BLOB NOT NULL)"  # response: zlib-compressed JSON
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS decision_payments ("
+                "payment_id TEXT NOT NULL, response_id INTEGER NOT NULL, bucket TEXT NOT NULL, stage TEXT NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS decision_payments_id ON decision_payments (payment_id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS decision_responses_hash ON decision_responses (request_hash)")
+        with self._conn:  # One transaction per batch
+            self._conn.execute("BEGIN")
+            payment_rows = []
+            for logged_at, key, source, config_version, stages, payments, body in batch:
+                response_id = self._conn.execute(
+                    "INSERT INTO decision_responses (logged_at, request_hash, source, config_version, stages, response) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (logged_at, key, source, config_version, json.dumps(stages), zlib.compress(body, 1))
+                ).lastrowid
+                payment_rows += [(pid, response_id, bucket, stage) for pid, bucket, stage in payments]
+            self._conn.executemany(
+                "INSERT INTO decision_payments (payment_id, response_id, bucket, stage) VALUES (?, ?, ?, ?)", payment_rows
+            )
+
+
+def read_decisions(path: str, payment_id: Optional[str] = None, request_hash: Optional[str] = None):
+    """
+    Yield one flat record per logged MatchGroup (logged_at, request_hash, source, config_version,
+    bucket, stage and the group's fields), oldest first, optionally only those of one payment / request.
+    """
+    def flatten(logged_at, key, source, stages, response):
+        for bucket in DECISION_BUCKETS:
+            for group, stage in zip(response[bucket], stages[bucket]):
+                if payment_id is None or payment_id in group["payment_ids"]:
+                    yield {"logged_at": logged_at, "request_hash": key, "source": source,
+                           "config_version": response["config_version"], "bucket": bucket, "stage": stage, **group}
+
+    if path.endswith(".jsonl.gz"):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                if request_hash is None or entry["request_hash"] == request_hash:
+                    yield from flatten(entry["logged_at"], entry["request_hash"], entry["source"],
+                                       entry["stages"], entry["response"])
+        return
+
+    conn = sqlite3.connect(path)
+    try:
+        query = "SELECT logged_at, request_hash, source, stages, response FROM decision_responses"
+        params: tuple = ()
+        if payment_id is not None:
+            query += " WHERE id IN (SELECT response_id FROM decision_payments WHERE payment_id = ?)"
+            params = (payment_id,)
+        elif request_hash is not None:
+            query += " WHERE request_hash = ?"
+            params = (request_hash,)
+        for logged_at, key, source, stages, blob in conn.execute(query + " ORDER BY id", params):
+            if request_hash is None or key == request_hash:
+                yield from flatten(logged_at, key, source, json.loads(stages), json.loads(zlib.decompress(blob)))
+    finally:
+        conn.close()
+
+
+decision_log = DecisionLog(DECISION_LOG_PATH) if DECISION_LOG_PATH else None
+
+
+@app.on_event("shutdown")
+def close_decision_log():
+    if decision_log is not None:
+        decision_log.close()
+
+
+# === TRAFFIC CAPTURE (pseudonymized /reconcile payloads for replay_traffic.py) ===
+# Opt-in: with TRAFFIC_CAPTURE_PATH (a .jsonl.gz file) set, a TRAFFIC_CAPTURE_SAMPLE share of the
+# computed /reconcile requests is appended to a local corpus that replay_traffic.py runs against any
+# engine build. IDs, customer names and memos are pseudonymized with a key, see Pseudonymizer;
+# amounts, dates, payment terms and flags are kept as they are. Legal forms and filler words
+# (PSEUDONYM_KEPT_WORDS: Corp, Corporation, Inc, Ltd, ...) carry no identity and are kept as well.
+# TRAFFIC_CAPTURE_PSEUDONYMS picks what survives of the rest:
+#   similarity (default) - one keyed substitution for all letters and one for all digits, applied
+#       character by character. Equal names stay equal, and prefixes and edit distances survive, so
+#       typo'd references still reach the BK-tree and name variants still group in Step 4.5. Name
+#       scores may move a few points where token_set_ratio sorts the words differently.
+#   tokens - every run of letters or digits becomes an unrelated token of the same length. Equality,
+#       separators and ID variants (INV-1001 / INV1001 / 1001) survive, similarity inside a token
+#       does not: a typo'd reference or a misspelt name no longer resembles the original.
+# Every captured entry records its mode, and replay_traffic.py reports what a corpus cannot exercise.
+# A substitution falls to frequency analysis over a large corpus: this is pseudonymization, not
+# anonymization, and the corpus stays on the host like the decision log. TRAFFIC_CAPTURE_KEY pins
+# the mapping across workers and restarts; without it every process draws a random key.
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH")
+TRAFFIC_CAPTURE_SAMPLE = float(os.getenv("TRAFFIC_CAPTURE_SAMPLE", "1.0"))
+TRAFFIC_CAPTURE_MAX_PENDING_BYTES = int(float(os.getenv("TRAFFIC_CAPTURE_MAX_PENDING_MB", "64")) * 1_000_000)
+TRAFFIC_CAPTURE_PSEUDONYMS = os.getenv("TRAFFIC_CAPTURE_PSEUDONYMS", "similarity").lower()
+_PSEUDONYM_TOKENS = re.compile(r"[^\W\d_]+|\d+")  # runs of letters, runs of digits
+PSEUDONYM_KEPT_WORDS = frozenset({
+    "AB", "AG", "AND", "AS", "BV", "CO", "COMPANY", "CORP", "CORPORATION", "GMBH", "GROUP", "HOLDING",
+    "HOLDINGS", "INC", "INCORPORATED", "INDUSTRIES", "INTERNATIONAL", "KG", "LIMITED", "LLC", "LLP", "LTD",
+    "NV", "OF", "OY", "PLC", "PTY", "SA", "SARL", "SAS", "SPA", "SRL", "THE",
+})
+PSEUDONYMIZED_FIELDS = {
+    "payments": ("payment_id", "invoice_ids", "customer_name", "memo_text"),
+    "open_items": ("invoice_id", "customer_name", "memo_line"),
+}
+
+
+class Pseudonymizer:
+    """
+    Keyed pseudonyms for the runs of letters and digits in a text; words in PSEUDONYM_KEPT_WORDS
+    are kept. mode "similarity" substitutes character by character: a keyed permutation of A-Z (case
+    kept) and one of 0-9, other letters an HMAC-chosen A-Z letter (two of them may coincide).
+    mode "tokens" maps each run to another run of the same length: the run is read as a number in its
+    alphabet and put through a Feistel permutation with HMAC-SHA256 rounds, so no two runs share a
+    pseudonym - a plain truncated HMAC would fold PAY-17 and PAY-803 onto one payment ID. Runs with
+    other letters get a truncated HMAC of the same length.
+    """
+
+    ROUNDS = 4
+    MODES = ("similarity", "tokens")
+
+    def __init__(self, key: bytes, mode: str = "similarity"):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown pseudonym mode {mode!r}, expected one of {self.MODES}")
+        self.key = key
+        self.mode = mode
+        self._letters = self._shuffled(string.ascii_uppercase)
+        self._digits = self._shuffled(string.digits)
+
+    def _shuffled(self, alphabet: str) -> Dict[str, str]:
+        """Keyed permutation of alphabet: each character goes where its HMAC ranks"""
+        ranked = sorted(alphabet, key=lambda c: hmac.new(self.key, b"alphabet|" + c.encode("ascii"), hashlib.sha256).digest())
+        return dict(zip(alphabet, ranked))
+
+    @lru_cache(maxsize=65536)
+    def text(self, value: str) -> str:
+        return _PSEUDONYM_TOKENS.sub(lambda m: self.token(m.group()), value)
+
+    @lru_cache(maxsize=65536)
+    def token(self, token: str) -> str:
+        upper = token.upper()
+        if upper in PSEUDONYM_KEPT_WORDS:
+            return token
+        if self.mode == "similarity":
+            mapped = "".join(self._character(c) for c in upper)
+        elif upper.isascii():
+            alphabet = string.digits if token.isdigit() else string.ascii_uppercase
+            value = 0
+            for c in upper:
+                value = value * len(alphabet) + alphabet.index(c)
+            value = self._permute(value, len(alphabet) ** len(token), f"{alphabet[0]}{len(token)}".encode("ascii"))
+            out = []
+            for _ in token:
+                value, digit = divmod(value, len(alphabet))
+                out.append(alphabet[digit])
+            mapped = "".join(reversed(out))
+        else:
+            alphabet = string.digits if token.isdigit() else string.ascii_uppercase
+            digest = hmac.new(self.key, upper.encode("utf-8"), hashlib.sha256).digest()
+            while len(digest) < len(token):
+                digest += hmac.new(self.key, digest, hashlib.sha256).digest()
+            mapped = "".join(alphabet[b % len(alphabet)] for b in digest[:len(token)])
+        return "".join(m.lower() if c.islower() else m for m, c in zip(mapped, token))
+
+    def _character(self, c: str) -> str:
+        if c in self._letters:
+            return self._letters[c]
+        if c in self._digits:
+            return self._digits[c]
+        alphabet = string.digits if c.isdigit() else string.ascii_uppercase
+        return alphabet[hmac.new(self.key, b"char|" + c.encode("utf-8"), hashlib.sha256).digest()[0] % len(alphabet)]
+
+    def _permute(self, value: int, domain: int, tweak: bytes) -> int:
+        """Keyed permutation of range(domain): Feistel over a square just above it, cycle-walking back into range"""
+        side = math.isqrt(domain - 1) + 1
+        while True:
+            left, right = divmod(value, side)
+            for round_no in range(self.ROUNDS):
+                f = hmac.new(self.key, b"%s|%d|%d" % (tweak, round_no, right), hashlib.sha256).digest()
+                left, right = right, (left + int.from_bytes(f[:16], "big")) % side
+            value = left * side + right
+            if value < domain:
+                return value
+
+    def payload(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        out = dict(payload)
+        for section, fields in PSEUDONYMIZED_FIELDS.items():
+            rows = []
+            for row in payload.get(section, []):
+                row = dict(row)
+                for field in fields:
+                    value = row.get(field)
+                    if isinstance(value, list):
+                        row[field] = [self.text(v) for v in value]
+                    elif isinstance(value, str):
+                        row[field] = self.text(value)
+                rows.append(row)
+            out[section] = rows
+        return out
+
+
+class TrafficCapture:
+    """Samples requests on the request path (serialized bytes only); a daemon thread pseudonymizes and appends them"""
+
+    def __init__(self, path: str, key: bytes, sample: float = TRAFFIC_CAPTURE_SAMPLE,
+                 max_pending_bytes: int = TRAFFIC_CAPTURE_MAX_PENDING_BYTES, pseudonyms: str = TRAFFIC_CAPTURE_PSEUDONYMS):
+        self.path = path
+        self.sample = sample
+        self.max_pending_bytes = max_pending_bytes
+        self.pseudonymizer = Pseudonymizer(key, pseudonyms)
+        self._pending: List[tuple] = []
+        self._pending_bytes = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None  # Started by the first submit, never in batch pool processes
+
+    def submit(self, request: ReconciliationRequest, top_k: int, config_version: str) -> bool:
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return False
+        body = request.model_dump_json().encode("utf-8")
+        with self._lock:
+            if self._stopped or self._pending_bytes + len(body) > self.max_pending_bytes:
+                metrics["traffic_capture_dropped"] += 1
+                return False
+            self._pending.append((time.time(), top_k, config_version, body))
+            self._pending_bytes += len(body)
+            self._start_writer()
+        self._wake.set()
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._stopped = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+
+    def _start_writer(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                batch, self._pending, self._pending_bytes = self._pending, [], 0
+                stopped = self._stopped
+            if batch:
+                try:
+                    lines = [json.dumps({
+                        "captured_at": round(captured_at, 3), "engine_version": ENGINE_VERSION,
+                        "config_version": config_version, "top_k": top_k, "pseudonyms": self.pseudonymizer.mode,
+                        "payload": self.pseudonymizer.payload(json.loads(body)),
+                    }, separators=(",", ":")) + "\n" for captured_at, top_k, config_version, body in batch]
+                    append_gzip_member(self.path, "".join(lines).encode("utf-8"))
+                    metrics["traffic_captured"] += len(batch)
+                except Exception as e:
+                    metrics["traffic_capture_errors"] += 1
+                    print(f"Traffic capture write to {self.path} failed, {len(batch)} requests lost: {e}")
+            if stopped:
+                return
+
+
+if TRAFFIC_CAPTURE_PATH:
+    _capture_key = os.getenv("TRAFFIC_CAPTURE_KEY")
+    traffic_capture = TrafficCapture(TRAFFIC_CAPTURE_PATH, _capture_key.encode("utf-8") if _capture_key else os.urandom(32))
+else:
+    traffic_capture = None
+
+
+@app.on_event("shutdown")
+def close_traffic_capture():
+    if traffic_capture is not None:
+        traffic_capture.close()
+
+
+# === LEDGER SNAPSHOT (memory-mapped open-item book) ===
+# A large open-item book that rarely changes can be stored once as a binary snapshot instead of
+# being sent and validated with every request. Each worker mmaps the file read-only, so all workers
+# share the same page-cache copy; /reconcile?ledger=true then reconciles against it.
+#
+# The engine reads the book straight from the mapped columns (LedgerBook): exact IDs, ID variants and
+# compact IDs are binary searches in prepared sorted tables, amounts and due dates are arrays, and
+# Step 4.5 groups the book by its table of normalized customer names. OpenItem models are built only
+# for the rows a request touches. The only per-worker structures left are the BK-tree over the
+# compact IDs and the Aho-Corasick automaton over the ID variants (memo references), built in the
+# background after a snapshot is loaded.
+#
+# Layout (little-endian): header "<8sHHIQ" = magic, format version, reserved, row count, TOC length,
+# then the TOC as JSON ({"meta": {...}, "columns": {name: [offset, length, dtype]}}), then the
+# 8-byte aligned columns. String columns are stored as "<name>.offsets" (int64, rows + 1) plus
+# "<name>.data" (UTF-8 bytes). A key table is a string column sorted by its UTF-8 bytes plus
+# "<name>.row" (int64; -1 = ambiguous, or for "id_key" an ID whose items are all closed).
+# The tables follow the engine's ID normalization, so a change to it needs a format version bump.
+LEDGER_MAGIC = b"ARLEDGER"
+LEDGER_FORMAT_VERSION = 3
+LEDGER_HEADER = struct.Struct("<8sHHIQ")
+LEDGER_STRING_COLUMNS = ["invoice_id", "customer_name", "due_in_date", "payment_terms", "memo_line", "memo_norm"]
+LEDGER_OPEN, LEDGER_CREDIT, LEDGER_MEMO = 1, 2, 4  # "flags" bits; LEDGER_MEMO: memo_line is not blank
+LEDGER_SNAPSHOT_PATH = os.getenv("LEDGER_SNAPSHOT_PATH")
+MAX_LEDGER_ITEMS = int(os.getenv("MAX_LEDGER_ITEMS", "200000"))
+
+
+class LedgerSnapshotRequest(BaseModel):
+    open_items: List[OpenItem]
+
+
+def _align8(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def _string_column(columns: Dict[str, np.ndarray], name: str, values: List[str]) -> None:
+    encoded = [value.encode("utf-8") for value in values]
+    columns[f"{name}.offsets"] = np.concatenate([[0], np.cumsum([len(b) for b in encoded], dtype="<i8")]).astype("<i8")
+    columns[f"{name}.data"] = np.frombuffer(b"".join(encoded), dtype="u1")
+
+
+def _key_table(columns: Dict[str, np.ndarray], name: str, rows: Dict[str, int]) -> None:
+    keys = sorted(rows, key=lambda key: key.encode("utf-8"))
+    _string_column(columns, name, keys)
+    columns[f"{name}.row"] = np.array([rows[key] for key in keys], dtype="<i8")
+
+
+def write_ledger_snapshot(open_items: List[OpenItem], path: str) -> str:
+    """Write a snapshot atomically (readers keep their old mapping until they reload); returns its digest"""
+    names: Dict[str, int] = {}
+    name_key = [names.setdefault(inv.customer_name.strip().upper(), len(names)) if inv.customer_name.strip() else -1
+                for inv in open_items]
+    columns: Dict[str, np.ndarray] = {
+        "amount": np.array([inv.total_open_amount for inv in open_items], dtype="<f8"),
+        "cents": np.array([to_cents(inv.total_open_amount) for inv in open_items], dtype="<i8"),
+        "due_ordinal": np.array([_date_ordinal(inv.due_in_date) for inv in open_items], dtype="<f8"),
+        "flags": np.array([(LEDGER_OPEN if inv.isOpen else 0) | (LEDGER_CREDIT if inv.is_credit else 0)
+                           | (LEDGER_MEMO if inv.memo_line.strip() else 0) for inv in open_items], dtype="u1"),
+        "name_key": np.array(name_key, dtype="<i4"),
+    }
+    for name in LEDGER_STRING_COLUMNS:
+        values = [_normalize_text(inv.memo_line) for inv in open_items] if name == "memo_norm" else \
+            [getattr(inv, name) for inv in open_items]
+        _string_column(columns, name, values)
+    _string_column(columns, "name_norm", list(names))
+
+    # ID tables with the semantics of the engine's {invoice_id: item} map over the open items
+    id_rows: Dict[str, int] = {}
+    for row, inv in enumerate(open_items):
+        if inv.isOpen:
+            id_rows[inv.invoice_id] = row  # The last open item with an ID wins
+        else:
+            id_rows.setdefault(inv.invoice_id, -1)
+    open_ids = list(dict.fromkeys(inv.invoice_id for inv in open_items if inv.isOpen))
+    index = InvoiceIdIndex(open_ids)
+    _key_table(columns, "id_key", id_rows)
+    # Amounts are looked up by ID, so an open item that shares its ID with a later one carries the later one's
+    columns["id_row"] = np.array([id_rows[inv.invoice_id] for inv in open_items], dtype="<i8")
+    _key_table(columns, "id_variant", {v: id_rows[iid] if iid is not None else -1 for v, iid in index._variants.items()})
+    _key_table(columns, "id_compact", {c: id_rows[iid] if iid is not None else -1 for c, iid in index._compact.items()})
+
+    digest = hashlib.sha256()
+    for name, array in columns.items():
+        digest.update(name.encode("utf-8"))
+        digest.update(array.tobytes())
+    open_rows = [inv for inv in open_items if inv.isOpen]
+    meta = {"engine_version": ENGINE_VERSION, "created_at": time.time(), "digest": digest.hexdigest(),
+            "open_rows": len(open_rows), "unique_names": len({inv.customer_name.upper() for inv in open_rows}),
+            "unique_memos": len({inv.memo_line.upper() for inv in open_rows})}
+
+    # Column offsets depend on the TOC length, which depends on the offsets: lay out until stable
+    toc_len = 0
+    while True:
+        offset = _align8(LEDGER_HEADER.size + toc_len)
+        layout = {}
+        for name, array in columns.items():
+            layout[name] = [offset, array.nbytes, array.dtype.str]
+            offset = _align8(offset + array.nbytes)
+        toc = json.dumps({"meta": meta, "columns": layout}, separators=(",", ":")).encode("utf-8")
+        if len(toc) == toc_len:
+            break
+        toc_len = len(toc)
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(LEDGER_HEADER.pack(LEDGER_MAGIC, LEDGER_FORMAT_VERSION, 0, len(open_items), len(toc)))
+        f.write(toc)
+        for name, array in columns.items():
+            f.seek(layout[name][0])
+            f.write(array.tobytes())
+        f.truncate(offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return meta["digest"]
+
+
+class LedgerSnapshot:
+    """Read-only view of a snapshot file; columns are numpy arrays over the mapping, nothing is copied"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.rows, toc_len = LEDGER_HEADER.unpack_from(self._mm, 0)
+        if magic != LEDGER_MAGIC:
+            raise ValueError(f"{path} is not a ledger snapshot")
+        if version != LEDGER_FORMAT_VERSION:
+            raise ValueError(f"{path} has snapshot format {version}, this engine reads {LEDGER_FORMAT_VERSION}")
+        toc = json.loads(self._mm[LEDGER_HEADER.size:LEDGER_HEADER.size + toc_len])
+        self.meta = toc["meta"]
+        self._offsets = {name: offset for name, (offset, _, _) in toc["columns"].items()}
+        self.columns = {
+            name: np.frombuffer(self._mm, dtype=np.dtype(dtype), count=length // np.dtype(dtype).itemsize, offset=offset)
+            for name, (offset, length, dtype) in toc["columns"].items()
+        }
+        self._id_index = None
+        self._memo_matcher = None
+        self._memo_matcher_built = False
+        self._lock = threading.Lock()
+
+    @property
+    def digest(self) -> str:
+        return self.meta["digest"]
+
+    def _bytes(self, column: str, i: int) -> bytes:
+        offsets, base = self.columns[f"{column}.offsets"], self._offsets[f"{column}.data"]
+        return self._mm[base + int(offsets[i]):base + int(offsets[i + 1])]
+
+    def string(self, column: str, row: int) -> str:
+        return self._bytes(column, row).decode("utf-8")
+
+    def strings(self, column: str, rows: Optional[np.ndarray] = None) -> List[str]:
+        """A string column decoded for rows (default: all of them)"""
+        offsets = self.columns[f"{column}.offsets"]
+        data = self.columns[f"{column}.data"].tobytes()
+        if rows is None:
+            bounds = offsets.tolist()
+            return [data[bounds[i]:bounds[i + 1]].decode("utf-8") for i in range(len(bounds) - 1)]
+        return [data[start:end].decode("utf-8") for start, end in zip(offsets[rows].tolist(), offsets[rows + 1].tolist())]
+
+    def lookup(self, table: str, key: str) -> Optional[int]:
+        """Row stored for key in a key table (may be -1), None when the key is not in it"""
+        target = key.encode("utf-8")
+        lo, hi = 0, len(self.columns[f"{table}.row"])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(table, mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.columns[f"{table}.row"]) and self._bytes(table, lo) == target:
+            return int(self.columns[f"{table}.row"][lo])
+        return None
+
+    def items_at(self, rows: List[int]) -> List[OpenItem]:
+        rows = np.asarray(rows, dtype=np.int64)
+        strings = {name: self.strings(name, rows) for name in ("invoice_id", "customer_name", "due_in_date",
+                                                                 "payment_terms", "memo_line")}
+        amount, flags = self.columns["amount"][rows].tolist(), self.columns["flags"][rows].tolist()
+        return [
+            OpenItem(
+                invoice_id=strings["invoice_id"][n], customer_name=strings["customer_name"][n],
+                total_open_amount=amount[n], due_in_date=strings["due_in_date"][n],
+                isOpen=bool(flags[n] & LEDGER_OPEN), payment_terms=strings["payment_terms"][n],
+                memo_line=strings["memo_line"][n], is_credit=bool(flags[n] & LEDGER_CREDIT)
+            )
+            for n in range(len(rows))
+        ]
+
+    def open_rows(self, flag: int = 0) -> np.ndarray:
+        mask = LEDGER_OPEN | flag
+        return np.flatnonzero((self.columns["flags"] & mask) == mask)
+
+    def due_ordinal(self, invoice_id: str) -> float:
+        """_date_ordinal of the due date of the open item with this ID (NaN when there is none)"""
+        row = self.lookup("id_key", invoice_id)
+        return float(self.columns["due_ordinal"][row]) if row is not None and row >= 0 else np.nan
+
+    def id_index(self) -> "LedgerIdIndex":
+        with self._lock:
+            if self._id_index is None:
+                self._id_index = LedgerIdIndex(self)
+        return self._id_index
+
+    def memo_matcher(self) -> Optional[AhoCorasick]:
+        """Memo reference scanner over the open invoices, built once per worker when first needed"""
+        with self._lock:
+            if not self._memo_matcher_built:
+                self._memo_matcher = build_memo_reference_matcher(
+                    list(dict.fromkeys(self.strings("invoice_id", self.open_rows()))))
+                self._memo_matcher_built = True
+        return self._memo_matcher
+
+    def warm(self) -> None:
+        """Build the per-worker structures in the background so requests never wait for them"""
+        self.id_index().tree()
+        self.memo_matcher()
+
+    def info(self) -> Dict[str, Any]:
+        return {"path": self.path, "rows": self.rows, "format_version": LEDGER_FORMAT_VERSION, **self.meta}
+
+
+class _LedgerKeys(Mapping):
+    """A key table as InvoiceIdIndex's {key: invoice_id or None} map"""
+
+    def __init__(self, snapshot: LedgerSnapshot, table: str):
+        self._snapshot = snapshot
+        self._table = table
+
+    def __getitem__(self, key: str) -> Optional[str]:
+        row = self._snapshot.lookup(self._table, key)
+        if row is None:
+            raise KeyError(key)
+        return self._snapshot.string("invoice_id", row) if row >= 0 else None
+
+    def __iter__(self):
+        return iter(self._snapshot.strings(self._table))
+
+    def __len__(self) -> int:
+        return len(self._snapshot.columns[f"{self._table}.row"])
+
+
+class LedgerIdIndex(InvoiceIdIndex):
+    """InvoiceIdIndex over a snapshot's prepared ID tables; only the BK-tree is built in memory"""
+
+    def __init__(self, snapshot: LedgerSnapshot):
+        self._snapshot = snapshot
+        self._variants = _LedgerKeys(snapshot, "id_variant")
+        self._compact = _LedgerKeys(snapshot, "id_compact")
+        self._bk_tree: Optional[BKTree] = None
+        self._lock = threading.Lock()
+
+    def tree(self) -> BKTree:
+        with self._lock:
+            if self._bk_tree is None:
+                tree = BKTree()
+                rows = self._snapshot.columns["id_compact.row"]
+                for compact, row in zip(self._snapshot.strings("id_compact"), rows.tolist()):
+                    if row >= 0:
+                        tree.add(compact)
+                self._bk_tree = tree
+        return self._bk_tree
+
+    @property
+    def _tree(self) -> BKTree:
+        return self.tree()
+
+
+class _LedgerCents(Mapping):
+    """invoice_id -> cents (signed: negative for credits) of a LedgerBook's open items"""
+
+    def __init__(self, book: "LedgerBook", signed: bool):
+        self._book = book
+        self._signed = signed
+
+    def __getitem__(self, invoice_id: str) -> int:
+        row = self._book.row(invoice_id)
+        if row is None:
+            raise KeyError(invoice_id)
+        cents = int(self._book.snapshot.columns["cents"][row])
+        return -cents if self._signed and self._book.snapshot.columns["flags"][row] & LEDGER_CREDIT else cents
+
+    def __iter__(self):
+        return iter(self._book)
+
+    def __len__(self) -> int:
+        return len(self._book)
+
+
+class LedgerBook(Mapping):
+    """
+    One run's view of a snapshot as the engine's invoice map: invoice_id -> OpenItem of the (last)
+    open item with that ID. Rows are found through the prepared ID table and models are built only
+    for the items the run looks at; cents/signed_cents read the amount column the same way.
+    """
+
+    def __init__(self, snapshot: LedgerSnapshot):
+        self.snapshot = snapshot
+        self.cents = _LedgerCents(self, signed=False)
+        self.signed_cents = _LedgerCents(self, signed=True)
+        self._rows: Dict[str, Optional[int]] = {}
+        self._items: Dict[int, OpenItem] = {}
+
+    def row(self, invoice_id: str) -> Optional[int]:
+        if invoice_id not in self._rows:
+            row = self.snapshot.lookup("id_key", invoice_id)
+            self._rows[invoice_id] = row if row is not None and row >= 0 else None
+        return self._rows[invoice_id]
+
+    def known(self, invoice_id: str) -> bool:
+        """Any item has this ID, open or closed"""
+        return self.row(invoice_id) is not None or self.snapshot.lookup("id_key", invoice_id) is not None
+
+    def items_at(self, rows) -> List[OpenItem]:
+        missing = [row for row in rows if row not in self._items]
+        if missing:
+            self._items.update(zip(missing, self.snapshot.items_at(missing)))
+        return [self._items[row] for row in rows]
+
+    def __getitem__(self, invoice_id: str) -> OpenItem:
+        row = self.row(invoice_id)
+        if row is None:
+            raise KeyError(invoice_id)
+        return self.items_at([row])[0]
+
+    def __contains__(self, invoice_id) -> bool:
+        return self.row(invoice_id) is not None
+
+    def __iter__(self):
+        rows = self.snapshot.columns["id_key.row"]
+        return iter([key for key, row in zip(self.snapshot.strings("id_key"), rows.tolist()) if row >= 0])
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.snapshot.columns["id_key.row"] >= 0))
+
+    def open_rows(self, flag: int = 0, exclude: Optional[set] = None) -> np.ndarray:
+        """Rows of the open items (with flag set), minus those whose ID is in exclude"""
+        rows = self.snapshot.open_rows(flag)
+        if exclude:
+            keep = [iid not in exclude for iid in self.snapshot.strings("invoice_id", rows)]
+            rows = rows[np.array(keep, dtype=bool)]
+        return rows
+
+    def customer_invoices(self, group_names: List[str], used: set, threshold: float) -> List[List[OpenItem]]:
+        """
+        Step 4.5's invoice grouping for the customer groups that have payments: every unused open item
+        with a name joins the first group its name scores at least threshold against. Items no group
+        takes would only form groups without payments, which match nothing, so they are never built.
+        """
+        groups: List[List[OpenItem]] = [[] for _ in group_names]
+        names = self.snapshot.strings("name_norm")
+        if not group_names or not names:
+            return groups
+        matrix, name_idx, group_idx = _similarity_tiers(names, group_names, NAME_TIERS)
+        hit = matrix[name_idx][:, group_idx] >= threshold
+        first = np.where(hit.any(axis=1), hit.argmax(axis=1), -1)
+        rows = self.snapshot.open_rows()
+        keys = self.snapshot.columns["name_key"][rows]
+        rows = rows[keys >= 0]
+        target = first[keys[keys >= 0]]
+        rows, target = rows[target >= 0], target[target >= 0]
+        for inv, group in zip(self.items_at(rows.tolist()), target.tolist()):
+            if inv.invoice_id not in used:
+                groups[group].append(inv)
+        return groups
+
+    def candidate_pool(self, exclude: set) -> CandidatePool:
+        """Step 5's pool: the open items whose ID is not in exclude, straight from the columns"""
+        snap = self.snapshot
+        rows = self.open_rows(exclude=exclude)
+        names = snap.strings("name_norm")
+        return CandidatePool(
+            names=[names[key] if key >= 0 else "" for key in snap.columns["name_key"][rows].tolist()],
+            memos=snap.strings("memo_line", rows),
+            terms=snap.strings("payment_terms", rows),
+            cents=snap.columns["cents"][snap.columns["id_row"][rows]],
+            due_days=snap.columns["due_ordinal"][rows],
+            describe=lambda j: (snap.string("invoice_id", int(rows[j])), snap.string("customer_name", int(rows[j])),
+                                snap.string("due_in_date", int(rows[j])))
+        )
+
+    def leftover_count(self, used: set) -> int:
+        """Open items whose ID the run did not use"""
+        return len(self.open_rows(exclude=used))
+
+
+_ledger: Optional[LedgerSnapshot] = None
+_rejected_ledger_file: Optional[tuple] = None  # file_id of a snapshot that could not be read
+
+
+def current_ledger() -> Optional[LedgerSnapshot]:
+    """The loaded snapshot, reloaded when another worker has replaced the file"""
+    global _ledger, _rejected_ledger_file
+    if not LEDGER_SNAPSHOT_PATH:
+        return None
+    try:
+        stat = os.stat(LEDGER_SNAPSHOT_PATH)
+    except FileNotFoundError:
+        _ledger = None
+        return None
+    file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if _ledger is None or _ledger.file_id != file_id:
+        if file_id == _rejected_ledger_file:
+            return None
+        try:
+            _ledger = LedgerSnapshot(LEDGER_SNAPSHOT_PATH)
+        except ValueError as e:
+            # e.g. a snapshot in an older format after an upgrade: serve without one until it is rewritten
+            print(f"Ledger snapshot {LEDGER_SNAPSHOT_PATH} not loaded: {e}")
+            _ledger, _rejected_ledger_file = None, file_id
+            return None
+        threading.Thread(target=_ledger.warm, daemon=True).start()
+    return _ledger
+
+
+@app.on_event("startup")
+def load_ledger_snapshot():
+    # Mapping is instant; the BK-tree and memo scanner are built by a background thread
+    current_ledger()
+
+
+@app.post("/ledger/snapshot", dependencies=[Depends(get_api_key)])
+async def create_ledger_snapshot(body: LedgerSnapshotRequest):
+    """Store the open-item book as the worker-shared snapshot used by /reconcile?ledger=true"""
+    if not LEDGER_SNAPSHOT_PATH:
+        raise HTTPException(409, "LEDGER_SNAPSHOT_PATH is not configured")
+    if len(body.open_items) > MAX_LEDGER_ITEMS:
+        raise HTTPException(400, f"Max {MAX_LEDGER_ITEMS} open items in a ledger snapshot")
+    # A book whose smallest ledger=true request can't fit this worker's budget would only ever get 413s
+    memory_budget.check(MEMORY_LEDGER_ROW_BYTES * len(body.open_items))
+    async with memory_budget.hold(MEMORY_LEDGER_WRITE_BYTES * len(body.open_items)):
+        await run_in_threadpool(write_ledger_snapshot, body.open_items, LEDGER_SNAPSHOT_PATH)
+    ledger = current_ledger()
+    if ledger is None:
+        raise HTTPException(500, f"Ledger snapshot was written to {LEDGER_SNAPSHOT_PATH} but could not be loaded")
+    return ledger.info()
+
+
+@app.get("/ledger", dependencies=[Depends(get_api_key)])
+async def get_ledger():
+    ledger = current_ledger()
+    if ledger is None:
+        raise HTTPException(404, "No ledger snapshot loaded")
+    return ledger.info()
+
+
+@app.get("/scoring", dependencies=[Depends(get_api_key)])
+async def get_scoring():
+    """The scoring plan new requests are scored with"""
+    plan = scoring_plan()
+    return {"fingerprint": plan.fingerprint, "source": SCORING_CONFIG_PATH or "defaults", **plan.config.model_dump()}
+
+
 # === NOW YOUR EXISTING @app.post("/reconcile") CONTINUES ===
 
-@app.post("/reconcile", response_model=ReconciliationResponse, dependencies=[Depends(get_api_key)])
-async def reconcile(request: ReconciliationRequest):
-    if len(request.payments) > 1000 or len(request.open_items) > 1000:
-        raise HTTPException(400, "Max 1000 payments and 1000 open items")
+def reconciliation_json(result: ReconciliationResponse, cache_status: str) -> Response:
+    """
+    The response body straight from pydantic's serializer. Returning the model would have FastAPI
+    re-validate and re-encode it (several times the cost), and the decision log reuses these bytes.
+    """
+    return Response(content=result.json_bytes(), media_type="application/json", headers={"X-Cache": cache_status})
+
+
+@app.post("/reconcile", response_model=ReconciliationResponse)
+async def reconcile(
+    request: ReconciliationRequest,
+    quota: KeyQuota = Depends(admit_request),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    top_k: int = Query(0, ge=0, le=MAX_TOP_K, description="Suggest the k best candidate invoices for each HITL / unmatched payment"),
+    deadline_ms: Optional[int] = Header(None, alias="X-Deadline-Ms", ge=1),
+    ledger: bool = Query(False, description="Match against the stored ledger snapshot instead of open_items")
+):
+    deadline = time.monotonic() + deadline_ms / 1000.0 if deadline_ms else None
+
+    plan = scoring_plan()
+    profiles = payment_profiles.snapshot() if payment_profiles is not None else None
+    snapshot = None
+    if ledger:
+        snapshot = current_ledger()
+        if snapshot is None:
+            raise HTTPException(409, "No ledger snapshot loaded; POST /ledger/snapshot first")
+        if request.open_items:
+            raise HTTPException(400, "Send either open_items or ledger=true, not both")
+    key = request_hash(request, *cache_options(plan, profiles, top_k, snapshot))
+    check_request_limits(request)
+    estimate = estimate_request_bytes(request, top_k, snapshot)
+
+    # An Idempotency-Key pins one payload; reusing it for a different payload is a client bug.
+    # Only the payload is pinned: a retry after a config reload or profile refresh is the same request.
+    if idempotency_key:
+        payload = payload_hash(request)
+        if await idempotency_pins.apin(f"{quota.name}:{idempotency_key}", payload) != payload:
+            raise HTTPException(422, "Idempotency-Key was already used with a different request payload")
+
+    cached = await result_cache.aget(key)
+    if cached is not None:
+        metrics["cache_hit"] += 1
+        return reconciliation_json(cached, "HIT")
+
+    # A request with its own time budget can't wait on someone else's computation (nor make
+    # others wait on a possibly partial one), so it neither joins nor leads a coalesced run
+    if deadline is not None:
+        async with memory_budget.hold(estimate):
+            result = await run_in_threadpool(run_reconciliation, request, top_k, deadline, snapshot, plan, profiles)
+        if not result.partial:
+            await result_cache.aput(key, result)
+        if decision_log is not None:
+            decision_log.submit(key, result)
+        if payment_profiles is not None:
+            payment_profiles.learn(request, result, snapshot)
+        if traffic_capture is not None and snapshot is None:  # A replay could not reproduce the stored book
+            traffic_capture.submit(request, top_k, result.config_version)
+        metrics["cache_miss"] += 1
+        return reconciliation_json(result, "MISS")
+
+    # Coalesce concurrent identical requests into a single computation
+    pending = _inflight.get(key)
+    if pending is not None:
+        metrics["cache_coalesced"] += 1
+        return reconciliation_json(await asyncio.shield(pending), "COALESCED")
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        async with memory_budget.hold(estimate):
+            result = await run_in_threadpool(run_reconciliation, request, top_k, None, snapshot, plan, profiles)
+    except BaseException as e:
+        # Waiters must never be left hanging; a cancelled leader hands them a 503 to retry on
+        if not isinstance(e, Exception):
+            e = HTTPException(503, "The identical request this one was waiting on was cancelled - retry",
+                              headers={"Retry-After": "1"})
+        future.set_exception(e)
+        # Mark the exception as retrieved when nobody else was waiting on it
+        future.exception()
+        raise
+    else:
+        future.set_result(result)
+    finally:
+        _inflight.pop(key, None)
+
+    await result_cache.aput(key, result)
+    if decision_log is not None:
+        decision_log.submit(key, result)
+    if payment_profiles is not None:
+        payment_profiles.learn(request, result, snapshot)
+    if traffic_capture is not None and snapshot is None:
+        traffic_capture.submit(request, top_k, result.config_version)
+    metrics["cache_miss"] += 1
+    return reconciliation_json(result, "MISS")
+
+
+def run_reconciliation(request: ReconciliationRequest, top_k: int = 0, deadline: Optional[float] = None,
+                       ledger: Optional[LedgerSnapshot] = None, plan: Optional[ScoringPlan] = None,
+                       profiles: Optional[PaymentProfiles] = None, probe=None) -> ReconciliationResponse:
+    """
+    Run the matching engine (Steps 1 -> 5) on a validated request.
+    deadline is a time.monotonic() value; once it passes, the remaining stages are skipped and
+    the payments they would have handled are returned as unprocessed.
+    ledger is a snapshot to match against instead of request.open_items: the book is read from its
+    columns (LedgerBook), and its unmatched invoices are counted in the summary, not listed in no_match.
+    plan holds the stage weights and cut-offs (default: the current scoring_plan()).
+    profiles are the customers' usual payment lags; Step 4.5 scores the likely invoices first.
+    probe gets enter(stage) at every stage boundary and finish(request, top_k) at the end
+    (default: StageMemory; replay_traffic.py passes a timer).
+    """
+    plan = plan or scoring_plan()
+    t = plan.thresholds
+    if probe is None:
+        probe = StageMemory(ledger)
+    skipped_stages: List[str] = []
+
+    def out_of_time(stage: str) -> bool:
+        if skipped_stages or (deadline is not None and time.monotonic() >= deadline):
+            if stage not in skipped_stages:
+                skipped_stages.append(stage)
+            return True
+        return False
 
-    inv_map = {inv.invoice_id: inv for inv in request.open_items if inv.isOpen}
     pay_map = {pay.payment_id: pay for pay in request.payments}
+
+    # Integer cents, converted once at ingest; floats only come back when a MatchGroup is built
+    pay_cents = {pay.payment_id: to_cents(pay.amount) for pay in request.payments}
+    signed_pay = {pid: -c if pay_map[pid].is_negative_payment else c for pid, c in pay_cents.items()}
+    book = LedgerBook(ledger) if ledger is not None else None
+    if book is not None:
+        inv_map, inv_cents, signed_inv = book, book.cents, book.signed_cents
+    else:
+        inv_map = {inv.invoice_id: inv for inv in request.open_items if inv.isOpen}
+        inv_cents = {iid: to_cents(inv.total_open_amount) for iid, inv in inv_map.items()}
+        signed_inv = {iid: -c if inv_map[iid].is_credit else c for iid, c in inv_cents.items()}
+
+    # === STEP 0: INVOICE REFERENCES ===
+    # Explicit invoice_ids first; IDs that are not exact keys are resolved through a variant map
+    # and a BK-tree (typos), and payments without any get the IDs named in their memo_text,
+    # so they can go through the explicit-ID steps instead of the fuzzy stage.
+    # A remittance that lists the same invoice twice still pays it once
+    refs: Dict[str, List[str]] = {pay.payment_id: list(dict.fromkeys(pay.invoice_ids)) for pay in request.payments}
+    ref_notes: Dict[str, List[str]] = defaultdict(list)
+    fuzzy_refs: Dict[str, set] = defaultdict(set)  # payment_id -> typo-resolved invoice IDs
+
+    id_index = None
+    for pay in request.payments:
+        if all(iid in inv_map for iid in pay.invoice_ids):
+            continue
+        if id_index is None:
+            if book is not None:
+                id_index, known = ledger.id_index(), book.known
+            else:
+                id_index, known = InvoiceIdIndex(list(inv_map)), {inv.invoice_id for inv in request.open_items}.__contains__
+        resolved_ids = []
+        for iid in refs[pay.payment_id]:
+            # An exact ID of a closed item is a reference to that item, not a typo of an open one
+            resolved = None if iid in inv_map or known(iid) else id_index.resolve(iid)
+            if resolved is not None and resolved[1] == "fuzzy":
+                inv_c = inv_cents[resolved[0]]
+                discount = 0
+                if TERMS_DISCOUNT_MATCHING and len(refs[pay.payment_id]) == 1:
+                    discount = early_payment_discount(pay, inv_map[resolved[0]], inv_c)
+                if not plausible_resolution(pay_cents[pay.payment_id], inv_c, len(refs[pay.payment_id]) == 1, discount):
+                    resolved = None
+            if resolved is None:
+                resolved_ids.append(iid)
+                continue
+            if resolved[0] in pay.invoice_ids or resolved[0] in resolved_ids:
+                continue  # Resolves to an invoice the payment already names; don't match it twice
+            resolved_ids.append(resolved[0])
+            if resolved[1] == "fuzzy":
+                fuzzy_refs[pay.payment_id].add(resolved[0])
+                ref_notes[pay.payment_id].append(f"'{iid}' resolved to {resolved[0]} by edit distance - review required")
+            else:
+                ref_notes[pay.payment_id].append(f"'{iid}' resolved to {resolved[0]}")
+        refs[pay.payment_id] = resolved_ids
+
+    memo_only = [pay for pay in request.payments if not pay.invoice_ids and pay.memo_text.strip()]
+    matcher = None
+    if memo_only:
+        matcher = ledger.memo_matcher() if ledger is not None else build_memo_reference_matcher(list(inv_map))
+    if matcher is not None:
+        for pay in memo_only:
+            inferred = extract_memo_references(matcher, pay.memo_text)
+            if inferred:
+                refs[pay.payment_id] = inferred
+                ref_notes[pay.payment_id].append("invoice ID inferred from memo")
+
     used_invoices = set()
     used_payments = set()
 
     high_conf = []
     hitl = []
     no_match = []
+    duplicates = []
+
+    # === STEP 0.5: DUPLICATE PAYMENTS ===
+    # Repeats of an earlier payment (same payer, amount, date and memo under another payment_id)
+    # are reported on their own and never reach the matching stages
+    if DUPLICATE_DETECTION:
+        for dup_id, original_id in find_duplicate_payments(request.payments).items():
+            pay = pay_map[dup_id]
+            duplicates.append(MatchGroup(
+                payment_ids=[dup_id],
+                invoice_ids=[],
+                total_payment_amount=from_cents(pay_cents[dup_id]),
+                total_invoice_amount=0.0,
+                net_amount_diff=from_cents(pay_cents[dup_id]),
+                avg_score=0.0,
+                id_scores=[], amount_scores=[], name_scores=[], date_scores=[],
+                memo_scores=[], terms_scores=[],
+                confidence="duplicate",
+                reason=f"Likely duplicate of {original_id}",
+                stage="duplicate",
+                is_negative_payment=pay.is_negative_payment,
+                payment_memo_text=pay.memo_text
+            ))
+            used_payments.add(dup_id)
 
     # === STEP 1: 1:1 MATCHING (One payment → one invoice) ===
+    if probe: probe.enter("1:1")
     for pay in request.payments:
+        if out_of_time("1:1"): break
         if pay.payment_id in used_payments: continue
-        if len(pay.invoice_ids) != 1: continue  # Only 1:1
+        if len(refs[pay.payment_id]) != 1: continue  # Only 1:1
 
-        iid = pay.invoice_ids[0]
+        iid = refs[pay.payment_id][0]
         if iid not in inv_map or iid in used_invoices: continue
         inv = inv_map[iid]
 
-        net_diff = abs(pay.amount - inv.total_open_amount)
-        amount_score_net = 100.0 if net_diff <= 1.0 else 95.0 if net_diff <= 5.0 else 60.0
+        net_diff = abs(pay_cents[pay.payment_id] - inv_cents[iid])
+        discount = 0
+        if TERMS_DISCOUNT_MATCHING and net_diff > AMOUNT_EXACT_CENTS:
+            net_diff, discount = discounted_net_diff(pay_cents[pay.payment_id], inv_cents[iid],
+                                                     early_payment_discount(pay, inv, inv_cents[iid]))
+        amount_score_net = amount_score_cents(net_diff)
 
         name_s = name_score(pay.customer_name, inv.customer_name)
         date_s = date_score(pay.payment_date, inv.due_in_date, pay.value_date)
         memo_s = memo_line_score(pay.memo_text, inv.memo_line)
         terms_s = payment_terms_score(pay.payment_terms_hint, inv.payment_terms)
 
-        final_score = min(100.0,
-            0.50 * 100.0 +
-            0.40 * amount_score_net +
-            0.05 * name_s +
-            0.025 * date_s +
-            0.015 * memo_s +
-            0.01 * terms_s
-        )
+        final_score = plan.combine("explicit", id=100.0, amount=amount_score_net, name=name_s, date=date_s,
+                                   memo=memo_s, terms=terms_s)
 
-        if final_score >= 90 and net_diff <= 1.0:
+        if final_score >= t.high and net_diff <= AMOUNT_EXACT_CENTS:
             group = MatchGroup(
                 payment_ids=[pay.payment_id],
                 invoice_ids=[iid],
-                total_payment_amount=pay.amount,
-                total_invoice_amount=inv.total_open_amount,
-                net_amount_diff=net_diff,
+                total_payment_amount=from_cents(pay_cents[pay.payment_id]),
+                total_invoice_amount=from_cents(inv_cents[iid]),
+                net_amount_diff=from_cents(net_diff),
                 avg_score=round(final_score, 2),
                 id_scores=[100.0],
                 amount_scores=[amount_score_net],
@@ -396,19 +3209,21 @@ async def reconcile(request: ReconciliationRequest):
                 memo_scores=[memo_s],
                 terms_scores=[terms_s],
                 confidence="high",
-                reason="1:1 perfect match",
+                reason="1:1 perfect match" + (" with early-payment discount" if discount else ""),
+                stage="1:1",
                 is_negative_payment=pay.is_negative_payment,
                 payment_memo_text=pay.memo_text,
                 invoice_payment_terms=[inv.payment_terms],
                 invoice_memo_lines=[inv.memo_line],
-                invoice_credit_flags=[inv.is_credit]
+                invoice_credit_flags=[inv.is_credit],
+                discount_applied=from_cents(discount)
             )
 
             # Check for egregious name mismatch only if both names exist
             if pay.customer_name.strip() and inv.customer_name.strip():
-                if name_s < 85:  # CHANGED from 40 to 85
+                if name_s < t.name_review:
                     group.confidence = "hitl"
-                    if name_s < 40:
+                    if name_s < t.name_mismatch:
                         group.reason = "1:1 match but customer name mismatch - review required"
                     else:
                         group.reason = f"1:1 match but name similarity only {name_s}% - review required"
@@ -421,24 +3236,139 @@ async def reconcile(request: ReconciliationRequest):
             used_invoices.add(iid)
             used_payments.add(pay.payment_id)
 
+    # === STEP 1.5: N:M (Payments referencing overlapping invoice sets) ===
+    if probe: probe.enter("N:M")
+    # Payments that share invoice references form connected components. Pure N:1 and 1:N components
+    # are left to steps 2 and 3; components with several payments AND several invoices are solved
+    # here as one net-amount match so the greedy order of steps 2/3 can't strand the leftovers.
+    ref_edges = [
+        (pay.payment_id, iid)
+        for pay in request.payments if pay.payment_id not in used_payments
+        for iid in dict.fromkeys(refs[pay.payment_id])
+        if iid in inv_map and iid not in used_invoices
+    ]
+    for comp_pay_ids, comp_inv_ids in connected_components(ref_edges):
+        if out_of_time("N:M"): break
+        if len(comp_pay_ids) < 2 or len(comp_inv_ids) < 2:
+            continue
+
+        comp_pays = [pay_map[pid] for pid in comp_pay_ids]
+        comp_invs = [inv_map[iid] for iid in comp_inv_ids]
+        inv_index = {iid: j for j, iid in enumerate(comp_inv_ids)}
+        solution = solve_nm_component(
+            [signed_pay[pid] for pid in comp_pay_ids],
+            [signed_inv[iid] for iid in comp_inv_ids],
+            [{inv_index[iid] for iid in refs[pay.payment_id] if iid in inv_index} for pay in comp_pays]
+        )
+        if solution is None:
+            continue  # No balanced subset - steps 2/3 and the fuzzy stage get these as before
+
+        pays = [comp_pays[i] for i in solution[0]]
+        invs = [comp_invs[j] for j in solution[1]]
+        net_pay = sum(signed_pay[pay.payment_id] for pay in pays)
+        net_open = sum(signed_inv[inv.invoice_id] for inv in invs)
+        net_diff = abs(net_pay - net_open)
+        amount_score_net = amount_score_cents(net_diff)
+        # The balanced subset may collapse to one payment or one invoice
+        shape = f"{'N' if len(pays) > 1 else '1'}:{('M' if len(pays) > 1 else 'N') if len(invs) > 1 else '1'}"
+
+        # One set of soft scores per referenced (payment, invoice) pair
+        selected_inv_ids = {inv.invoice_id for inv in invs}
+        edges = [(pay, inv_map[iid]) for pay in pays for iid in dict.fromkeys(refs[pay.payment_id]) if iid in selected_inv_ids]
+        soft_scores = []
+        for pay, inv in edges:
+            soft_scores.append({
+                "name": name_score(pay.customer_name, inv.customer_name),
+                "date": date_score(pay.payment_date, inv.due_in_date, pay.value_date),
+                "memo": memo_line_score(pay.memo_text, inv.memo_line),
+                "terms": payment_terms_score(pay.payment_terms_hint, inv.payment_terms)
+            })
+
+        force_hitl = False
+        force_hitl_reason = ""
+        for (pay, inv), scores in zip(edges, soft_scores):
+            if pay.customer_name.strip() and inv.customer_name.strip():
+                if scores["name"] < t.name_review:
+                    force_hitl = True
+                    force_hitl_reason = f"{shape} match (overlapping references) but {pay.payment_id} -> {inv.invoice_id} has {scores['name']:.0f}% name similarity - review required"
+                    break
+
+        avg_name = sum(s["name"] for s in soft_scores) / len(soft_scores)
+        avg_date = sum(s["date"] for s in soft_scores) / len(soft_scores)
+        avg_memo = sum(s["memo"] for s in soft_scores) / len(soft_scores)
+        avg_terms = sum(s["terms"] for s in soft_scores) / len(soft_scores)
+
+        final_score = plan.combine("explicit", id=100.0, amount=amount_score_net, name=avg_name, date=avg_date,
+                                   memo=avg_memo, terms=avg_terms)
+
+        group = MatchGroup(
+            payment_ids=[pay.payment_id for pay in pays],
+            invoice_ids=[inv.invoice_id for inv in invs],
+            total_payment_amount=from_cents(sum(pay_cents[pay.payment_id] for pay in pays)),
+            total_invoice_amount=from_cents(net_open),
+            net_amount_diff=from_cents(net_diff),
+            avg_score=round(final_score, 2),
+            id_scores=[100.0] * len(edges),
+            amount_scores=[amount_score_net] * len(edges),
+            name_scores=[s["name"] for s in soft_scores],
+            date_scores=[s["date"] for s in soft_scores],
+            memo_scores=[s["memo"] for s in soft_scores],
+            terms_scores=[s["terms"] for s in soft_scores],
+            confidence="",
+            reason="",
+            stage="N:M",
+            is_negative_payment=any(pay.is_negative_payment for pay in pays),
+            payment_memo_text="; ".join(pay.memo_text for pay in pays),
+            invoice_payment_terms=[inv.payment_terms for inv in invs],
+            invoice_memo_lines=[inv.memo_line for inv in invs],
+            invoice_credit_flags=[inv.is_credit for inv in invs]
+        )
+
+        if force_hitl:
+            group.confidence = "hitl"
+            group.reason = force_hitl_reason
+            hitl.append(group)
+        elif final_score >= t.high and net_diff <= AMOUNT_EXACT_CENTS:
+            group.confidence = "high"
+            group.reason = f"{shape} perfect net match (overlapping references)"
+            high_conf.append(group)
+        elif final_score >= t.review:
+            group.confidence = "hitl"
+            group.reason = f"{shape} good match (overlapping references)"
+            hitl.append(group)
+        else:
+            group.confidence = "no_match"
+            group.reason = f"{shape} score too low (overlapping references)"
+            no_match.append(group)
+
+        used_invoices.update(inv.invoice_id for inv in invs)
+        used_payments.update(pay.payment_id for pay in pays)
+
     # === STEP 2: N:1 (Many payments → one invoice) ===
+    if probe: probe.enter("N:1")
     inv_to_pays = defaultdict(list)
     for pay in request.payments:
         if pay.payment_id in used_payments: continue
 
         # ONLY include payments that reference EXACTLY ONE invoice
         # Payments with multiple invoices belong in STEP 3 (1:N)
-        if len(pay.invoice_ids) == 1:
-            iid = pay.invoice_ids[0]
+        if len(refs[pay.payment_id]) == 1:
+            iid = refs[pay.payment_id][0]
             if iid in inv_map and iid not in used_invoices:
                 inv_to_pays[iid].append(pay)
 
     for inv_id, pays in inv_to_pays.items():
+        if out_of_time("N:1"): break
         inv = inv_map[inv_id]
 
-        net_pay = sum((-1 if pay.is_negative_payment else 1) * pay.amount for pay in pays)
-        net_diff = abs(net_pay - inv.total_open_amount)
-        amount_score_net = 100.0 if net_diff <= 1.0 else 95.0 if net_diff <= 5.0 else 60.0
+        net_pay = sum(signed_pay[pay.payment_id] for pay in pays)
+        net_diff = abs(net_pay - inv_cents[inv_id])
+        discount = 0
+        if TERMS_DISCOUNT_MATCHING and net_diff > AMOUNT_EXACT_CENTS:
+            # Every instalment has to arrive within the discount window
+            net_diff, discount = discounted_net_diff(net_pay, inv_cents[inv_id],
+                                                     min(early_payment_discount(pay, inv, inv_cents[inv_id]) for pay in pays))
+        amount_score_net = amount_score_cents(net_diff)
 
         soft_scores = []
         for pay in pays:
@@ -454,7 +3384,7 @@ async def reconcile(request: ReconciliationRequest):
         force_hitl_reason = ""
         for pay, scores in zip(pays, soft_scores):
             if pay.customer_name.strip() and inv.customer_name.strip():
-                if scores["name"] < 85:
+                if scores["name"] < t.name_review:
                     force_hitl = True
                     force_hitl_reason = f"N:1 match but {pay.payment_id} has {scores['name']:.0f}% name similarity - review required"
                     break  # Found one bad match, that's enough
@@ -464,22 +3394,16 @@ async def reconcile(request: ReconciliationRequest):
         avg_memo = sum(s["memo"] for s in soft_scores) / len(soft_scores)
         avg_terms = sum(s["terms"] for s in soft_scores) / len(soft_scores)
 
-        final_score = min(100.0,
-            0.50 * 100.0 +
-            0.40 * amount_score_net +
-            0.05 * avg_name +
-            0.025 * avg_date +
-            0.015 * avg_memo +
-            0.01 * avg_terms
-        )
+        final_score = plan.combine("explicit", id=100.0, amount=amount_score_net, name=avg_name, date=avg_date,
+                                   memo=avg_memo, terms=avg_terms)
 
         pay_ids = [pay.payment_id for pay in pays]
         group = MatchGroup(
             payment_ids=pay_ids,
             invoice_ids=[inv_id],
-            total_payment_amount=sum(pay.amount for pay in pays),
-            total_invoice_amount=inv.total_open_amount,
-            net_amount_diff=net_diff,
+            total_payment_amount=from_cents(sum(pay_cents[pay.payment_id] for pay in pays)),
+            total_invoice_amount=from_cents(inv_cents[inv_id]),
+            net_amount_diff=from_cents(net_diff),
             avg_score=round(final_score, 2),
             id_scores=[100.0] * len(pays),
             amount_scores=[amount_score_net] * len(pays),
@@ -489,25 +3413,28 @@ async def reconcile(request: ReconciliationRequest):
             terms_scores=[s["terms"] for s in soft_scores],
             confidence="",
             reason="",
+            stage="N:1",
             is_negative_payment=any(pay.is_negative_payment for pay in pays),
             payment_memo_text="; ".join(pay.memo_text for pay in pays),
             invoice_payment_terms=[inv.payment_terms],
             invoice_memo_lines=[inv.memo_line],
-            invoice_credit_flags=[inv.is_credit]
+            invoice_credit_flags=[inv.is_credit],
+            discount_applied=from_cents(discount)
         )
+        discount_note = " with early-payment discount" if discount else ""
 
         # Check for forced HITL first (due to name score violations)
         if force_hitl:
             group.confidence = "hitl"
             group.reason = force_hitl_reason
             hitl.append(group)
-        elif final_score >= 90 and net_diff <= 1.0:
+        elif final_score >= t.high and net_diff <= AMOUNT_EXACT_CENTS:
             group.confidence = "high"
-            group.reason = "N:1 perfect net match"
+            group.reason = "N:1 perfect net match" + discount_note
             high_conf.append(group)
-        elif final_score >= 80:
+        elif final_score >= t.review:
             group.confidence = "hitl"
-            group.reason = "N:1 good match"
+            group.reason = "N:1 good match" + discount_note
             hitl.append(group)
         else:
             group.confidence = "no_match"
@@ -520,12 +3447,14 @@ async def reconcile(request: ReconciliationRequest):
             used_payments.add(pay.payment_id)
 
     # === STEP 3: 1:N (One payment → many invoices) ===
+    if probe: probe.enter("1:N")
     for pay in request.payments:
+        if out_of_time("1:N"): break
         if pay.payment_id in used_payments: continue
-        if len(pay.invoice_ids) <= 1: continue  # Skip 1:1
+        if len(refs[pay.payment_id]) <= 1: continue  # Skip 1:1
 
         valid_invoices = [
-            inv_map[iid] for iid in pay.invoice_ids
+            inv_map[iid] for iid in refs[pay.payment_id]
             if iid in inv_map and iid not in used_invoices
         ]
 
@@ -533,24 +3462,30 @@ async def reconcile(request: ReconciliationRequest):
             no_match.append(MatchGroup(
                 payment_ids=[pay.payment_id],
                 invoice_ids=[],
-                total_payment_amount=pay.amount,
+                total_payment_amount=from_cents(pay_cents[pay.payment_id]),
                 total_invoice_amount=0.0,
-                net_amount_diff=pay.amount,
+                net_amount_diff=from_cents(pay_cents[pay.payment_id]),
                 avg_score=0.0,
                 id_scores=[], amount_scores=[], name_scores=[], date_scores=[],
                 memo_scores=[], terms_scores=[],
                 confidence="no_match",
                 reason="No valid multi-invoice match",
+                stage="1:N",
                 is_negative_payment=pay.is_negative_payment,
                 payment_memo_text=pay.memo_text
             ))
             used_payments.add(pay.payment_id)
             continue
 
-        net_open = sum((-1 if inv.is_credit else 1) * inv.total_open_amount for inv in valid_invoices)
-        target = -pay.amount if pay.is_negative_payment else pay.amount
+        net_open = sum(signed_inv[inv.invoice_id] for inv in valid_invoices)
+        target = signed_pay[pay.payment_id]
         net_diff = abs(net_open - target)
-        amount_score_net = 100.0 if net_diff <= 1.0 else 95.0 if net_diff <= 5.0 else 60.0
+        discount = 0
+        if TERMS_DISCOUNT_MATCHING and net_diff > AMOUNT_EXACT_CENTS:
+            # Only the invoices still inside their own discount window are discounted
+            net_diff, discount = discounted_net_diff(target, net_open, sum(
+                early_payment_discount(pay, inv, inv_cents[inv.invoice_id]) for inv in valid_invoices))
+        amount_score_net = amount_score_cents(net_diff)
 
         soft_scores = []
         for inv in valid_invoices:
@@ -566,7 +3501,7 @@ async def reconcile(request: ReconciliationRequest):
         force_hitl_reason = ""
         for inv, scores in zip(valid_invoices, soft_scores):
             if pay.customer_name.strip() and inv.customer_name.strip():
-                if scores["name"] < 85:
+                if scores["name"] < t.name_review:
                     force_hitl = True
                     force_hitl_reason = f"1:N match but {inv.invoice_id} has {scores['name']:.0f}% name similarity - review required"
                     break  # Found one bad match, that's enough
@@ -577,22 +3512,16 @@ async def reconcile(request: ReconciliationRequest):
         avg_memo = sum(s["memo"] for s in soft_scores) / len(soft_scores)
         avg_terms = sum(s["terms"] for s in soft_scores) / len(soft_scores)
 
-        final_score = min(100.0,
-            0.50 * 100.0 +
-            0.40 * amount_score_net +
-            0.05 * avg_name +
-            0.025 * avg_date +
-            0.015 * avg_memo +
-            0.01 * avg_terms
-        )
+        final_score = plan.combine("explicit", id=100.0, amount=amount_score_net, name=avg_name, date=avg_date,
+                                   memo=avg_memo, terms=avg_terms)
 
         inv_ids = [inv.invoice_id for inv in valid_invoices]
         group = MatchGroup(
             payment_ids=[pay.payment_id],
             invoice_ids=inv_ids,
-            total_payment_amount=pay.amount,
-            total_invoice_amount=net_open,
-            net_amount_diff=net_diff,
+            total_payment_amount=from_cents(pay_cents[pay.payment_id]),
+            total_invoice_amount=from_cents(net_open),
+            net_amount_diff=from_cents(net_diff),
             avg_score=round(final_score, 2),
             id_scores=[100.0] * len(inv_ids),
             amount_scores=[amount_score_net] * len(inv_ids),
@@ -602,25 +3531,28 @@ async def reconcile(request: ReconciliationRequest):
             terms_scores=[s["terms"] for s in soft_scores],
             confidence="",
             reason="",
+            stage="1:N",
             is_negative_payment=pay.is_negative_payment,
             payment_memo_text=pay.memo_text,
             invoice_payment_terms=[inv.payment_terms for inv in valid_invoices],
             invoice_memo_lines=[inv.memo_line for inv in valid_invoices],
-            invoice_credit_flags=[inv.is_credit for inv in valid_invoices]
+            invoice_credit_flags=[inv.is_credit for inv in valid_invoices],
+            discount_applied=from_cents(discount)
         )
+        discount_note = " with early-payment discount" if discount else ""
 
         # Check for forced HITL first (due to name score violations)
         if force_hitl:
             group.confidence = "hitl"
             group.reason = force_hitl_reason
             hitl.append(group)
-        elif final_score >= 90 and net_diff <= 1.0:
+        elif final_score >= t.high and net_diff <= AMOUNT_EXACT_CENTS:
             group.confidence = "high"
-            group.reason = "1:N perfect net match"
+            group.reason = "1:N perfect net match" + discount_note
             high_conf.append(group)
-        elif final_score >= 80:
+        elif final_score >= t.review:
             group.confidence = "hitl"
-            group.reason = "1:N good match"
+            group.reason = "1:N good match" + discount_note
             hitl.append(group)
         else:
             group.confidence = "no_match"
@@ -631,26 +3563,38 @@ async def reconcile(request: ReconciliationRequest):
         used_invoices.update(inv_ids)
         used_payments.add(pay.payment_id)
 
+    # Flag groups that rest on inferred or resolved invoice references;
+    # a typo-resolved reference is never enough for high confidence
+    if ref_notes:
+        for group in high_conf + hitl + no_match:
+            notes = [note for pid in group.payment_ids for note in ref_notes.get(pid, [])]
+            if notes:
+                group.reason = f"{group.reason} ({'; '.join(dict.fromkeys(notes))})"
+        for group in [g for g in high_conf if any(fuzzy_refs.get(pid, set()) & set(g.invoice_ids) for pid in g.payment_ids)]:
+            high_conf.remove(group)
+            group.confidence = "hitl"
+            hitl.append(group)
+
     # === STEP 4.5: FUZZY MATCH within Customer Groups ===
+    if probe: probe.enter("fuzzy")
     # Get unmatched items with customer names
     unmatched_payments = [
         pay for pay in request.payments
         if pay.payment_id not in used_payments and pay.customer_name.strip()
     ]
 
-    unmatched_invoices = [
-        inv for inv in request.open_items
-        if inv.invoice_id not in used_invoices and inv.isOpen and inv.customer_name.strip()
-    ]
-
     # Create fuzzy customer groups
     customer_groups = []  # Each group: {'name': str, 'payments': [], 'invoices': []}
 
+    # Payments the fuzzy stage still has to look at; whatever is left when time runs out is unprocessed
+    fuzzy_pending = {pay.payment_id for pay in unmatched_payments}
+
     # Group payments by fuzzy customer name
     for pay in unmatched_payments:
+        if out_of_time("fuzzy"): break
         found_group = False
         for group in customer_groups:
-            if name_score(pay.customer_name, group['name']) >= 90:
+            if name_score(pay.customer_name, group['name']) >= t.customer_group:
                 group['payments'].append(pay)
                 found_group = True
                 break
@@ -663,137 +3607,253 @@ async def reconcile(request: ReconciliationRequest):
             })
 
     # Group invoices by fuzzy customer name
-    for inv in unmatched_invoices:
-        found_group = False
-        for group in customer_groups:
-            if name_score(inv.customer_name, group['name']) >= 90:
-                group['invoices'].append(inv)
-                found_group = True
-                break
+    if book is not None:
+        if not out_of_time("fuzzy"):
+            group_invoices = book.customer_invoices([group['name'] for group in customer_groups], used_invoices, t.customer_group)
+            for group, invoices in zip(customer_groups, group_invoices):
+                group['invoices'] = invoices
+    else:
+        unmatched_invoices = [
+            inv for inv in request.open_items
+            if inv.invoice_id not in used_invoices and inv.isOpen and inv.customer_name.strip()
+        ]
+        for inv in unmatched_invoices:
+            if out_of_time("fuzzy"): break
+            found_group = False
+            for group in customer_groups:
+                if name_score(inv.customer_name, group['name']) >= t.customer_group:
+                    group['invoices'].append(inv)
+                    found_group = True
+                    break
+
+            if not found_group:
+                customer_groups.append({
+                    'name': inv.customer_name,
+                    'payments': [],
+                    'invoices': [inv]
+                })
+
+    def record_fuzzy_match(pay, best_score, best_match):
+        inv, amount_diff, amount_score_val, name_s, date_s, memo_s, terms_s = best_match
+
+        group_match = MatchGroup(
+            payment_ids=[pay.payment_id],
+            invoice_ids=[inv.invoice_id],
+            total_payment_amount=from_cents(pay_cents[pay.payment_id]),
+            total_invoice_amount=from_cents(inv_cents[inv.invoice_id]),
+            net_amount_diff=from_cents(amount_diff),
+            avg_score=round(best_score, 2),
+            id_scores=[0.0],
+            amount_scores=[amount_score_val],
+            name_scores=[name_s],
+            date_scores=[date_s],
+            memo_scores=[memo_s],
+            terms_scores=[terms_s],
+            confidence="",
+            reason="",
+            stage="fuzzy",
+            is_negative_payment=pay.is_negative_payment,
+            payment_memo_text=pay.memo_text,
+            invoice_payment_terms=[inv.payment_terms],
+            invoice_memo_lines=[inv.memo_line],
+            invoice_credit_flags=[inv.is_credit]
+        )
 
-        if not found_group:
-            customer_groups.append({
-                'name': inv.customer_name,
-                'payments': [],
-                'invoices': [inv]
-            })
+        if best_score >= t.fuzzy_high and amount_diff <= AMOUNT_EXACT_CENTS:
+            group_match.confidence = "high"
+            group_match.reason = "Fuzzy match - exact amount + strong signals"
+            high_conf.append(group_match)
+            used_invoices.add(inv.invoice_id)
+            used_payments.add(pay.payment_id)
+        elif best_score >= t.fuzzy_review:
+            group_match.confidence = "hitl"
+            group_match.reason = "Fuzzy match - good candidate"
+            hitl.append(group_match)
+            used_invoices.add(inv.invoice_id)
+            used_payments.add(pay.payment_id)
 
     # Within each customer group, do 1:1 fuzzy matching
     for group in customer_groups:
+        due_index = None
+        if FUZZY_DATE_WINDOW_DAYS > 0 and group['payments']:
+            due_index = DueDateIndex(group['invoices'], inv_cents, prune_far_amounts=plan.prune_far_amounts)
+
+        if FUZZY_ASSIGNMENT == "optimal":
+            # Sparse graph of every pair that would be accepted, then one assignment for the group
+            edges = []
+            scored = {}
+            for pay in group['payments']:
+                if out_of_time("fuzzy"): break
+                fuzzy_pending.discard(pay.payment_id)
+                if pay.payment_id in used_payments:
+                    continue
+                # Same candidate passes as the greedy pass: the out-of-window fallback only without an in-window edge
+                passes = [group['invoices']] if due_index is None else due_index.candidate_passes(
+                    pay, pay_cents[pay.payment_id], profiles.window(pay.customer_name) if profiles else None)
+                for candidates in passes:
+                    candidates = [inv for inv in candidates if inv.invoice_id not in used_invoices]
+                    if not candidates:
+                        continue
+                    cand = score_candidates(plan, pay, pay_cents[pay.payment_id], candidates, inv_cents)
+                    accepted = np.flatnonzero(cand["total"] >= t.fuzzy_review)
+                    for j in accepted:
+                        inv, final_score = candidates[j], float(cand["total"][j])
+                        edges.append((pay.payment_id, inv.invoice_id, final_score))
+                        scored[(pay.payment_id, inv.invoice_id)] = (final_score, fuzzy_signals(inv, cand, j))
+                    if len(accepted):
+                        break
+
+            assigned = dict(max_weight_assignment(edges))
+            for pay in group['payments']:  # Record in payment order, like the greedy pass
+                if pay.payment_id in assigned:
+                    record_fuzzy_match(pay, *scored[(pay.payment_id, assigned[pay.payment_id])])
+            continue
+
         for pay in group['payments']:
+            if out_of_time("fuzzy"): break
+            fuzzy_pending.discard(pay.payment_id)
             if pay.payment_id in used_payments:
                 continue
 
             best_match = None
             best_score = 0
 
-            for inv in group['invoices']:
-                if inv.invoice_id in used_invoices:
-                    continue
-
-                # Score this potential match
-                amount_diff = abs(pay.amount - inv.total_open_amount)
-                amount_score_val = 100.0 if amount_diff <= 1.0 else 95.0 if amount_diff <= 5.0 else 60.0
-
-                name_s = name_score(pay.customer_name, inv.customer_name)
-                date_s = date_score(pay.payment_date, inv.due_in_date, pay.value_date)
-                memo_s = memo_line_score(pay.memo_text, inv.memo_line)
-                terms_s = payment_terms_score(pay.payment_terms_hint, inv.payment_terms)
-
-                final_score = min(100.0,
-                                  0.40 * amount_score_val +
-                                  0.25 * name_s +
-                                  0.20 * date_s +
-                                  0.10 * memo_s +
-                                  0.05 * terms_s
-                                  )
-
-                # Keep track of best match
-                if final_score > best_score and final_score >= 70:
-                    best_score = final_score
-                    best_match = (inv, amount_diff, amount_score_val, name_s, date_s, memo_s, terms_s)
+            # Likely-lag candidates, then the date window; out-of-window items only if nothing in the window qualifies
+            passes = [group['invoices']] if due_index is None else due_index.candidate_passes(
+                pay, pay_cents[pay.payment_id], profiles.window(pay.customer_name) if profiles else None)
+            for candidates in passes:
+                candidates = [inv for inv in candidates if inv.invoice_id not in used_invoices]
+                if candidates:
+                    # Score the whole pass at once; the best is the first candidate with the top score
+                    cand = score_candidates(plan, pay, pay_cents[pay.payment_id], candidates, inv_cents)
+                    j = int(np.argmax(cand["total"]))
+                    if cand["total"][j] > best_score:
+                        best_score = float(cand["total"][j])
+                        best_match = fuzzy_signals(candidates[j], cand, j)
+
+                if best_score >= t.fuzzy_review:
+                    break
 
             # If found a good match, create a match group
             if best_match:
-                inv, amount_diff, amount_score_val, name_s, date_s, memo_s, terms_s = best_match
-
-                group_match = MatchGroup(
-                    payment_ids=[pay.payment_id],
-                    invoice_ids=[inv.invoice_id],
-                    total_payment_amount=pay.amount,
-                    total_invoice_amount=inv.total_open_amount,
-                    net_amount_diff=amount_diff,
-                    avg_score=round(best_score, 2),
-                    id_scores=[0.0],
-                    amount_scores=[amount_score_val],
-                    name_scores=[name_s],
-                    date_scores=[date_s],
-                    memo_scores=[memo_s],
-                    terms_scores=[terms_s],
-                    confidence="",
-                    reason="",
-                    is_negative_payment=pay.is_negative_payment,
-                    payment_memo_text=pay.memo_text,
-                    invoice_payment_terms=[inv.payment_terms],
-                    invoice_memo_lines=[inv.memo_line],
-                    invoice_credit_flags=[inv.is_credit]
-                )
-
-                if best_score >= 85 and amount_diff <= 1.0:
-                    group_match.confidence = "high"
-                    group_match.reason = "Fuzzy match - exact amount + strong signals"
-                    high_conf.append(group_match)
-                    used_invoices.add(inv.invoice_id)
-                    used_payments.add(pay.payment_id)
-                elif best_score >= 75:
-                    group_match.confidence = "hitl"
-                    group_match.reason = "Fuzzy match - good candidate"
-                    hitl.append(group_match)
-                    used_invoices.add(inv.invoice_id)
-                    used_payments.add(pay.payment_id)
-
+                record_fuzzy_match(pay, best_score, best_match)
+
+    # === STEP 4.6: MEMO MATCH across customers (third-party payers) ===
+    if probe: probe.enter("memo")
+    # Whatever the name-based stages left is compared by memo alone; a hit is never high confidence
+    if MEMO_TFIDF_MATCHING and not out_of_time("memo"):
+        memo_payments = [pay for pay in request.payments if pay.payment_id not in used_payments and pay.memo_text.strip()]
+        if book is not None:
+            memo_rows = book.open_rows(LEDGER_MEMO, exclude=used_invoices)
+            matches = memo_similarity_matches(memo_payments, ledger.strings("memo_norm", memo_rows),
+                                              ledger.columns["cents"][ledger.columns["id_row"][memo_rows]], pay_cents)
+            matches = [(pay, book.items_at([int(memo_rows[j])])[0], similarity) for pay, j, similarity in matches]
+        else:
+            memo_invoices = [inv for inv in request.open_items
+                             if inv.isOpen and inv.invoice_id not in used_invoices and inv.memo_line.strip()]
+            matches = memo_similarity_matches(memo_payments, [inv.memo_line for inv in memo_invoices],
+                                              np.array([inv_cents[inv.invoice_id] for inv in memo_invoices], dtype=np.int64), pay_cents)
+            matches = [(pay, memo_invoices[j], similarity) for pay, j, similarity in matches]
+        for pay, inv, similarity in matches:
+            amount_diff = abs(pay_cents[pay.payment_id] - inv_cents[inv.invoice_id])
+            name_s = name_score(pay.customer_name, inv.customer_name)
+            payer = f"paid by '{pay.customer_name}'" if pay.customer_name.strip() else "payer unnamed"
+            hitl.append(MatchGroup(
+                payment_ids=[pay.payment_id],
+                invoice_ids=[inv.invoice_id],
+                total_payment_amount=from_cents(pay_cents[pay.payment_id]),
+                total_invoice_amount=from_cents(inv_cents[inv.invoice_id]),
+                net_amount_diff=from_cents(amount_diff),
+                avg_score=round(similarity * 100.0, 2),
+                id_scores=[0.0],
+                amount_scores=[amount_score_cents(amount_diff)],
+                name_scores=[name_s],
+                date_scores=[date_score(pay.payment_date, inv.due_in_date, pay.value_date)],
+                memo_scores=[round(similarity * 100.0, 2)],
+                terms_scores=[payment_terms_score(pay.payment_terms_hint, inv.payment_terms)],
+                confidence="hitl",
+                reason=(f"Memo match across customers - {payer}, invoice customer '{inv.customer_name}' "
+                        f"(memo similarity {similarity:.0%}) - review required"
+                        if name_s < t.customer_group else
+                        f"Memo match (memo similarity {similarity:.0%}) - review required"),
+                stage="memo",
+                is_negative_payment=pay.is_negative_payment,
+                payment_memo_text=pay.memo_text,
+                invoice_payment_terms=[inv.payment_terms],
+                invoice_memo_lines=[inv.memo_line],
+                invoice_credit_flags=[inv.is_credit]
+            ))
+            used_invoices.add(inv.invoice_id)
+            used_payments.add(pay.payment_id)
 
     # === STEP 4: UNMATCHED ===
+    if probe: probe.enter("unmatched")
+    unprocessed_payment_ids = []
     for pay in request.payments:
         if pay.payment_id not in used_payments:
+            reason, stage = "Unmatched payment", "unmatched"
+            if skipped_stages and (pay.payment_id in fuzzy_pending or skipped_stages[0] != "fuzzy"):
+                reason, stage = f"Not processed - deadline exceeded during {skipped_stages[0]} stage", "deadline"
+                unprocessed_payment_ids.append(pay.payment_id)
             no_match.append(MatchGroup(
                 payment_ids=[pay.payment_id],
                 invoice_ids=[],
-                total_payment_amount=pay.amount,
+                total_payment_amount=from_cents(pay_cents[pay.payment_id]),
                 total_invoice_amount=0.0,
-                net_amount_diff=pay.amount,
+                net_amount_diff=from_cents(pay_cents[pay.payment_id]),
                 avg_score=0.0,
                 id_scores=[], amount_scores=[], name_scores=[], date_scores=[],
                 memo_scores=[], terms_scores=[],
                 confidence="no_match",
-                reason="Unmatched payment",
+                reason=reason,
+                stage=stage,
                 is_negative_payment=pay.is_negative_payment,
                 payment_memo_text=pay.memo_text
             ))
 
-    for inv in request.open_items:
-        if inv.invoice_id not in used_invoices and inv.isOpen:
+    # Against a ledger snapshot the unmatched open items are most of the book: count them, don't list them
+    if book is not None:
+        nm_invoices = book.leftover_count(used_invoices)
+    else:
+        leftover_invoices = [inv for inv in request.open_items if inv.invoice_id not in used_invoices and inv.isOpen]
+        nm_invoices = len(leftover_invoices)
+        for inv in leftover_invoices:
             no_match.append(MatchGroup(
                 payment_ids=[],
                 invoice_ids=[inv.invoice_id],
                 total_payment_amount=0.0,
-                total_invoice_amount=inv.total_open_amount,
-                net_amount_diff=inv.total_open_amount,
+                total_invoice_amount=from_cents(inv_cents[inv.invoice_id]),
+                net_amount_diff=from_cents(inv_cents[inv.invoice_id]),
                 avg_score=0.0,
                 id_scores=[], amount_scores=[], name_scores=[], date_scores=[],
                 memo_scores=[], terms_scores=[],
                 confidence="no_match",
-                reason="Unmatched invoice",
+                reason="Unmatched invoice (not fully processed - deadline exceeded)" if skipped_stages else "Unmatched invoice",
+                stage="unmatched",
                 invoice_payment_terms=[inv.payment_terms],
                 invoice_memo_lines=[inv.memo_line],
                 invoice_credit_flags=[inv.is_credit]
             ))
 
+    # === STEP 5: CANDIDATE SUGGESTIONS for reviewers ===
+    if probe: probe.enter("candidate suggestions")
+    # Invoices already in a high-confidence match are settled; everything else is a candidate
+    if top_k > 0 and not out_of_time("candidate suggestions"):
+        settled = {iid for g in high_conf for iid in g.invoice_ids}
+        if book is not None:
+            pool = book.candidate_pool(settled)
+        else:
+            pool = candidate_pool([inv for inv in request.open_items if inv.isOpen and inv.invoice_id not in settled], inv_cents)
+        review_groups = [g for g in hitl + no_match if g.payment_ids]
+        review_payments = list({pid: pay_map[pid] for g in review_groups for pid in g.payment_ids}.values())
+        suggestions = suggest_candidates(review_payments, pool, top_k, pay_cents, plan)
+        for g in review_groups:
+            g.candidates = [c for pid in g.payment_ids for c in suggestions.get(pid, [])]
+
     # Calculate summary statistics (AFTER all processing is done)
     hc_payments = sum(len(g.payment_ids) for g in high_conf)
     hitl_payments = sum(len(g.payment_ids) for g in hitl)
     nm_payments = sum(len(g.payment_ids) for g in no_match if len(g.payment_ids) > 0)
-    nm_invoices = sum(1 for g in no_match if len(g.invoice_ids) > 0 and len(g.payment_ids) == 0)
 
     summary = ReconciliationSummary(
         high_confidence_payments=hc_payments,
@@ -801,15 +3861,125 @@ async def reconcile(request: ReconciliationRequest):
         no_match_payments=nm_payments,
         no_match_invoices=nm_invoices,
         total_payments_processed=len(request.payments),
-        total_invoices_processed=len(request.open_items)
+        total_invoices_processed=ledger.rows if ledger is not None else len(request.open_items),
+        unprocessed_payments=len(unprocessed_payment_ids),
+        duplicate_payments=len(duplicates)
     )
 
-    return ReconciliationResponse(
+    response = ReconciliationResponse(
         high_confidence=high_conf,
         hitl_review=hitl,
         no_match=no_match,
-        summary=summary
+        summary=summary,
+        duplicates=duplicates,
+        partial=bool(skipped_stages),
+        skipped_stages=skipped_stages,
+        unprocessed_payment_ids=unprocessed_payment_ids,
+        config_version=plan.version
     )
+    if probe:
+        probe.finish(request, top_k)
+    return response
+
+# === BATCH: independent ledgers reconciled in parallel ===
+# Reconciliation is CPU-bound, so entities are spread over a process pool rather than threads.
+# Every uvicorn worker has its own pool, so by default they split the cores between them
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", str(max(1, (os.cpu_count() or 1) // max(1, WEB_CONCURRENCY)))))
+BATCH_MAX_ENTITIES = int(os.getenv("BATCH_MAX_ENTITIES", "100"))
+_batch_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_batch_pool() -> ProcessPoolExecutor:
+    global _batch_pool
+    if _batch_pool is None:
+        # spawn works the same on Linux (Railway) and Windows (local runs)
+        _batch_pool = ProcessPoolExecutor(max_workers=BATCH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _batch_pool
+
+
+@app.on_event("shutdown")
+def shutdown_batch_pool():
+    if _batch_pool is not None:
+        _batch_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _timed_reconciliation(request: ReconciliationRequest, plan: ScoringPlan, profiles: Optional[PaymentProfiles] = None):
+    """Runs inside a pool process; returns the response and compute time in ms"""
+    start = time.perf_counter()
+    result = run_reconciliation(request, plan=plan, profiles=profiles)
+    return result, (time.perf_counter() - start) * 1000.0
+
+
+async def reconcile_entity(entity: EntityReconciliationRequest) -> EntityReconciliationResult:
+    start = time.perf_counter()
+    try:
+        check_request_limits(entity)
+        request = ReconciliationRequest.model_construct(payments=entity.payments, open_items=entity.open_items)
+        plan = scoring_plan()  # Decided here, so every pool process scores with the same plan
+        profiles = payment_profiles.snapshot() if payment_profiles is not None else None
+        key = request_hash(request, *cache_options(plan, profiles))
+        result = await result_cache.aget(key)
+        if result is None:
+            loop = asyncio.get_running_loop()
+            async with memory_budget.hold(estimate_request_bytes(request), wait=True):
+                result, _ = await loop.run_in_executor(get_batch_pool(), _timed_reconciliation, request, plan, profiles)
+            await result_cache.aput(key, result)
+            if decision_log is not None:
+                decision_log.submit(key, result, source=f"batch:{entity.entity_key}")
+            if payment_profiles is not None:
+                payment_profiles.learn(request, result)
+        return EntityReconciliationResult(
+            entity_key=entity.entity_key,
+            status="ok",
+            elapsed_ms=round((time.perf_counter() - start) * 1000.0, 2),
+            result=result
+        )
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        return EntityReconciliationResult(
+            entity_key=entity.entity_key,
+            status="error",
+            elapsed_ms=round((time.perf_counter() - start) * 1000.0, 2),
+            error=str(detail)
+        )
+
+
+@app.post("/reconcile/batch", response_model=BatchReconciliationResponse, dependencies=[Depends(admit_request)])
+async def reconcile_batch(batch: BatchReconciliationRequest, stream: bool = False):
+    """
+    Reconcile several independent ledgers (e.g. one per company code) in one call.
+    With ?stream=true the response is NDJSON, one EntityReconciliationResult per line
+    in completion order; otherwise results are returned together in request order.
+    """
+    if len(batch.entities) > BATCH_MAX_ENTITIES:
+        raise HTTPException(400, f"Max {BATCH_MAX_ENTITIES} entities per batch")
+    keys = [e.entity_key for e in batch.entities]
+    if len(set(keys)) != len(keys):
+        raise HTTPException(400, "entity_key values must be unique within a batch")
+
+    start = time.perf_counter()
+    tasks = [asyncio.ensure_future(reconcile_entity(entity)) for entity in batch.entities]
+
+    if stream:
+        async def ndjson_lines():
+            try:
+                for finished in asyncio.as_completed(tasks):
+                    entity_result = await finished
+                    yield entity_result.model_dump_json() + "\n"
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+        # An explicit Content-Encoding keeps GZipMiddleware from buffering the lines until its deflate block fills
+        return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson", headers={"Content-Encoding": "identity"})
+
+    results = await asyncio.gather(*tasks)
+    return BatchReconciliationResponse(
+        results=results,
+        elapsed_ms=round((time.perf_counter() - start) * 1000.0, 2)
+    )
+
 
 # === 5. RUN ===
 if __name__ == "__main__":
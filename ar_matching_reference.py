@@ -0,0 +1,1336 @@
+"""
+Frozen reference implementation of the reconciliation engine (ar_matching v11.0, amounts in cents).
+
+This is a verbatim copy of run_reconciliation() and the scoring helpers it uses, with every
+environment-driven setting pinned to its default. It is NOT served and must NOT be optimized:
+differential_harness.py runs it side by side with ar_matching.run_reconciliation() to prove that
+performance work does not move a single match between buckets.
+"""
+from pydantic import BaseModel
+from typing import List, Optional, Dict, Any
+from rapidfuzz import fuzz, process
+from rapidfuzz.distance import OSA
+from datetime import datetime
+from collections import defaultdict
+from functools import lru_cache
+import numpy as np
+import bisect
+import re
+import time
+
+
+# === 1. INPUT MODELS (NO FEES) ===
+class Payment(BaseModel):
+    payment_id: str
+    invoice_ids: List[str] = []
+    customer_name: str = ""
+    memo_text: str = ""
+    amount: float
+    is_negative_payment: bool = False
+    payment_date: str
+    value_date: Optional[str] = None
+    payment_terms_hint: str = ""
+
+class OpenItem(BaseModel):
+    invoice_id: str
+    customer_name: str
+    total_open_amount: float
+    due_in_date: str
+    isOpen: bool = True
+    payment_terms: str = ""
+    memo_line: str = ""
+    is_credit: bool = False
+
+class ReconciliationRequest(BaseModel):
+    payments: List[Payment]
+    open_items: List[OpenItem]
+
+# === 2. OUTPUT MODEL ===
+class CandidateScore(BaseModel):
+    payment_id: str
+    invoice_id: str
+    customer_name: str
+    total_open_amount: float
+    due_in_date: str
+    score: float
+    amount_score: float
+    name_score: float
+    date_score: float
+    memo_score: float
+    terms_score: float
+
+class MatchGroup(BaseModel):
+    payment_ids: List[str]
+    invoice_ids: List[str]
+    total_payment_amount: float
+    total_invoice_amount: float
+    net_amount_diff: float
+    avg_score: float
+    id_scores: List[float]
+    amount_scores: List[float]
+    name_scores: List[float]
+    date_scores: List[float]
+    memo_scores: List[float]
+    terms_scores: List[float]
+    confidence: str
+    reason: str = ""
+    is_negative_payment: bool = False
+    payment_memo_text: str = ""
+    invoice_payment_terms: List[str] = []
+    invoice_memo_lines: List[str] = []
+    invoice_credit_flags: List[bool] = []
+    candidates: List[CandidateScore] = []  # Only filled when /reconcile?top_k=N is requested
+
+class ReconciliationSummary(BaseModel):
+    high_confidence_payments: int
+    hitl_review_payments: int
+    no_match_payments: int
+    no_match_invoices: int
+    total_payments_processed: int
+    total_invoices_processed: int
+    unprocessed_payments: int = 0
+    duplicate_payments: int = 0
+
+class ReconciliationResponse(BaseModel):
+    high_confidence: List[MatchGroup]
+    hitl_review: List[MatchGroup]
+    no_match: List[MatchGroup]
+    summary: ReconciliationSummary
+    duplicates: List[MatchGroup] = []  # Likely double-delivered bank lines, kept out of matching
+    partial: bool = False  # True when X-Deadline-Ms ran out before all stages finished
+    skipped_stages: List[str] = []
+    unprocessed_payment_ids: List[str] = []
+
+
+# === 3. SCORING FUNCTIONS ===
+NAME_SIMILARITY_CACHE_SIZE = 65536
+
+@lru_cache(maxsize=NAME_SIMILARITY_CACHE_SIZE)
+def _name_similarity(p1_upper: str, p2_upper: str) -> float:
+    # Customer names repeat heavily within a batch (grouping compares every payer to every group)
+    return fuzz.token_set_ratio(p1_upper, p2_upper)
+
+def name_score(p1: str, p2: str) -> float:
+    if not p1 or not p2: return 0.0
+    s = _name_similarity(p1.upper(), p2.upper())
+    if s == 100: return 100.0
+    if s >= 95: return 95.0
+    if s >= 90: return 90.0
+    if s >= 80: return 80.0
+    if s >= 70: return 70.0
+    return 0.0
+
+def date_score(pay_date: str, due_date: str, value_date: Optional[str] = None) -> float:
+    try:
+        pay = datetime.strptime(value_date or pay_date, "%Y%m%d")
+        due = datetime.strptime(due_date, "%Y%m%d")
+        days = abs((pay - due).days)
+        if days == 0: return 100.0
+        if days <= 1: return 95.0
+        if days <= 3: return 90.0
+        if days <= 7: return 80.0
+        if days <= 10: return 70.0
+        if days <= 30: return 50.0
+        return 20.0
+    except: return 50.0
+
+def memo_line_score(pay_memo: str, inv_memo: str) -> float:
+    if not pay_memo or not inv_memo: return 0.0
+    score = fuzz.token_set_ratio(pay_memo.upper(), inv_memo.upper())
+    if score >= 90: return 100.0
+    if score >= 70: return 70.0
+    return 0.0
+
+def payment_terms_score(pay_hint: str, inv_terms: str) -> float:
+    if not inv_terms: return 0.0
+    pay_norm = pay_hint.upper() if pay_hint else ""
+    inv_norm = inv_terms.upper()
+    if pay_norm == inv_norm: return 100.0
+    if pay_norm in inv_norm or inv_norm in pay_hint: return 80.0
+    if inv_norm in {"NET 30", "NET 15", "DUE ON RECEIPT", "2/10 NET 30"}: return 50.0
+    return 0.0
+
+# === 3b. N:M COMPONENTS (payments referencing overlapping invoice sets) ===
+NM_EXACT_MAX_ITEMS = 14
+NM_HEURISTIC_MAX_STEPS = 5000
+
+
+def connected_components(edges: List[tuple]) -> List[tuple]:
+    """
+    Split a bipartite graph given as (left, right) edges into connected components.
+    Returns [(lefts, rights), ...] with nodes in first-seen order.
+    """
+    parent: Dict[tuple, tuple] = {}
+
+    def find(node):
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    for left, right in edges:
+        a, b = ("L", left), ("R", right)
+        parent.setdefault(a, a)
+        parent.setdefault(b, b)
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[rb] = ra
+
+    components: Dict[tuple, tuple] = {}
+    for node in parent:  # dicts keep insertion order, so output follows the input order
+        lefts, rights = components.setdefault(find(node), ([], []))
+        (lefts if node[0] == "L" else rights).append(node[1])
+    return list(components.values())
+
+
+# Amounts are converted once to integer cents; sums and tolerance checks are exact and hashable.
+AMOUNT_EXACT_CENTS = 100   # |diff| <= 1.00 counts as an exact amount match
+AMOUNT_CLOSE_CENTS = 500   # |diff| <= 5.00 counts as close
+
+
+def to_cents(amount: float) -> int:
+    return int(round(amount * 100))
+
+
+def from_cents(cents: int) -> float:
+    return cents / 100.0
+
+
+def amount_score_cents(diff_cents: int) -> float:
+    return 100.0 if diff_cents <= AMOUNT_EXACT_CENTS else 95.0 if diff_cents <= AMOUNT_CLOSE_CENTS else 60.0
+
+
+def _subset_sums(values: List[int]) -> List[tuple]:
+    """All non-empty subset sums as (sum, mask), sorted by sum"""
+    sums = [(0, 0)]
+    for i, v in enumerate(values):
+        bit = 1 << i
+        sums += [(total + v, mask | bit) for total, mask in sums]
+    return sorted(sums[1:])
+
+
+def solve_nm_component(pay_cents: List[int], inv_cents: List[int], refs: List[set],
+                       tolerance_cents: int = AMOUNT_EXACT_CENTS) -> Optional[tuple]:
+    """
+    Find the largest payment subset and invoice subset of one component whose signed nets agree
+    within tolerance. pay_cents/inv_cents are signed amounts; refs[i] holds the invoice indexes
+    payment i references. Returns (payment_indexes, invoice_indexes) or None.
+    Small components are solved exactly, large ones with a bounded greedy heuristic.
+    """
+    n_pay, n_inv = len(pay_cents), len(inv_cents)
+    if abs(sum(pay_cents) - sum(inv_cents)) <= tolerance_cents:
+        return list(range(n_pay)), list(range(n_inv))
+
+    if n_pay + n_inv <= NM_EXACT_MAX_ITEMS:
+        inv_sums = _subset_sums(inv_cents)
+        inv_keys = [total for total, _ in inv_sums]
+        best = None
+        for pay_total, pay_mask in _subset_sums(pay_cents):
+            lo = bisect.bisect_left(inv_keys, pay_total - tolerance_cents)
+            hi = bisect.bisect_right(inv_keys, pay_total + tolerance_cents)
+            pay_idx = [i for i in range(n_pay) if pay_mask >> i & 1]
+            for inv_total, inv_mask in inv_sums[lo:hi]:
+                inv_idx = [j for j in range(n_inv) if inv_mask >> j & 1]
+                # Every selected payment must reference a selected invoice and vice versa
+                if not all(any(inv_mask >> j & 1 for j in refs[i]) for i in pay_idx):
+                    continue
+                if not all(any(j in refs[i] for i in pay_idx) for j in inv_idx):
+                    continue
+                rank = (len(pay_idx) + len(inv_idx), -abs(pay_total - inv_total))
+                if best is None or rank > best[0]:
+                    best = (rank, pay_idx, inv_idx)
+        return (best[1], best[2]) if best else None
+
+    # Large component: drop the single item that balances the nets, else fill invoices greedily
+    pay_total, inv_total = sum(pay_cents), sum(inv_cents)
+    for j in range(n_inv):
+        if abs(pay_total - (inv_total - inv_cents[j])) <= tolerance_cents:
+            return list(range(n_pay)), [k for k in range(n_inv) if k != j]
+    for i in range(n_pay):
+        if abs((pay_total - pay_cents[i]) - inv_total) <= tolerance_cents:
+            return [k for k in range(n_pay) if k != i], list(range(n_inv))
+
+    order = sorted(range(n_inv), key=lambda j: -abs(inv_cents[j]))
+    chosen, running, steps = [], 0, 0
+    for j in order:
+        steps += 1
+        if steps > NM_HEURISTIC_MAX_STEPS:
+            break
+        if abs(pay_total - (running + inv_cents[j])) < abs(pay_total - running):
+            chosen.append(j)
+            running += inv_cents[j]
+            if abs(pay_total - running) <= tolerance_cents:
+                return list(range(n_pay)), sorted(chosen)
+    return None
+
+
+# === 3c. INVOICE REFERENCES FROM MEMO TEXT ===
+class AhoCorasick:
+    """Multi-pattern matcher: one pass over a text finds every occurrence of every pattern"""
+
+    def __init__(self, patterns: Dict[str, Any]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[tuple]] = [[]]
+        for pattern, payload in patterns.items():
+            state = 0
+            for ch in pattern:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = nxt
+            self._out[state].append((pattern, payload))
+
+        # Breadth-first failure links; each state inherits the outputs of its failure state
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def iter_matches(self, text: str):
+        """Yield (start, end, pattern, payload) for every match, end exclusive"""
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(ch, 0)
+            for pattern, payload in self._out[state]:
+                yield i + 1 - len(pattern), i + 1, pattern, payload
+
+
+MEMO_REF_MIN_LENGTH = 4
+_ID_PREFIX = re.compile(r"^[A-Z]+[-_ /#.:]*")
+
+
+def invoice_id_variants(invoice_id: str) -> set:
+    """Spellings of an invoice ID that show up in remittance memos: INV-1001, INV1001, 1001"""
+    upper = invoice_id.strip().upper()
+    variants = {upper, re.sub(r"[^A-Z0-9]", "", upper)}
+    core = _ID_PREFIX.sub("", upper)
+    if core != upper and any(c.isdigit() for c in core):
+        variants.add(core)
+    return {v for v in variants if len(v) >= MEMO_REF_MIN_LENGTH}
+
+
+def build_memo_reference_matcher(invoice_ids: List[str]) -> Optional[AhoCorasick]:
+    patterns: Dict[str, str] = {}
+    ambiguous = set()
+    for iid in invoice_ids:
+        for variant in invoice_id_variants(iid):
+            if variant in patterns and patterns[variant] != iid:
+                ambiguous.add(variant)  # e.g. the same number under two prefixes
+            patterns.setdefault(variant, iid)
+    for variant in ambiguous:
+        del patterns[variant]
+    return AhoCorasick(patterns) if patterns else None
+
+
+def extract_memo_references(matcher: AhoCorasick, memo_text: str) -> List[str]:
+    """Invoice IDs named in a memo, in order of appearance; matches must sit on token boundaries"""
+    text = memo_text.upper()
+    found: Dict[str, None] = {}
+    for start, end, pattern, iid in matcher.iter_matches(text):
+        if start > 0 and text[start - 1].isalnum():
+            continue
+        if end < len(text) and text[end].isalnum():
+            continue
+        if pattern.isdigit():
+            # Skip numbers that are part of an amount such as 1001.50 or 2,1001
+            if end + 1 < len(text) and text[end] in ".," and text[end + 1].isdigit():
+                continue
+            if start >= 2 and text[start - 1] in ".," and text[start - 2].isdigit():
+                continue
+        found.setdefault(iid, None)
+    return list(found)
+
+
+# === 3d. NEAR-MISS INVOICE REFERENCES (typos, prefix variants) ===
+FUZZY_ID_MAX_DISTANCE = 1
+
+
+class BKTree:
+    """Burkhard-Keller tree: finds all strings within an edit distance without a full scan"""
+
+    def __init__(self, distance=OSA.distance):
+        self._distance = distance
+        self._root = None  # [item, {distance: child}]
+
+    def add(self, item: str) -> None:
+        if self._root is None:
+            self._root = [item, {}]
+            return
+        node = self._root
+        while True:
+            d = self._distance(item, node[0])
+            if d == 0:
+                return
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = [item, {}]
+                return
+            node = child
+
+    def search(self, query: str, max_distance: int) -> List[tuple]:
+        """All (distance, item) with distance <= max_distance"""
+        found = []
+        stack = [self._root] if self._root else []
+        while stack:
+            item, children = stack.pop()
+            d = self._distance(query, item)
+            if d <= max_distance:
+                found.append((d, item))
+            # Triangle inequality: only subtrees at distance d +/- max_distance can hold matches
+            for child_d, child in children.items():
+                if d - max_distance <= child_d <= d + max_distance:
+                    stack.append(child)
+        return found
+
+
+def _compact_id(invoice_id: str) -> str:
+    return re.sub(r"[^A-Z0-9]", "", invoice_id.upper())
+
+
+class InvoiceIdIndex:
+    """Resolves invoice references that are not exact keys: prefix/separator variants, then typos"""
+
+    def __init__(self, invoice_ids: List[str]):
+        self._variants: Dict[str, Optional[str]] = {}
+        self._compact: Dict[str, Optional[str]] = {}
+        for iid in invoice_ids:
+            for variant in invoice_id_variants(iid):
+                self._variants[variant] = iid if self._variants.get(variant, iid) == iid else None
+            compact = _compact_id(iid)
+            self._compact[compact] = iid if self._compact.get(compact, iid) == iid else None
+        self._tree = BKTree()
+        for compact, iid in self._compact.items():
+            if iid is not None:
+                self._tree.add(compact)
+
+    def resolve(self, reference: str) -> Optional[tuple]:
+        """(invoice_id, "normalized" | "fuzzy") for an unambiguous near-miss, else None"""
+        upper = reference.strip().upper()
+        for key in (upper, _compact_id(upper), _ID_PREFIX.sub("", upper)):
+            iid = self._variants.get(key)
+            if iid is not None:
+                return iid, "normalized"
+
+        compact = _compact_id(upper)
+        if len(compact) < MEMO_REF_MIN_LENGTH or FUZZY_ID_MAX_DISTANCE <= 0:
+            return None
+        hits = self._tree.search(compact, FUZZY_ID_MAX_DISTANCE)
+        if not hits:
+            return None
+        best = min(d for d, _ in hits)
+        nearest = [item for d, item in hits if d == best]
+        if len(nearest) != 1:
+            return None  # Equally close to two invoices - don't guess
+        return self._compact[nearest[0]], "fuzzy"
+
+
+# === 3e. CANDIDATE SUGGESTIONS (top-k invoices for HITL / no-match payments) ===
+MAX_TOP_K = 20
+SUGGESTION_CHUNK_CELLS = 4_000_000  # payment x invoice cells scored per batch
+NAME_TIERS = [(100, 100.0), (95, 95.0), (90, 90.0), (80, 80.0), (70, 70.0)]
+MEMO_TIERS = [(90, 100.0), (70, 70.0)]
+DATE_TIERS = [(0, 100.0), (1, 95.0), (3, 90.0), (7, 80.0), (10, 70.0), (30, 50.0)]
+
+
+def _date_ordinal(value: Optional[str]) -> float:
+    try:
+        return float(datetime.strptime(value, "%Y%m%d").toordinal())
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _similarity_tiers(left: List[str], right: List[str], tiers: List[tuple]) -> tuple:
+    """
+    Tiered token_set_ratio between every unique left and right string (vectorized with cdist).
+    Returns (matrix, left_index, right_index) so the score of pair (i, j) is
+    matrix[left_index[i], right_index[j]]. Empty strings score 0, as in name_score/memo_line_score.
+    """
+    left_unique = list(dict.fromkeys(s.upper() for s in left))
+    right_unique = list(dict.fromkeys(s.upper() for s in right))
+    left_pos = {s: i for i, s in enumerate(left_unique)}
+    right_pos = {s: i for i, s in enumerate(right_unique)}
+    raw = process.cdist(left_unique, right_unique, scorer=fuzz.token_set_ratio, workers=-1)
+    matrix = np.select([raw >= cutoff for cutoff, _ in tiers], [score for _, score in tiers], default=0.0)
+    matrix[[i for i, s in enumerate(left_unique) if not s.strip()], :] = 0.0
+    matrix[:, [j for j, s in enumerate(right_unique) if not s.strip()]] = 0.0
+    return (
+        matrix,
+        np.array([left_pos[s.upper()] for s in left], dtype=np.intp),
+        np.array([right_pos[s.upper()] for s in right], dtype=np.intp)
+    )
+
+
+def suggest_candidates(payments: List[Payment], invoices: List[OpenItem], top_k: int,
+                       pay_cents: Dict[str, int], inv_cents: Dict[str, int]) -> Dict[str, List[CandidateScore]]:
+    """
+    Top-k invoices per payment under the Step 4.5 weights. Scores are computed in batches of
+    payment rows as whole arrays; each row keeps only its k best via a partial sort.
+    """
+    if not payments or not invoices or top_k <= 0:
+        return {}
+    k = min(top_k, len(invoices))
+
+    name_mat, pay_name_idx, inv_name_idx = _similarity_tiers(
+        [p.customer_name for p in payments], [i.customer_name for i in invoices], NAME_TIERS)
+    memo_mat, pay_memo_idx, inv_memo_idx = _similarity_tiers(
+        [p.memo_text for p in payments], [i.memo_line for i in invoices], MEMO_TIERS)
+
+    hints = list(dict.fromkeys(p.payment_terms_hint for p in payments))
+    terms = list(dict.fromkeys(i.payment_terms for i in invoices))
+    terms_mat = np.array([[payment_terms_score(h, t) for t in terms] for h in hints])
+    hint_pos = {h: n for n, h in enumerate(hints)}
+    terms_pos = {t: n for n, t in enumerate(terms)}
+    pay_hint_idx = np.array([hint_pos[p.payment_terms_hint] for p in payments], dtype=np.intp)
+    inv_terms_idx = np.array([terms_pos[i.payment_terms] for i in invoices], dtype=np.intp)
+
+    pay_amount = np.array([pay_cents[p.payment_id] for p in payments], dtype=np.int64)
+    inv_amount = np.array([inv_cents[i.invoice_id] for i in invoices], dtype=np.int64)
+    pay_day = np.array([_date_ordinal(p.value_date or p.payment_date) for p in payments])
+    inv_day = np.array([_date_ordinal(i.due_in_date) for i in invoices])
+
+    suggestions: Dict[str, List[CandidateScore]] = {}
+    chunk = max(1, SUGGESTION_CHUNK_CELLS // len(invoices))
+    for start in range(0, len(payments), chunk):
+        rows = slice(start, start + chunk)
+        amount_diff = np.abs(pay_amount[rows, None] - inv_amount[None, :])
+        amount_s = np.where(amount_diff <= AMOUNT_EXACT_CENTS, 100.0, np.where(amount_diff <= AMOUNT_CLOSE_CENTS, 95.0, 60.0))
+        name_s = name_mat[pay_name_idx[rows]][:, inv_name_idx]
+        memo_s = memo_mat[pay_memo_idx[rows]][:, inv_memo_idx]
+        terms_s = terms_mat[pay_hint_idx[rows]][:, inv_terms_idx]
+        days = np.abs(pay_day[rows, None] - inv_day[None, :])
+        date_s = np.select([days <= cutoff for cutoff, _ in DATE_TIERS], [score for _, score in DATE_TIERS], default=20.0)
+        date_s[np.isnan(days)] = 50.0
+
+        total = np.minimum(100.0, 0.40 * amount_s + 0.25 * name_s + 0.20 * date_s + 0.10 * memo_s + 0.05 * terms_s)
+
+        # Bounded selection: O(n) partition to the k best, then order just those k
+        if k < total.shape[1]:
+            best = np.argpartition(-total, k - 1, axis=1)[:, :k]
+        else:
+            best = np.tile(np.arange(total.shape[1]), (total.shape[0], 1))
+        order = np.argsort(-np.take_along_axis(total, best, axis=1), axis=1, kind="stable")
+        best = np.take_along_axis(best, order, axis=1)
+
+        for r, pay in enumerate(payments[rows]):
+            suggestions[pay.payment_id] = [
+                CandidateScore(
+                    payment_id=pay.payment_id,
+                    invoice_id=invoices[j].invoice_id,
+                    customer_name=invoices[j].customer_name,
+                    total_open_amount=from_cents(int(inv_amount[j])),
+                    due_in_date=invoices[j].due_in_date,
+                    score=round(float(total[r, j]), 2),
+                    amount_score=float(amount_s[r, j]),
+                    name_score=float(name_s[r, j]),
+                    date_score=float(date_s[r, j]),
+                    memo_score=float(memo_s[r, j]),
+                    terms_score=float(terms_s[r, j])
+                )
+                for j in best[r]
+            ]
+    return suggestions
+
+
+# === 3f. DUPLICATE PAYMENTS ===
+DUPLICATE_DETECTION = True
+
+
+def _normalize_text(value: str) -> str:
+    return " ".join(re.sub(r"[^A-Z0-9]+", " ", value.upper()).split())
+
+
+def payment_fingerprint(pay: Payment) -> tuple:
+    """
+    Composite key a bank feed repeats verbatim when it delivers the same payment twice.
+    Invoice references are part of it: two equal payments against different invoices are legitimate.
+    """
+    cents = to_cents(pay.amount)
+    return (
+        _normalize_text(pay.customer_name),
+        -cents if pay.is_negative_payment else cents,
+        pay.payment_date,
+        _normalize_text(pay.memo_text),
+        tuple(sorted(_compact_id(iid) for iid in pay.invoice_ids))
+    )
+
+
+def find_duplicate_payments(payments: List[Payment]) -> Dict[str, str]:
+    """payment_id of each repeat -> payment_id of the first occurrence, in one hashing pass"""
+    first_seen: Dict[tuple, str] = {}
+    duplicates: Dict[str, str] = {}
+    for pay in payments:
+        original = first_seen.setdefault(payment_fingerprint(pay), pay.payment_id)
+        if original != pay.payment_id:
+            duplicates[pay.payment_id] = original
+    return duplicates
+
+
+# === 3g. DUE-DATE WINDOW FOR FUZZY CANDIDATES ===
+# date_score is flat (20) beyond 30 days, so by default Step 4.5 only scores open items due within
+# FUZZY_DATE_WINDOW_DAYS of the payment's value/payment date. 0 scores every item as before.
+FUZZY_DATE_WINDOW_DAYS = 30
+
+
+class DueDateIndex:
+    """Open items of one customer group sorted by due-date ordinal, for date-window candidate lookups"""
+
+    def __init__(self, invoices: List[OpenItem], inv_cents: Dict[str, int], window_days: Optional[int] = None):
+        self.window_days = FUZZY_DATE_WINDOW_DAYS if window_days is None else window_days
+        self._invoices = invoices
+        dated, self._undated = [], []
+        for pos, inv in enumerate(invoices):
+            day = _date_ordinal(inv.due_in_date)
+            if np.isnan(day):
+                self._undated.append(pos)  # date_score gives these 50 for any payment - always a candidate
+            else:
+                dated.append((int(day), pos))
+        dated.sort()
+        self._days = [day for day, _ in dated]
+        self._positions = [pos for _, pos in dated]
+        by_amount = sorted((inv_cents[invoices[pos].invoice_id], pos, day) for day, pos in dated)
+        self._amounts = [amount for amount, _, _ in by_amount]
+        self._by_amount = [(pos, day) for _, pos, day in by_amount]
+
+    def candidate_passes(self, pay: Payment, pay_cents: int):
+        """Yield the in-window candidates, then (lazily) the out-of-window fallback, in group order"""
+        anchor = _date_ordinal(pay.value_date or pay.payment_date)
+        if np.isnan(anchor):
+            yield self._invoices  # No usable payment date: every item scores date 50, nothing to prune
+            return
+        lo = bisect.bisect_left(self._days, anchor - self.window_days)
+        hi = bisect.bisect_right(self._days, anchor + self.window_days)
+        yield [self._invoices[pos] for pos in sorted(self._positions[lo:hi] + self._undated)]
+
+        # Fallback: outside the window date_score is at most 50, so a candidate can only reach the
+        # 75 acceptance score with an amount within 5.00 - look those up by amount instead of scanning
+        if self.window_days >= 10:
+            a_lo = bisect.bisect_left(self._amounts, pay_cents - AMOUNT_CLOSE_CENTS)
+            a_hi = bisect.bisect_right(self._amounts, pay_cents + AMOUNT_CLOSE_CENTS)
+            fallback = [pos for pos, day in self._by_amount[a_lo:a_hi] if abs(day - anchor) > self.window_days]
+        else:
+            fallback = [self._positions[i] for i in range(len(self._positions)) if i < lo or i >= hi]
+        yield [self._invoices[pos] for pos in sorted(fallback)]
+
+
+def run_reconciliation(request: ReconciliationRequest, top_k: int = 0, deadline: Optional[float] = None) -> ReconciliationResponse:
+    """
+    Run the matching engine (Steps 1 -> 5) on a validated request.
+    deadline is a time.monotonic() value; once it passes, the remaining stages are skipped and
+    the payments they would have handled are returned as unprocessed.
+    """
+    skipped_stages: List[str] = []
+
+    def out_of_time(stage: str) -> bool:
+        if skipped_stages or (deadline is not None and time.monotonic() >= deadline):
+            if stage not in skipped_stages:
+                skipped_stages.append(stage)
+            return True
+        return False
+
+    inv_map = {inv.invoice_id: inv for inv in request.open_items if inv.isOpen}
+    pay_map = {pay.payment_id: pay for pay in request.payments}
+
+    # Integer cents, converted once at ingest; floats only come back when a MatchGroup is built
+    pay_cents = {pay.payment_id: to_cents(pay.amount) for pay in request.payments}
+    inv_cents = {iid: to_cents(inv.total_open_amount) for iid, inv in inv_map.items()}
+    signed_pay = {pid: -c if pay_map[pid].is_negative_payment else c for pid, c in pay_cents.items()}
+    signed_inv = {iid: -c if inv_map[iid].is_credit else c for iid, c in inv_cents.items()}
+
+    # === STEP 0: INVOICE REFERENCES ===
+    # Explicit invoice_ids first; IDs that are not exact keys are resolved through a variant map
+    # and a BK-tree (typos), and payments without any get the IDs named in their memo_text,
+    # so they can go through the explicit-ID steps instead of the fuzzy stage.
+    # A remittance that lists the same invoice twice still pays it once
+    refs: Dict[str, List[str]] = {pay.payment_id: list(dict.fromkeys(pay.invoice_ids)) for pay in request.payments}
+    ref_notes: Dict[str, List[str]] = defaultdict(list)
+    fuzzy_refs: Dict[str, set] = defaultdict(set)  # payment_id -> typo-resolved invoice IDs
+
+    id_index = None
+    for pay in request.payments:
+        if all(iid in inv_map for iid in pay.invoice_ids):
+            continue
+        if id_index is None:
+            id_index = InvoiceIdIndex(list(inv_map))
+        resolved_ids = []
+        for iid in refs[pay.payment_id]:
+            resolved = None if iid in inv_map else id_index.resolve(iid)
+            if resolved is None:
+                resolved_ids.append(iid)
+                continue
+            if resolved[0] in pay.invoice_ids or resolved[0] in resolved_ids:
+                continue  # Resolves to an invoice the payment already names; don't match it twice
+            resolved_ids.append(resolved[0])
+            if resolved[1] == "fuzzy":
+                fuzzy_refs[pay.payment_id].add(resolved[0])
+                ref_notes[pay.payment_id].append(f"'{iid}' resolved to {resolved[0]} by edit distance - review required")
+            else:
+                ref_notes[pay.payment_id].append(f"'{iid}' resolved to {resolved[0]}")
+        refs[pay.payment_id] = resolved_ids
+
+    memo_only = [pay for pay in request.payments if not pay.invoice_ids and pay.memo_text.strip()]
+    matcher = build_memo_reference_matcher(list(inv_map)) if memo_only else None
+    if matcher is not None:
+        for pay in memo_only:
+            inferred = extract_memo_references(matcher, pay.memo_text)
+            if inferred:
+                refs[pay.payment_id] = inferred
+                ref_notes[pay.payment_id].append("invoice ID inferred from memo")
+
+    used_invoices = set()
+    used_payments = set()
+
+    high_conf = []
+    hitl = []
+    no_match = []
+    duplicates = []
+
+    # === STEP 0.5: DUPLICATE PAYMENTS ===
+    # Repeats of an earlier payment (same payer, amount, date and memo under another payment_id)
+    # are reported on their own and never reach the matching stages
+    if DUPLICATE_DETECTION:
+        for dup_id, original_id in find_duplicate_payments(request.payments).items():
+            pay = pay_map[dup_id]
+            duplicates.append(MatchGroup(
+                payment_ids=[dup_id],
+                invoice_ids=[],
+                total_payment_amount=from_cents(pay_cents[dup_id]),
+                total_invoice_amount=0.0,
+                net_amount_diff=from_cents(pay_cents[dup_id]),
+                avg_score=0.0,
+                id_scores=[], amount_scores=[], name_scores=[], date_scores=[],
+                memo_scores=[], terms_scores=[],
+                confidence="duplicate",
+                reason=f"Likely duplicate of {original_id}",
+                is_negative_payment=pay.is_negative_payment,
+                payment_memo_text=pay.memo_text
+            ))
+            used_payments.add(dup_id)
+
+    # === STEP 1: 1:1 MATCHING (One payment → one invoice) ===
+    for pay in request.payments:
+        if out_of_time("1:1"): break
+        if pay.payment_id in used_payments: continue
+        if len(refs[pay.payment_id]) != 1: continue  # Only 1:1
+
+        iid = refs[pay.payment_id][0]
+        if iid not in inv_map or iid in used_invoices: continue
+        inv = inv_map[iid]
+
+        net_diff = abs(pay_cents[pay.payment_id] - inv_cents[iid])
+        amount_score_net = amount_score_cents(net_diff)
+
+        name_s = name_score(pay.customer_name, inv.customer_name)
+        date_s = date_score(pay.payment_date, inv.due_in_date, pay.value_date)
+        memo_s = memo_line_score(pay.memo_text, inv.memo_line)
+        terms_s = payment_terms_score(pay.payment_terms_hint, inv.payment_terms)
+
+        final_score = min(100.0,
+            0.50 * 100.0 +
+            0.40 * amount_score_net +
+            0.05 * name_s +
+            0.025 * date_s +
+            0.015 * memo_s +
+            0.01 * terms_s
+        )
+
+        if final_score >= 90 and net_diff <= AMOUNT_EXACT_CENTS:
+            group = MatchGroup(
+                payment_ids=[pay.payment_id],
+                invoice_ids=[iid],
+                total_payment_amount=from_cents(pay_cents[pay.payment_id]),
+                total_invoice_amount=from_cents(inv_cents[iid]),
+                net_amount_diff=from_cents(net_diff),
+                avg_score=round(final_score, 2),
+                id_scores=[100.0],
+                amount_scores=[amount_score_net],
+                name_scores=[name_s],
+                date_scores=[date_s],
+                memo_scores=[memo_s],
+                terms_scores=[terms_s],
+                confidence="high",
+                reason="1:1 perfect match",
+                is_negative_payment=pay.is_negative_payment,
+                payment_memo_text=pay.memo_text,
+                invoice_payment_terms=[inv.payment_terms],
+                invoice_memo_lines=[inv.memo_line],
+                invoice_credit_flags=[inv.is_credit]
+            )
+
+            # Check for egregious name mismatch only if both names exist
+            if pay.customer_name.strip() and inv.customer_name.strip():
+                if name_s < 85:  # CHANGED from 40 to 85
+                    group.confidence = "hitl"
+                    if name_s < 40:
+                        group.reason = "1:1 match but customer name mismatch - review required"
+                    else:
+                        group.reason = f"1:1 match but name similarity only {name_s}% - review required"
+                    hitl.append(group)
+                    used_invoices.add(iid)
+                    used_payments.add(pay.payment_id)
+                    continue
+
+            high_conf.append(group)
+            used_invoices.add(iid)
+            used_payments.add(pay.payment_id)
+
+    # === STEP 1.5: N:M (Payments referencing overlapping invoice sets) ===
+    # Payments that share invoice references form connected components. Pure N:1 and 1:N components
+    # are left to steps 2 and 3; components with several payments AND several invoices are solved
+    # here as one net-amount match so the greedy order of steps 2/3 can't strand the leftovers.
+    ref_edges = [
+        (pay.payment_id, iid)
+        for pay in request.payments if pay.payment_id not in used_payments
+        for iid in dict.fromkeys(refs[pay.payment_id])
+        if iid in inv_map and iid not in used_invoices
+    ]
+    for comp_pay_ids, comp_inv_ids in connected_components(ref_edges):
+        if out_of_time("N:M"): break
+        if len(comp_pay_ids) < 2 or len(comp_inv_ids) < 2:
+            continue
+
+        comp_pays = [pay_map[pid] for pid in comp_pay_ids]
+        comp_invs = [inv_map[iid] for iid in comp_inv_ids]
+        inv_index = {iid: j for j, iid in enumerate(comp_inv_ids)}
+        solution = solve_nm_component(
+            [signed_pay[pid] for pid in comp_pay_ids],
+            [signed_inv[iid] for iid in comp_inv_ids],
+            [{inv_index[iid] for iid in refs[pay.payment_id] if iid in inv_index} for pay in comp_pays]
+        )
+        if solution is None:
+            continue  # No balanced subset - steps 2/3 and the fuzzy stage get these as before
+
+        pays = [comp_pays[i] for i in solution[0]]
+        invs = [comp_invs[j] for j in solution[1]]
+        net_pay = sum(signed_pay[pay.payment_id] for pay in pays)
+        net_open = sum(signed_inv[inv.invoice_id] for inv in invs)
+        net_diff = abs(net_pay - net_open)
+        amount_score_net = amount_score_cents(net_diff)
+        # The balanced subset may collapse to one payment or one invoice
+        shape = f"{'N' if len(pays) > 1 else '1'}:{('M' if len(pays) > 1 else 'N') if len(invs) > 1 else '1'}"
+
+        # One set of soft scores per referenced (payment, invoice) pair
+        selected_inv_ids = {inv.invoice_id for inv in invs}
+        edges = [(pay, inv_map[iid]) for pay in pays for iid in dict.fromkeys(refs[pay.payment_id]) if iid in selected_inv_ids]
+        soft_scores = []
+        for pay, inv in edges:
+            soft_scores.append({
+                "name": name_score(pay.customer_name, inv.customer_name),
+                "date": date_score(pay.payment_date, inv.due_in_date, pay.value_date),
+                "memo": memo_line_score(pay.memo_text, inv.memo_line),
+                "terms": payment_terms_score(pay.payment_terms_hint, inv.payment_terms)
+            })
+
+        force_hitl = False
+        force_hitl_reason = ""
+        for (pay, inv), scores in zip(edges, soft_scores):
+            if pay.customer_name.strip() and inv.customer_name.strip():
+                if scores["name"] < 85:
+                    force_hitl = True
+                    force_hitl_reason = f"{shape} match (overlapping references) but {pay.payment_id} -> {inv.invoice_id} has {scores['name']:.0f}% name similarity - review required"
+                    break
+
+        avg_name = sum(s["name"] for s in soft_scores) / len(soft_scores)
+        avg_date = sum(s["date"] for s in soft_scores) / len(soft_scores)
+        avg_memo = sum(s["memo"] for s in soft_scores) / len(soft_scores)
+        avg_terms = sum(s["terms"] for s in soft_scores) / len(soft_scores)
+
+        final_score = min(100.0,
+            0.50 * 100.0 +
+            0.40 * amount_score_net +
+            0.05 * avg_name +
+            0.025 * avg_date +
+            0.015 * avg_memo +
+            0.01 * avg_terms
+        )
+
+        group = MatchGroup(
+            payment_ids=[pay.payment_id for pay in pays],
+            invoice_ids=[inv.invoice_id for inv in invs],
+            total_payment_amount=from_cents(sum(pay_cents[pay.payment_id] for pay in pays)),
+            total_invoice_amount=from_cents(net_open),
+            net_amount_diff=from_cents(net_diff),
+            avg_score=round(final_score, 2),
+            id_scores=[100.0] * len(edges),
+            amount_scores=[amount_score_net] * len(edges),
+            name_scores=[s["name"] for s in soft_scores],
+            date_scores=[s["date"] for s in soft_scores],
+            memo_scores=[s["memo"] for s in soft_scores],
+            terms_scores=[s["terms"] for s in soft_scores],
+            confidence="",
+            reason="",
+            is_negative_payment=any(pay.is_negative_payment for pay in pays),
+            payment_memo_text="; ".join(pay.memo_text for pay in pays),
+            invoice_payment_terms=[inv.payment_terms for inv in invs],
+            invoice_memo_lines=[inv.memo_line for inv in invs],
+            invoice_credit_flags=[inv.is_credit for inv in invs]
+        )
+
+        if force_hitl:
+            group.confidence = "hitl"
+            group.reason = force_hitl_reason
+            hitl.append(group)
+        elif final_score >= 90 and net_diff <= AMOUNT_EXACT_CENTS:
+            group.confidence = "high"
+            group.reason = f"{shape} perfect net match (overlapping references)"
+            high_conf.append(group)
+        else:
+            group.confidence = "hitl"
+            group.reason = f"{shape} good match (overlapping references)"
+            hitl.append(group)
+
+        used_invoices.update(inv.invoice_id for inv in invs)
+        used_payments.update(pay.payment_id for pay in pays)
+
+    # === STEP 2: N:1 (Many payments → one invoice) ===
+    inv_to_pays = defaultdict(list)
+    for pay in request.payments:
+        if pay.payment_id in used_payments: continue
+
+        # ONLY include payments that reference EXACTLY ONE invoice
+        # Payments with multiple invoices belong in STEP 3 (1:N)
+        if len(refs[pay.payment_id]) == 1:
+            iid = refs[pay.payment_id][0]
+            if iid in inv_map and iid not in used_invoices:
+                inv_to_pays[iid].append(pay)
+
+    for inv_id, pays in inv_to_pays.items():
+        if out_of_time("N:1"): break
+        inv = inv_map[inv_id]
+
+        net_pay = sum(signed_pay[pay.payment_id] for pay in pays)
+        net_diff = abs(net_pay - inv_cents[inv_id])
+        amount_score_net = amount_score_cents(net_diff)
+
+        soft_scores = []
+        for pay in pays:
+            soft_scores.append({
+                "name": name_score(pay.customer_name, inv.customer_name),
+                "date": date_score(pay.payment_date, inv.due_in_date, pay.value_date),
+                "memo": memo_line_score(pay.memo_text, inv.memo_line),
+                "terms": payment_terms_score(pay.payment_terms_hint, inv.payment_terms)
+            })
+
+        # Check for individual name score violations
+        force_hitl = False
+        force_hitl_reason = ""
+        for pay, scores in zip(pays, soft_scores):
+            if pay.customer_name.strip() and inv.customer_name.strip():
+                if scores["name"] < 85:
+                    force_hitl = True
+                    force_hitl_reason = f"N:1 match but {pay.payment_id} has {scores['name']:.0f}% name similarity - review required"
+                    break  # Found one bad match, that's enough
+
+        avg_name = sum(s["name"] for s in soft_scores) / len(soft_scores)
+        avg_date = sum(s["date"] for s in soft_scores) / len(soft_scores)
+        avg_memo = sum(s["memo"] for s in soft_scores) / len(soft_scores)
+        avg_terms = sum(s["terms"] for s in soft_scores) / len(soft_scores)
+
+        final_score = min(100.0,
+            0.50 * 100.0 +
+            0.40 * amount_score_net +
+            0.05 * avg_name +
+            0.025 * avg_date +
+            0.015 * avg_memo +
+            0.01 * avg_terms
+        )
+
+        pay_ids = [pay.payment_id for pay in pays]
+        group = MatchGroup(
+            payment_ids=pay_ids,
+            invoice_ids=[inv_id],
+            total_payment_amount=from_cents(sum(pay_cents[pay.payment_id] for pay in pays)),
+            total_invoice_amount=from_cents(inv_cents[inv_id]),
+            net_amount_diff=from_cents(net_diff),
+            avg_score=round(final_score, 2),
+            id_scores=[100.0] * len(pays),
+            amount_scores=[amount_score_net] * len(pays),
+            name_scores=[s["name"] for s in soft_scores],
+            date_scores=[s["date"] for s in soft_scores],
+            memo_scores=[s["memo"] for s in soft_scores],
+            terms_scores=[s["terms"] for s in soft_scores],
+            confidence="",
+            reason="",
+            is_negative_payment=any(pay.is_negative_payment for pay in pays),
+            payment_memo_text="; ".join(pay.memo_text for pay in pays),
+            invoice_payment_terms=[inv.payment_terms],
+            invoice_memo_lines=[inv.memo_line],
+            invoice_credit_flags=[inv.is_credit]
+        )
+
+        # Check for forced HITL first (due to name score violations)
+        if force_hitl:
+            group.confidence = "hitl"
+            group.reason = force_hitl_reason
+            hitl.append(group)
+        elif final_score >= 90 and net_diff <= AMOUNT_EXACT_CENTS:
+            group.confidence = "high"
+            group.reason = "N:1 perfect net match"
+            high_conf.append(group)
+        elif final_score >= 80:
+            group.confidence = "hitl"
+            group.reason = "N:1 good match"
+            hitl.append(group)
+        else:
+            group.confidence = "no_match"
+            group.reason = "N:1 score too low"
+            no_match.append(group)
+
+        # Always mark invoice as used, regardless of confidence
+        used_invoices.add(inv_id)
+        for pay in pays:
+            used_payments.add(pay.payment_id)
+
+    # === STEP 3: 1:N (One payment → many invoices) ===
+    for pay in request.payments:
+        if out_of_time("1:N"): break
+        if pay.payment_id in used_payments: continue
+        if len(refs[pay.payment_id]) <= 1: continue  # Skip 1:1
+
+        valid_invoices = [
+            inv_map[iid] for iid in refs[pay.payment_id]
+            if iid in inv_map and iid not in used_invoices
+        ]
+
+        if len(valid_invoices) <= 1:
+            no_match.append(MatchGroup(
+                payment_ids=[pay.payment_id],
+                invoice_ids=[],
+                total_payment_amount=from_cents(pay_cents[pay.payment_id]),
+                total_invoice_amount=0.0,
+                net_amount_diff=from_cents(pay_cents[pay.payment_id]),
+                avg_score=0.0,
+                id_scores=[], amount_scores=[], name_scores=[], date_scores=[],
+                memo_scores=[], terms_scores=[],
+                confidence="no_match",
+                reason="No valid multi-invoice match",
+                is_negative_payment=pay.is_negative_payment,
+                payment_memo_text=pay.memo_text
+            ))
+            used_payments.add(pay.payment_id)
+            continue
+
+        net_open = sum(signed_inv[inv.invoice_id] for inv in valid_invoices)
+        target = signed_pay[pay.payment_id]
+        net_diff = abs(net_open - target)
+        amount_score_net = amount_score_cents(net_diff)
+
+        soft_scores = []
+        for inv in valid_invoices:
+            soft_scores.append({
+                "name": name_score(pay.customer_name, inv.customer_name),
+                "date": date_score(pay.payment_date, inv.due_in_date, pay.value_date),
+                "memo": memo_line_score(pay.memo_text, inv.memo_line),
+                "terms": payment_terms_score(pay.payment_terms_hint, inv.payment_terms)
+            })
+
+        # Check for individual name score violations (same as N:1 logic)
+        force_hitl = False
+        force_hitl_reason = ""
+        for inv, scores in zip(valid_invoices, soft_scores):
+            if pay.customer_name.strip() and inv.customer_name.strip():
+                if scores["name"] < 85:
+                    force_hitl = True
+                    force_hitl_reason = f"1:N match but {inv.invoice_id} has {scores['name']:.0f}% name similarity - review required"
+                    break  # Found one bad match, that's enough
+
+
+        avg_name = sum(s["name"] for s in soft_scores) / len(soft_scores)
+        avg_date = sum(s["date"] for s in soft_scores) / len(soft_scores)
+        avg_memo = sum(s["memo"] for s in soft_scores) / len(soft_scores)
+        avg_terms = sum(s["terms"] for s in soft_scores) / len(soft_scores)
+
+        final_score = min(100.0,
+            0.50 * 100.0 +
+            0.40 * amount_score_net +
+            0.05 * avg_name +
+            0.025 * avg_date +
+            0.015 * avg_memo +
+            0.01 * avg_terms
+        )
+
+        inv_ids = [inv.invoice_id for inv in valid_invoices]
+        group = MatchGroup(
+            payment_ids=[pay.payment_id],
+            invoice_ids=inv_ids,
+            total_payment_amount=from_cents(pay_cents[pay.payment_id]),
+            total_invoice_amount=from_cents(net_open),
+            net_amount_diff=from_cents(net_diff),
+            avg_score=round(final_score, 2),
+            id_scores=[100.0] * len(inv_ids),
+            amount_scores=[amount_score_net] * len(inv_ids),
+            name_scores=[s["name"] for s in soft_scores],
+            date_scores=[s["date"] for s in soft_scores],
+            memo_scores=[s["memo"] for s in soft_scores],
+            terms_scores=[s["terms"] for s in soft_scores],
+            confidence="",
+            reason="",
+            is_negative_payment=pay.is_negative_payment,
+            payment_memo_text=pay.memo_text,
+            invoice_payment_terms=[inv.payment_terms for inv in valid_invoices],
+            invoice_memo_lines=[inv.memo_line for inv in valid_invoices],
+            invoice_credit_flags=[inv.is_credit for inv in valid_invoices]
+        )
+
+        # Check for forced HITL first (due to name score violations)
+        if force_hitl:
+            group.confidence = "hitl"
+            group.reason = force_hitl_reason
+            hitl.append(group)
+        elif final_score >= 90 and net_diff <= AMOUNT_EXACT_CENTS:
+            group.confidence = "high"
+            group.reason = "1:N perfect net match"
+            high_conf.append(group)
+        elif final_score >= 80:
+            group.confidence = "hitl"
+            group.reason = "1:N good match"
+            hitl.append(group)
+        else:
+            group.confidence = "no_match"
+            group.reason = "1:N score too low"
+            no_match.append(group)
+
+        # Always mark invoices as used, regardless of confidence
+        used_invoices.update(inv_ids)
+        used_payments.add(pay.payment_id)
+
+    # Flag groups that rest on inferred or resolved invoice references;
+    # a typo-resolved reference is never enough for high confidence
+    if ref_notes:
+        for group in high_conf + hitl + no_match:
+            notes = [note for pid in group.payment_ids for note in ref_notes.get(pid, [])]
+            if notes:
+                group.reason = f"{group.reason} ({'; '.join(dict.fromkeys(notes))})"
+        for group in [g for g in high_conf if any(fuzzy_refs.get(pid, set()) & set(g.invoice_ids) for pid in g.payment_ids)]:
+            high_conf.remove(group)
+            group.confidence = "hitl"
+            hitl.append(group)
+
+    # === STEP 4.5: FUZZY MATCH within Customer Groups ===
+    # Get unmatched items with customer names
+    unmatched_payments = [
+        pay for pay in request.payments
+        if pay.payment_id not in used_payments and pay.customer_name.strip()
+    ]
+
+    unmatched_invoices = [
+        inv for inv in request.open_items
+        if inv.invoice_id not in used_invoices and inv.isOpen and inv.customer_name.strip()
+    ]
+
+    # Create fuzzy customer groups
+    customer_groups = []  # Each group: {'name': str, 'payments': [], 'invoices': []}
+
+    # Payments the fuzzy stage still has to look at; whatever is left when time runs out is unprocessed
+    fuzzy_pending = {pay.payment_id for pay in unmatched_payments}
+
+    # Group payments by fuzzy customer name
+    for pay in unmatched_payments:
+        if out_of_time("fuzzy"): break
+        found_group = False
+        for group in customer_groups:
+            if name_score(pay.customer_name, group['name']) >= 90:
+                group['payments'].append(pay)
+                found_group = True
+                break
+
+        if not found_group:
+            customer_groups.append({
+                'name': pay.customer_name,
+                'payments': [pay],
+                'invoices': []
+            })
+
+    # Group invoices by fuzzy customer name
+    for inv in unmatched_invoices:
+        if out_of_time("fuzzy"): break
+        found_group = False
+        for group in customer_groups:
+            if name_score(inv.customer_name, group['name']) >= 90:
+                group['invoices'].append(inv)
+                found_group = True
+                break
+
+        if not found_group:
+            customer_groups.append({
+                'name': inv.customer_name,
+                'payments': [],
+                'invoices': [inv]
+            })
+
+    # Within each customer group, do 1:1 fuzzy matching
+    for group in customer_groups:
+        due_index = DueDateIndex(group['invoices'], inv_cents) if FUZZY_DATE_WINDOW_DAYS > 0 and group['payments'] else None
+        for pay in group['payments']:
+            if out_of_time("fuzzy"): break
+            fuzzy_pending.discard(pay.payment_id)
+            if pay.payment_id in used_payments:
+                continue
+
+            best_match = None
+            best_score = 0
+
+            # Date-window candidates first; out-of-window items only if nothing in the window qualifies
+            passes = [group['invoices']] if due_index is None else due_index.candidate_passes(pay, pay_cents[pay.payment_id])
+            for candidates in passes:
+                for inv in candidates:
+                    if inv.invoice_id in used_invoices:
+                        continue
+
+                    # Score this potential match
+                    amount_diff = abs(pay_cents[pay.payment_id] - inv_cents[inv.invoice_id])
+                    amount_score_val = amount_score_cents(amount_diff)
+
+                    name_s = name_score(pay.customer_name, inv.customer_name)
+                    date_s = date_score(pay.payment_date, inv.due_in_date, pay.value_date)
+                    memo_s = memo_line_score(pay.memo_text, inv.memo_line)
+                    terms_s = payment_terms_score(pay.payment_terms_hint, inv.payment_terms)
+
+                    final_score = min(100.0,
+                                      0.40 * amount_score_val +
+                                      0.25 * name_s +
+                                      0.20 * date_s +
+                                      0.10 * memo_s +
+                                      0.05 * terms_s
+                                      )
+
+                    # Keep track of best match
+                    if final_score > best_score and final_score >= 70:
+                        best_score = final_score
+                        best_match = (inv, amount_diff, amount_score_val, name_s, date_s, memo_s, terms_s)
+
+                if best_score >= 75:
+                    break
+
+            # If found a good match, create a match group
+            if best_match:
+                inv, amount_diff, amount_score_val, name_s, date_s, memo_s, terms_s = best_match
+
+                group_match = MatchGroup(
+                    payment_ids=[pay.payment_id],
+                    invoice_ids=[inv.invoice_id],
+                    total_payment_amount=from_cents(pay_cents[pay.payment_id]),
+                    total_invoice_amount=from_cents(inv_cents[inv.invoice_id]),
+                    net_amount_diff=from_cents(amount_diff),
+                    avg_score=round(best_score, 2),
+                    id_scores=[0.0],
+                    amount_scores=[amount_score_val],
+                    name_scores=[name_s],
+                    date_scores=[date_s],
+                    memo_scores=[memo_s],
+                    terms_scores=[terms_s],
+                    confidence="",
+                    reason="",
+                    is_negative_payment=pay.is_negative_payment,
+                    payment_memo_text=pay.memo_text,
+                    invoice_payment_terms=[inv.payment_terms],
+                    invoice_memo_lines=[inv.memo_line],
+                    invoice_credit_flags=[inv.is_credit]
+                )
+
+                if best_score >= 85 and amount_diff <= AMOUNT_EXACT_CENTS:
+                    group_match.confidence = "high"
+                    group_match.reason = "Fuzzy match - exact amount + strong signals"
+                    high_conf.append(group_match)
+                    used_invoices.add(inv.invoice_id)
+                    used_payments.add(pay.payment_id)
+                elif best_score >= 75:
+                    group_match.confidence = "hitl"
+                    group_match.reason = "Fuzzy match - good candidate"
+                    hitl.append(group_match)
+                    used_invoices.add(inv.invoice_id)
+                    used_payments.add(pay.payment_id)
+
+
+    # === STEP 4: UNMATCHED ===
+    unprocessed_payment_ids = []
+    for pay in request.payments:
+        if pay.payment_id not in used_payments:
+            reason = "Unmatched payment"
+            if skipped_stages and (pay.payment_id in fuzzy_pending or skipped_stages[0] != "fuzzy"):
+                reason = f"Not processed - deadline exceeded during {skipped_stages[0]} stage"
+                unprocessed_payment_ids.append(pay.payment_id)
+            no_match.append(MatchGroup(
+                payment_ids=[pay.payment_id],
+                invoice_ids=[],
+                total_payment_amount=from_cents(pay_cents[pay.payment_id]),
+                total_invoice_amount=0.0,
+                net_amount_diff=from_cents(pay_cents[pay.payment_id]),
+                avg_score=0.0,
+                id_scores=[], amount_scores=[], name_scores=[], date_scores=[],
+                memo_scores=[], terms_scores=[],
+                confidence="no_match",
+                reason=reason,
+                is_negative_payment=pay.is_negative_payment,
+                payment_memo_text=pay.memo_text
+            ))
+
+    for inv in request.open_items:
+        if inv.invoice_id not in used_invoices and inv.isOpen:
+            no_match.append(MatchGroup(
+                payment_ids=[],
+                invoice_ids=[inv.invoice_id],
+                total_payment_amount=0.0,
+                total_invoice_amount=from_cents(inv_cents[inv.invoice_id]),
+                net_amount_diff=from_cents(inv_cents[inv.invoice_id]),
+                avg_score=0.0,
+                id_scores=[], amount_scores=[], name_scores=[], date_scores=[],
+                memo_scores=[], terms_scores=[],
+                confidence="no_match",
+                reason="Unmatched invoice (not fully processed - deadline exceeded)" if skipped_stages else "Unmatched invoice",
+                invoice_payment_terms=[inv.payment_terms],
+                invoice_memo_lines=[inv.memo_line],
+                invoice_credit_flags=[inv.is_credit]
+            ))
+
+    # === STEP 5: CANDIDATE SUGGESTIONS for reviewers ===
+    # Invoices already in a high-confidence match are settled; everything else is a candidate
+    if top_k > 0 and not out_of_time("candidate suggestions"):
+        settled = {iid for g in high_conf for iid in g.invoice_ids}
+        pool = [inv for inv in request.open_items if inv.isOpen and inv.invoice_id not in settled]
+        review_groups = [g for g in hitl + no_match if g.payment_ids]
+        review_payments = list({pid: pay_map[pid] for g in review_groups for pid in g.payment_ids}.values())
+        suggestions = suggest_candidates(review_payments, pool, top_k, pay_cents, inv_cents)
+        for g in review_groups:
+            g.candidates = [c for pid in g.payment_ids for c in suggestions.get(pid, [])]
+
+    # Calculate summary statistics (AFTER all processing is done)
+    hc_payments = sum(len(g.payment_ids) for g in high_conf)
+    hitl_payments = sum(len(g.payment_ids) for g in hitl)
+    nm_payments = sum(len(g.payment_ids) for g in no_match if len(g.payment_ids) > 0)
+    nm_invoices = sum(1 for g in no_match if len(g.invoice_ids) > 0 and len(g.payment_ids) == 0)
+
+    summary = ReconciliationSummary(
+        high_confidence_payments=hc_payments,
+        hitl_review_payments=hitl_payments,
+        no_match_payments=nm_payments,
+        no_match_invoices=nm_invoices,
+        total_payments_processed=len(request.payments),
+        total_invoices_processed=len(request.open_items),
+        unprocessed_payments=len(unprocessed_payment_ids),
+        duplicate_payments=len(duplicates)
+    )
+
+    return ReconciliationResponse(
+        high_confidence=high_conf,
+        hitl_review=hitl,
+        no_match=no_match,
+        summary=summary,
+        duplicates=duplicates,
+        partial=bool(skipped_stages),
+        skipped_stages=skipped_stages,
+        unprocessed_payment_ids=unprocessed_payment_ids
+    )
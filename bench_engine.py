@@ -0,0 +1,41 @@
+"""
+In-process benchmark of the matching engine (no HTTP, no cache).
+
+Runs run_reconciliation() on synthetic payloads of increasing size and reports the best of
+--repeat runs per size, so engine changes can be compared on the same machine:
+
+    python bench_engine.py --sizes 100 500 1000 --repeat 3
+"""
+import argparse
+import contextlib
+import io
+import time
+
+from synthetic_data import make_payload
+
+with contextlib.redirect_stdout(io.StringIO()):  # ar_matching prints its API_KEY debug lines on import
+    import ar_matching
+
+
+def bench(size: int, repeat: int) -> tuple:
+    request = ar_matching.ReconciliationRequest(**make_payload(size, int(size * 1.2), seed=size))
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = ar_matching.run_reconciliation(request)
+        best = min(best, time.perf_counter() - start)
+    return best, result.summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 500, 1000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'payments':>9} {'open items':>11} {'best ms':>10} {'high':>6} {'hitl':>6} {'no match':>9}")
+    for size in args.sizes:
+        seconds, summary = bench(size, args.repeat)
+        print(f"{size:>9} {int(size * 1.2):>11} {seconds * 1000:>10.1f} {summary.high_confidence_payments:>6} "
+              f"{summary.hitl_review_payments:>6} {summary.no_match_payments:>9}")
@@ -0,0 +1,105 @@
+"""
+Throughput benchmark for running ar_matching with 1..N uvicorn workers.
+
+Starts a local uvicorn per worker count, fires CONCURRENCY parallel /reconcile calls with
+synthetic payloads and reports requests/second. The result cache is disabled so every call
+does the full CPU-bound reconciliation, and the bench key's quota admits CONCURRENCY calls at
+once; anything still turned away with 429/503 is retried after Retry-After and counted.
+
+    python bench_workers.py --max-workers 4 --requests 64 --payments 500 --open-items 600
+
+Expect near-linear scaling up to the number of CPU cores and a flat line beyond it: the
+engine is pure CPU, so extra workers only help when there are idle cores. Size
+WEB_CONCURRENCY in the Dockerfile to the core count of the Railway instance.
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import time
+
+import requests
+
+from synthetic_data import make_payload
+
+API_KEY = "bench-key"
+PORT = 8765
+
+
+def wait_until_healthy(base_url: str, timeout: float = 30.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{base_url}/health", timeout=1).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("uvicorn did not become healthy in time")
+
+
+def run_one(workers: int, args) -> tuple:
+    """(requests/second, requests rejected with 429/503 and retried)"""
+    # The bench key may hold every request in flight at once, with no rate limit to speak of;
+    # the admission limits themselves are not what is being measured
+    quota = {"key": API_KEY, "max_concurrent": args.concurrency, "kb_per_second": 1e9, "burst_kb": 1e9}
+    env = dict(os.environ, API_KEYS=json.dumps({"bench": quota}), MAX_IN_FLIGHT=str(max(16, args.concurrency)),
+               RESULT_CACHE_SIZE="0", WEB_CONCURRENCY=str(workers))
+    env.pop("API_KEY", None)
+    env.pop("RESULT_CACHE_PATH", None)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "ar_matching:app", "--port", str(PORT),
+         "--workers", str(workers), "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL
+    )
+    base_url = f"http://127.0.0.1:{PORT}"
+    try:
+        wait_until_healthy(base_url)
+        payloads = [make_payload(args.payments, args.open_items, seed=i) for i in range(args.requests)]
+        session = requests.Session()
+        headers = {"X-API-Key": API_KEY}
+        rejected = []
+
+        def call(payload):
+            while True:
+                r = session.post(f"{base_url}/reconcile", json=payload, headers=headers, timeout=300)
+                if r.status_code not in (429, 503):
+                    break
+                # Admission control (or the memory budget) turned it away; count it and retry as a client would
+                rejected.append(r.status_code)
+                time.sleep(float(r.headers.get("Retry-After", "1")))
+            r.raise_for_status()
+
+        # Warm-up: one request per worker so imports and caches are not timed
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(call, payloads[:workers]))
+
+        rejected.clear()
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(call, payloads))
+        elapsed = time.perf_counter() - start
+        return args.requests / elapsed, len(rejected)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--payments", type=int, default=500)
+    parser.add_argument("--open-items", type=int, default=600)
+    args = parser.parse_args()
+
+    print(f"CPU cores: {os.cpu_count()} | payload: {args.payments} payments x {args.open_items} open items")
+    print(f"{'workers':>8} {'req/s':>10} {'speedup':>8} {'retried':>8}")
+    baseline = None
+    for workers in range(1, args.max_workers + 1):
+        rps, rejected = run_one(workers, args)
+        baseline = baseline or rps
+        print(f"{workers:>8} {rps:>10.2f} {rps / baseline:>7.2f}x {rejected:>8}")
@@ -0,0 +1,486 @@
+"""
+Differential test harness: ar_matching.run_reconciliation() vs the frozen ar_matching_reference.
+
+Generates random payment / open-item sets (overlapping references, typos, memo-only references,
+credits, negative payments, duplicates, ties, bad dates), runs both engines and asserts that
+every bucket holds the same MatchGroups with the same scores, and that the summaries agree.
+Independently of the reference it also checks invariants of the optimized engine (each payment
+reported exactly once, no invoice matched twice, summary consistent with the buckets, every group
+tagged with its stage), and that a run against a ledger snapshot of the open items returns what the
+same run with open_items returns.
+The reference is never edited: behavior the engine changed on purpose since it was frozen is listed
+in ALLOWED_DIFFERENCES, and the comparison accounts for exactly those changes.
+REGRESSION_CASES (fixed payloads) and TERMS_CASES (payment terms strings) have a known right answer
+and are checked before the random runs.
+
+On the first mismatch the payload is shrunk (delta debugging over payments and open items, then
+field simplification) to a minimal failing case, which is printed and written to --out.
+
+    python differential_harness.py --runs 500 --seed 0
+    python differential_harness.py --replay differential_failure.json
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+from collections import Counter
+from typing import Callable, NamedTuple, Optional
+
+# Settings under which the optimized engine must reproduce the reference exactly. Engine stages the
+# reference has no counterpart for are switched off here; deliberate changes to shared stages run
+# as deployed and are listed in ALLOWED_DIFFERENCES.
+PARITY_ENV = {
+    "FUZZY_DATE_WINDOW_DAYS": "30",
+    "DUPLICATE_DETECTION": "1",
+    "FUZZY_ID_MAX_DISTANCE": "1",
+    "MEMO_TFIDF_MATCHING": "0",    # Step 4.6 has no counterpart in the reference
+    "TERMS_DISCOUNT_MATCHING": "0",  # the reference compares short payments to the gross amount
+}
+os.environ.update(PARITY_ENV)
+os.environ.setdefault("API_KEY", "differential-harness")
+
+with contextlib.redirect_stdout(io.StringIO()):  # ar_matching prints its API_KEY debug lines on import
+    import ar_matching
+import ar_matching_reference
+
+NAMES = ["Acme Corporation", "ACME Corp", "Acme Corporation Ltd", "Globex Inc", "Globex", "Initech LLC",
+         "Umbrella Corp", "Stark Industries", "  globex inc ", ""]
+MEMOS = ["Consulting services", "Hardware order", "PAYMENT", "", "Payment for Invoice {num}", "INV{num} and more"]
+TERMS = ["NET 30", "NET 15", "2/10 NET 30", "2% 10 NET 30", "1.5% 15 N45", "DUE ON RECEIPT", ""]
+GROUP_FIELDS = ["payment_ids", "invoice_ids", "total_payment_amount", "total_invoice_amount", "net_amount_diff",
+                "avg_score", "id_scores", "amount_scores", "name_scores", "date_scores", "memo_scores",
+                "terms_scores", "confidence", "reason", "is_negative_payment"]
+STAGES = {"1:1", "N:1", "1:N", "N:M", "fuzzy", "memo", "duplicate", "deadline", "unmatched"}
+SUMMARY_FIELDS = ["high_confidence_payments", "hitl_review_payments", "no_match_payments", "no_match_invoices",
+                  "total_payments_processed", "total_invoices_processed"]
+
+
+def _item(invoice_id, amount, is_open=True, **fields):
+    return dict({"invoice_id": invoice_id, "customer_name": "Acme Corporation", "total_open_amount": amount,
+                 "due_in_date": "20250201", "isOpen": is_open, "payment_terms": "NET 30", "memo_line": ""}, **fields)
+
+
+def _payment(payment_id, amount, invoice_ids=(), **fields):
+    return dict({"payment_id": payment_id, "invoice_ids": list(invoice_ids), "customer_name": "Acme Corporation",
+                 "memo_text": "", "amount": amount, "payment_date": "20250201"}, **fields)
+
+
+# Fixed cases with a known right answer: (what they pin, payload, {payment_id: (bucket, invoice_ids)})
+REGRESSION_CASES = [
+    ("a reference to a closed invoice is not typo-resolved to an open one",
+     {"open_items": [_item("INV-1001", 500.0, is_open=False), _item("INV-1002", 700.0)],
+      "payments": [_payment("P1", 500.0, ["INV-1001"]), _payment("P2", 700.0)]},
+     {"P2": ("high_confidence", ["INV-1002"])}),
+    ("a typo-resolved reference must fit the payment amount",
+     {"open_items": [_item("INV-1002", 700.0)],
+      "payments": [_payment("P1", 500.0, ["INV-1003"]), _payment("P2", 700.0)]},
+     {"P2": ("high_confidence", ["INV-1002"])}),
+]
+
+# payment_terms strings and what parse_payment_terms must make of them (discount %, discount days, net days)
+TERMS_CASES = [
+    ("2/10 NET 30", (2.0, 10, 30)),
+    ("2/10, NET 30", (2.0, 10, 30)),
+    ("2% 10 NET 30", (2.0, 10, 30)),
+    ("1.5% 15 N45", (1.5, 15, 45)),
+    ("1.5%/15 n45", (1.5, 15, 45)),
+    ("NET 30", (0.0, 0, 30)),
+    ("DUE ON RECEIPT", (0.0, 0, 0)),
+    ("210 NET 30", None),
+    ("2/40 NET 30", None),
+]
+
+
+# === ALLOW-LIST: intentional differences from the frozen reference ===
+# Each entry names the request that changed the behavior and states the change. adjust_payload
+# rewrites the payload the reference runs on, adjust_reference rewrites the reference's response;
+# both apply the stated rule and nothing else, so any other difference still fails the run.
+# engine_settings are ar_matching globals for a second engine run that is compared with the reference;
+# check(default, compared) then holds the default run to what the change may alter.
+class AllowedDifference(NamedTuple):
+    request_id: str
+    change: str
+    adjust_payload: Optional[Callable[[dict], dict]] = None
+    adjust_reference: Optional[Callable[[object], object]] = None
+    engine_settings: Optional[dict] = None
+    check: Optional[Callable[[object, object], list]] = None
+
+
+def _unresolvable_references(payload: dict) -> dict:
+    """user-031: references the engine no longer resolves become IDs that resolve to nothing in the reference"""
+    ref = ar_matching_reference
+    request = ref.ReconciliationRequest(**payload)
+    inv_map = {inv.invoice_id: inv for inv in request.open_items if inv.isOpen}
+    known_ids = {inv.invoice_id for inv in request.open_items}
+    index = ref.InvoiceIdIndex(list(inv_map))
+    placeholders = {}
+    payments = []
+    for pay, raw in zip(request.payments, payload["payments"]):
+        refs = list(dict.fromkeys(pay.invoice_ids))
+        dropped = set()
+        if not all(iid in inv_map for iid in pay.invoice_ids):
+            for iid in refs:
+                if iid in inv_map:
+                    continue
+                if iid in known_ids:
+                    dropped.add(iid)  # the exact ID of a closed item
+                    continue
+                resolved = index.resolve(iid)
+                if resolved is not None and resolved[1] == "fuzzy":
+                    pay_c, inv_c = ref.to_cents(pay.amount), ref.to_cents(inv_map[resolved[0]].total_open_amount)
+                    fits = abs(pay_c - inv_c) <= ref.AMOUNT_CLOSE_CENTS if len(refs) == 1 else inv_c <= pay_c + ref.AMOUNT_CLOSE_CENTS
+                    if not fits:
+                        dropped.add(iid)
+        if dropped:
+            raw = dict(raw, invoice_ids=[placeholders.setdefault(iid, f"UNRESOLVED-{len(placeholders)}")
+                                         if iid in dropped else iid for iid in raw["invoice_ids"]])
+        payments.append(raw)
+    return dict(payload, payments=payments) if placeholders else payload
+
+
+def _nm_below_review_to_no_match(response):
+    """user-029: N:M groups under the review threshold are no_match, not hitl"""
+    for group in [g for g in response.hitl_review if "good match (overlapping references)" in g.reason and g.avg_score < 80]:
+        response.hitl_review.remove(group)
+        group.confidence = "no_match"
+        group.reason = group.reason.replace("good match (overlapping references)", "score too low (overlapping references)")
+        response.no_match.append(group)
+        response.summary.hitl_review_payments -= len(group.payment_ids)
+        response.summary.no_match_payments += len(group.payment_ids)
+    return response
+
+
+def _fuzzy_assignment_only(optimal, greedy) -> list:
+    """user-041: the optimal run may pair the payments and invoices Step 4.5 had left differently, nothing else"""
+    fuzzy_review = ar_matching.scoring_plan().thresholds.fuzzy_review
+    problems = []
+
+    def split(response):
+        fixed, pays, invs = Counter(), set(), set()
+        for bucket in ("high_confidence", "hitl_review", "no_match", "duplicates"):
+            for g in getattr(response, bucket):
+                if g.reason.startswith(("Fuzzy match", "Unmatched payment", "Unmatched invoice")):
+                    pays.update(g.payment_ids)
+                    invs.update(g.invoice_ids)
+                else:
+                    fixed[(bucket, _canonical_group(g))] += 1
+        return fixed, pays, invs
+
+    (fixed, pays, invs), (want_fixed, want_pays, want_invs) = split(optimal), split(greedy)
+    for side, extra in (("optimal", fixed - want_fixed), ("greedy", want_fixed - fixed)):
+        problems += [f"{bucket}: outside Step 4.5 only in {side}: {dict(zip(GROUP_FIELDS, g))}" for bucket, g in extra]
+    if (pays, invs) != (want_pays, want_invs):
+        problems.append("optimal and greedy assignment start Step 4.5 from different payments or invoices")
+    for g in optimal.high_confidence + optimal.hitl_review:
+        if g.reason.startswith("Fuzzy match") and (len(g.payment_ids) != 1 or len(g.invoice_ids) != 1 or g.avg_score < fuzzy_review):
+            problems.append(f"optimal fuzzy match is not a 1:1 pair at or above fuzzy_review: {g.payment_ids} {g.invoice_ids} {g.avg_score}")
+    for f in ("total_payments_processed", "total_invoices_processed", "duplicate_payments"):
+        if getattr(optimal.summary, f) != getattr(greedy.summary, f):
+            problems.append(f"summary.{f}: optimal {getattr(optimal.summary, f)} != greedy {getattr(greedy.summary, f)}")
+    return problems
+
+
+ALLOWED_DIFFERENCES = [
+    AllowedDifference("user-031", "An exact ID of a closed item is not typo-resolved to an open one, and a typo "
+                                  "resolution must fit the payment amount (all of it as the only reference, else a part)",
+                      adjust_payload=_unresolvable_references),
+    # Under the default weights an N:M net match scores at least 90, so this only shows with a scoring plan
+    AllowedDifference("user-029", "N:M groups below the review threshold (80) go to no_match instead of hitl",
+                      adjust_reference=_nm_below_review_to_no_match),
+    # The reference is compared with a greedy run; assignment_failures() checks the solver itself
+    AllowedDifference("user-041", "Step 4.5 pairs each customer group by maximum-weight assignment (FUZZY_ASSIGNMENT="
+                                  "optimal, the default) instead of first-come, best-unused-invoice",
+                      engine_settings={"FUZZY_ASSIGNMENT": "greedy"}, check=_fuzzy_assignment_only),
+]
+
+
+@contextlib.contextmanager
+def engine_settings(settings: dict):
+    saved = {name: getattr(ar_matching, name) for name in settings}
+    for name, value in settings.items():
+        setattr(ar_matching, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(ar_matching, name, value)
+
+
+def reference_response(payload: dict):
+    """The reference's response with the allow-listed changes applied"""
+    for allowed in ALLOWED_DIFFERENCES:
+        if allowed.adjust_payload:
+            payload = allowed.adjust_payload(payload)
+    response = ar_matching_reference.run_reconciliation(ar_matching_reference.ReconciliationRequest(**payload))
+    for allowed in ALLOWED_DIFFERENCES:
+        if allowed.adjust_reference:
+            response = allowed.adjust_reference(response)
+    return response
+
+
+def regression_failures() -> list:
+    failures = [f"parse_payment_terms({terms!r}) is {tuple(got) if got else got}, expected {want}"
+                for terms, want in TERMS_CASES
+                if (got := ar_matching.parse_payment_terms(terms)) != (tuple(want) if want else None)]
+    for what, payload, expected in REGRESSION_CASES:
+        response = ar_matching.run_reconciliation(ar_matching.ReconciliationRequest(**payload))
+        got = {pid: (bucket, sorted(g.invoice_ids)) for bucket in ("high_confidence", "hitl_review", "no_match", "duplicates")
+               for g in getattr(response, bucket) for pid in g.payment_ids}
+        for pid, want in expected.items():
+            if got.get(pid) != want:
+                failures.append(f"{what}: {pid} is {got.get(pid)}, expected {want}")
+        failures += [f"{what}: {p}" for p in differences(payload)]
+    return failures
+
+
+def assignment_failures(cases: int = 300, seed: int = 0) -> list:
+    """max_weight_assignment against exhaustive search on small random graphs with tied weights"""
+    failures = []
+    for case in range(cases):
+        rng = random.Random(seed * 1_000_003 + case)
+        n_left, n_right = rng.randint(1, 5), rng.randint(1, 5)
+        edges = [(f"P{i}", f"I{j}", float(rng.choice([75, 80, 85, 90, 95, 100])))
+                 for i in range(n_left) for j in range(n_right) if rng.random() < 0.5]
+        weight = {(left, right): w for left, right, w in edges}
+        pairs = ar_matching.max_weight_assignment(edges)
+        if any(p not in weight for p in pairs) or len({l for l, _ in pairs}) != len(pairs) or len({r for _, r in pairs}) != len(pairs):
+            failures.append(f"max_weight_assignment({edges}) is not a 1:1 subset of the edges: {pairs}")
+            continue
+        best = 0.0
+        lefts = sorted({left for left, _, _ in edges})
+        for rights in itertools.product(*[[None] + [r for l, r, _ in edges if l == left] for left in lefts]):
+            taken = [r for r in rights if r is not None]
+            if len(taken) == len(set(taken)):
+                best = max(best, sum(weight[(left, r)] for left, r in zip(lefts, rights) if r is not None))
+        if sum(weight[p] for p in pairs) != best:
+            failures.append(f"max_weight_assignment({edges}) weighs {sum(weight[p] for p in pairs)}, the best matching {best}")
+    return failures
+
+
+def random_payload(rng: random.Random, max_payments: int, max_open_items: int) -> dict:
+    """Small, adversarial payloads: few amounts and dates so ties and collisions are common"""
+    n_inv = rng.randint(1, max_open_items)
+    n_pay = rng.randint(1, max_payments)
+    amounts = [round(rng.choice([100, 250, 250.5, 999.99, 1000, 1000.75, 5000]) + rng.choice([0, 0, 0.5, 3, 7]), 2)
+               for _ in range(4)]
+    dates = ["20250101", "20250102", "20250110", "20250201", "20250315", "not-a-date"]
+    open_items = []
+    for i in range(n_inv):
+        open_items.append({
+            "invoice_id": rng.choice([f"INV-{1000 + i}", f"INV{1000 + i}", f"{1000 + i}"]),
+            "customer_name": rng.choice(NAMES[:-1]),
+            "total_open_amount": rng.choice(amounts),
+            "due_in_date": rng.choice(dates),
+            "isOpen": rng.random() > 0.1,
+            "payment_terms": rng.choice(TERMS),
+            "memo_line": rng.choice(MEMOS[:4]),
+            "is_credit": rng.random() < 0.1,
+        })
+    if rng.random() < 0.1:
+        open_items.append(dict(rng.choice(open_items), total_open_amount=rng.choice(amounts)))  # A reused invoice ID
+    payments = []
+    for j in range(n_pay):
+        refs = []
+        if rng.random() < 0.6:
+            for inv in rng.sample(open_items, rng.randint(1, min(3, len(open_items)))):
+                iid = inv["invoice_id"]
+                mutation = rng.random()
+                if mutation < 0.1:
+                    iid = iid.replace("-", "")
+                elif mutation < 0.15 and len(iid) > 2:
+                    iid = iid[:-2] + iid[-1] + iid[-2]  # transposed digits
+                refs.append(iid)
+        amount = rng.choice(amounts + [round(sum(rng.sample(amounts, 2)), 2)])
+        memo = rng.choice(MEMOS).format(num=1000 + rng.randrange(n_inv))
+        payment = {
+            "payment_id": f"PAY-{j}",
+            "invoice_ids": refs,
+            "customer_name": rng.choice(NAMES),
+            "memo_text": memo,
+            "amount": amount,
+            "is_negative_payment": rng.random() < 0.08,
+            "payment_date": rng.choice(dates),
+            "payment_terms_hint": rng.choice(TERMS),
+        }
+        if rng.random() < 0.3:
+            payment["value_date"] = rng.choice(dates)
+        payments.append(payment)
+        if rng.random() < 0.08:
+            payments.append(dict(payment, payment_id=f"PAY-{j}-dup"))
+    return {"payments": payments, "open_items": open_items}
+
+
+def _canonical_group(group) -> tuple:
+    data = group.model_dump()
+    return tuple(
+        tuple(round(v, 6) if isinstance(v, float) else v for v in data[f]) if isinstance(data[f], list)
+        else round(data[f], 6) if isinstance(data[f], float) else data[f]
+        for f in GROUP_FIELDS
+    )
+
+
+def _canonical(response) -> dict:
+    buckets = {
+        name: Counter(_canonical_group(g) for g in getattr(response, name))
+        for name in ("high_confidence", "hitl_review", "no_match", "duplicates")
+    }
+    buckets["summary"] = {f: getattr(response.summary, f) for f in SUMMARY_FIELDS}
+    return buckets
+
+
+def check_invariants(payload: dict, response) -> list:
+    problems = []
+    reported = Counter(pid for bucket in (response.high_confidence, response.hitl_review, response.no_match, response.duplicates)
+                       for g in bucket for pid in g.payment_ids)
+    for pay in payload["payments"]:
+        if reported[pay["payment_id"]] != Counter(p["payment_id"] for p in payload["payments"])[pay["payment_id"]]:
+            problems.append(f"payment {pay['payment_id']} reported {reported[pay['payment_id']]} times")
+    matched = Counter(iid for bucket in (response.high_confidence, response.hitl_review) for g in bucket for iid in g.invoice_ids)
+    problems += [f"invoice {iid} matched {n} times" for iid, n in matched.items() if n > 1]
+    if response.summary.high_confidence_payments != sum(len(g.payment_ids) for g in response.high_confidence):
+        problems.append("summary.high_confidence_payments disagrees with the bucket")
+    if response.summary.hitl_review_payments != sum(len(g.payment_ids) for g in response.hitl_review):
+        problems.append("summary.hitl_review_payments disagrees with the bucket")
+    problems += [f"{bucket}: group {g.payment_ids}/{g.invoice_ids} has stage {g.stage!r}"
+                 for bucket in ("high_confidence", "hitl_review", "no_match", "duplicates")
+                 for g in getattr(response, bucket) if g.stage not in STAGES]
+    return problems
+
+
+def differences(payload: dict) -> list:
+    """Empty when both engines agree and the optimized engine keeps its invariants"""
+    request = ar_matching.ReconciliationRequest(**payload)
+    optimized = ar_matching.run_reconciliation(request)
+    problems = check_invariants(payload, optimized)
+    settings = {name: value for allowed in ALLOWED_DIFFERENCES for name, value in (allowed.engine_settings or {}).items()}
+    if settings:
+        default = optimized
+        with engine_settings(settings):
+            optimized = ar_matching.run_reconciliation(request)
+        problems += check_invariants(payload, optimized)
+        for allowed in ALLOWED_DIFFERENCES:
+            if allowed.check:
+                problems += allowed.check(default, optimized)
+    reference = reference_response(payload)
+    got, want = _canonical(optimized), _canonical(reference)
+    for name in want:
+        if got[name] != want[name]:
+            if name == "summary":
+                problems.append(f"summary: optimized {got[name]} != reference {want[name]}")
+            else:
+                for side, extra in (("optimized", got[name] - want[name]), ("reference", want[name] - got[name])):
+                    for g in extra:
+                        problems.append(f"{name}: only in {side}: {dict(zip(GROUP_FIELDS, g))}")
+    return problems + ledger_differences(payload)
+
+
+LEDGER_PATH = os.path.join(tempfile.mkdtemp(prefix="differential_harness"), "ledger.bin")
+
+
+def ledger_differences(payload: dict, top_k: int = 3) -> list:
+    """
+    The open items as a ledger snapshot must give the open_items result (memo stage and suggestions
+    on), less the per-invoice "Unmatched invoice" groups a ledger run only counts
+    """
+    request = ar_matching.ReconciliationRequest(**payload)
+    ar_matching.write_ledger_snapshot(request.open_items, LEDGER_PATH)
+    ledger = ar_matching.LedgerSnapshot(LEDGER_PATH)
+    with engine_settings({"MEMO_TFIDF_MATCHING": True}):
+        want = ar_matching.run_reconciliation(request, top_k)
+        got = ar_matching.run_reconciliation(request.model_copy(update={"open_items": []}), top_k, ledger=ledger)
+    want.no_match = [g for g in want.no_match if g.payment_ids]
+    problems = []
+    for name in ("high_confidence", "hitl_review", "no_match", "duplicates", "summary"):
+        got_part, want_part = getattr(got, name), getattr(want, name)
+        if name != "summary":
+            got_part, want_part = sorted(g.model_dump_json() for g in got_part), sorted(g.model_dump_json() for g in want_part)
+        if got_part != want_part:
+            problems.append(f"ledger run {name}: {got_part} != open_items run {want_part}")
+    return problems
+
+
+def shrink(payload: dict) -> dict:
+    """Delta-debug the payload down to a minimal case that still fails"""
+    def fails(candidate):
+        try:
+            return bool(candidate["payments"] or candidate["open_items"]) and bool(differences(candidate))
+        except Exception:
+            return False  # A candidate that can't even be validated is not a smaller failure
+
+    current = json.loads(json.dumps(payload))
+    changed = True
+    while changed:
+        changed = False
+        for key in ("payments", "open_items"):
+            chunk = max(1, len(current[key]) // 2)
+            while chunk >= 1:
+                i = 0
+                while i < len(current[key]):
+                    candidate = dict(current, **{key: current[key][:i] + current[key][i + chunk:]})
+                    if fails(candidate):
+                        current, changed = candidate, True
+                    else:
+                        i += chunk
+                chunk //= 2
+        # Field simplification: blank out optional text and drop references one at a time
+        for key, fields in (("payments", {"memo_text": "", "payment_terms_hint": "", "value_date": None}),
+                            ("open_items", {"memo_line": "", "payment_terms": ""})):
+            for idx in range(len(current[key])):
+                for field, blank in fields.items():
+                    if current[key][idx].get(field) not in (blank, None):
+                        item = dict(current[key][idx], **{field: blank})
+                        candidate = dict(current, **{key: current[key][:idx] + [item] + current[key][idx + 1:]})
+                        if fails(candidate):
+                            current, changed = candidate, True
+        for idx, pay in enumerate(current["payments"]):
+            for ref in list(pay["invoice_ids"]):
+                item = dict(pay, invoice_ids=[r for r in pay["invoice_ids"] if r != ref])
+                candidate = dict(current, payments=current["payments"][:idx] + [item] + current["payments"][idx + 1:])
+                if fails(candidate):
+                    current, changed = candidate, True
+                    pay = item
+    return current
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-payments", type=int, default=12)
+    parser.add_argument("--max-open-items", type=int, default=14)
+    parser.add_argument("--out", default="differential_failure.json")
+    parser.add_argument("--replay", help="re-run a saved failing case instead of generating new ones")
+    args = parser.parse_args()
+
+    if args.replay:
+        with open(args.replay, "r", encoding="utf-8") as f:
+            problems = differences(json.load(f))
+        print("\n".join(problems) if problems else "Engines agree on the saved case.")
+        sys.exit(1 if problems else 0)
+
+    failures = regression_failures() + assignment_failures(seed=args.seed)
+    if failures:
+        print("\n".join(failures))
+        sys.exit(1)
+
+    for run in range(args.runs):
+        rng = random.Random(args.seed * 1_000_003 + run)
+        payload = random_payload(rng, args.max_payments, args.max_open_items)
+        problems = differences(payload)
+        if problems:
+            print(f"Mismatch on run {run} (seed {args.seed}): {len(problems)} difference(s). Shrinking...")
+            minimal = shrink(payload)
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(minimal, f, indent=2)
+            print(json.dumps(minimal, indent=2))
+            print("\n".join(differences(minimal)))
+            print(f"Minimal failing case written to {args.out}")
+            sys.exit(1)
+
+    print(f"OK: {len(REGRESSION_CASES) + len(TERMS_CASES)} regression cases, 300 assignment cases, {args.runs} random cases, "
+          f"optimized engine matches the reference.")
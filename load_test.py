@@ -0,0 +1,142 @@
+"""
+Open-loop load generator for /reconcile with latency percentiles per payload size class.
+
+Requests are sent on a Poisson schedule at --rates requests/second whether or not earlier ones have
+finished (open loop), so a saturated service shows up as growing latency and errors instead of the
+generator quietly slowing down. Latency is measured from the scheduled send time, so time spent
+queued behind a slow server counts. Every request carries a unique payment ID, so the result cache
+never answers it.
+
+    python load_test.py --rates 1 2 4 8 --duration 30                          # in-process app
+    python load_test.py --url http://127.0.0.1:8000 --api-key KEY --rates 5 10  # local uvicorn
+    python load_test.py --mix small=0.7 large=0.3 --rates 2 4
+
+Run it against uvicorn with the WEB_CONCURRENCY of the target Railway instance: the highest rate
+with no errors and an acceptable p99 is what one instance of that size sustains.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import time
+from collections import defaultdict
+
+import httpx
+import numpy as np
+
+from synthetic_data import make_payload
+
+# payments x open items per class
+SIZE_CLASSES = {"small": (20, 25), "medium": (200, 240), "large": (1000, 1000)}
+PAYLOADS_PER_CLASS = 8
+
+
+def build_client(args) -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    if args.url:
+        return httpx.AsyncClient(base_url=args.url.rstrip("/"), headers={"X-API-Key": args.api_key},
+                                 timeout=args.timeout, limits=limits)
+
+    # In-process: the ASGI app runs on this event loop, the engine in its threadpool
+    os.environ["API_KEY"] = args.api_key
+    os.environ["RESULT_CACHE_SIZE"] = "0"
+    os.environ.pop("RESULT_CACHE_PATH", None)
+    with contextlib.redirect_stdout(io.StringIO()):  # ar_matching prints its API_KEY debug lines on import
+        import ar_matching
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=ar_matching.app), base_url="http://in-process",
+                             headers={"X-API-Key": args.api_key}, timeout=args.timeout, limits=limits)
+
+
+def unique_payload(payload: dict, n: int) -> dict:
+    first = dict(payload["payments"][0], payment_id=f"{payload['payments'][0]['payment_id']}-load{n}")
+    return {**payload, "payments": [first] + payload["payments"][1:]}
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1000.0 if values else float("nan")
+
+
+async def run_rate(client, rate: float, args, payloads, mix) -> dict:
+    rng = random.Random(args.seed)
+    classes, weights = zip(*mix.items())
+    schedule, t = [], 0.0
+    while True:
+        t += rng.expovariate(rate)
+        if t >= args.duration:
+            break
+        schedule.append((t, rng.choices(classes, weights)[0]))
+
+    stats = defaultdict(lambda: {"latencies": [], "errors": defaultdict(int), "sent": 0})
+
+    async def fire(n, offset, size_class):
+        await asyncio.sleep(max(0.0, start + offset - time.perf_counter()))
+        stats[size_class]["sent"] += 1
+        payload = unique_payload(payloads[size_class][n % PAYLOADS_PER_CLASS], n)
+        try:
+            response = await client.post("/reconcile", json=payload)
+            outcome = "ok" if response.status_code == 200 else str(response.status_code)
+        except httpx.TimeoutException:
+            outcome = "timeout"
+        except httpx.TransportError as e:
+            outcome = type(e).__name__
+        latency = time.perf_counter() - (start + offset)  # From the scheduled time: queueing counts
+        if outcome == "ok":
+            stats[size_class]["latencies"].append(latency)
+        else:
+            stats[size_class]["errors"][outcome] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(fire(n, offset, size_class) for n, (offset, size_class) in enumerate(schedule)))
+    elapsed = time.perf_counter() - start
+    return {"elapsed": elapsed, "classes": stats}
+
+
+def report(rate: float, result: dict) -> None:
+    print(f"\noffered {rate:g} req/s for {result['elapsed']:.1f}s")
+    print(f"{'class':>8} {'sent':>6} {'ok':>6} {'err %':>6} {'ok/s':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}  errors")
+    rows = list(result["classes"].items())
+    everything = {"latencies": [l for _, s in rows for l in s["latencies"]], "sent": sum(s["sent"] for _, s in rows),
+                  "errors": defaultdict(int)}
+    for _, s in rows:
+        for outcome, count in s["errors"].items():
+            everything["errors"][outcome] += count
+    for name, s in sorted(rows) + [("all", everything)]:
+        lat, errors = s["latencies"], sum(s["errors"].values())
+        err_pct = 100.0 * errors / s["sent"] if s["sent"] else 0.0
+        print(f"{name:>8} {s['sent']:>6} {len(lat):>6} {err_pct:>6.1f} {len(lat) / result['elapsed']:>7.2f} "
+              f"{percentile(lat, 50):>9.1f} {percentile(lat, 95):>9.1f} {percentile(lat, 99):>9.1f} "
+              f"{max(lat) * 1000.0 if lat else float('nan'):>9.1f}  {dict(s['errors']) or ''}")
+
+
+async def main(args) -> None:
+    mix = {}
+    for entry in args.mix:
+        name, _, weight = entry.partition("=")
+        if name not in SIZE_CLASSES:
+            raise SystemExit(f"Unknown size class {name!r}; choose from {', '.join(SIZE_CLASSES)}")
+        mix[name] = float(weight or 1)
+    payloads = {
+        name: [make_payload(*SIZE_CLASSES[name], seed=seed) for seed in range(PAYLOADS_PER_CLASS)]
+        for name in mix
+    }
+    target = args.url or "in-process app (result cache off)"
+    print(f"Target: {target} | mix: {mix} | {args.duration:g}s per rate")
+    async with build_client(args) as client:
+        for rate in args.rates:
+            report(rate, await run_rate(client, rate, args, payloads, mix))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="base URL of a running instance; default runs the app in-process")
+    parser.add_argument("--api-key", default=os.getenv("API_KEY", "load-test-key"))
+    parser.add_argument("--rates", type=float, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per rate")
+    parser.add_argument("--mix", nargs="+", default=["small=0.6", "medium=0.3", "large=0.1"],
+                        help=f"size classes with weights, from {', '.join(SIZE_CLASSES)}")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--max-connections", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
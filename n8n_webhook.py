@@ -1,69 +1,194 @@
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import json
+import time
+import uuid
+import concurrent.futures
 
+CHUNK_SIZE = 256 * 1024  # Bytes read from disk per send; keeps memory flat for large PDFs/XLSX
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
-def send_raw_files_for_sniffing(webhook_url, folder_path, file_list, auth_token):
+
+class MultipartFileStream:
     """
-    Uploads files with NO metadata and GENERIC content-type headers.
-    This forces n8n to rely on Magic Bytes detection.
+    File-like multipart/form-data body for ONE file, read from disk chunk by chunk.
+    It has a known length, so requests sends a Content-Length instead of chunked encoding
+    (the n8n webhook node does not accept chunked uploads).
     """
-    # FIX: Initialize this BEFORE the try block so it exists if an error occurs immediately
-    open_files = []
-
-    try:
-        headers = {'auth': auth_token}
-        files_payload = []
-
-        print(f"Preparing {len(file_list)} files for 'Blind' Upload...")
-
-        for filename in file_list:
-            file_path = os.path.join(folder_path, filename)
-
-            if not os.path.exists(file_path):
-                print(f"⚠️ Skipped (Not Found): {filename}")
-                continue
-
-            f = open(file_path, 'rb')
-            open_files.append(f)
 
-            # CRITICAL FOR TESTING:
-            # We deliberately set Content-Type to 'application/octet-stream'.
-            # This forces the n8n Sniffer Node to look at the magic bytes.
-            files_payload.append(
-                ('data', (filename, f, 'application/octet-stream'))
-            )
-            print(f"  -> Added: {filename} [As generic binary]")
-
-        print(f"\nSending to n8n...")
-
-        # Note: We are NOT sending the 'data=' parameter (metadata). Just files.
-        response = requests.post(
-            webhook_url,
-            files=files_payload,
-            headers=headers
-        )
+    def __init__(self, file_path, field_name="data", filename=None, content_type="application/octet-stream",
+                 chunk_size=CHUNK_SIZE):
+        self.boundary = uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        filename = (filename or os.path.basename(file_path)).replace('"', "%22")
+        self._head = (
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'
+        ).encode("utf-8")
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self._file = open(file_path, "rb")
+        self._file_size = os.fstat(self._file.fileno()).st_size
+        self._parts = [self._head, None, self._tail]  # None = the file itself
+        self._pending = b""
+        self.bytes_sent = 0
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return len(self._head) + self._file_size + len(self._tail)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self)
+        out = self._pending
+        while len(out) < size and self._parts:
+            part = self._parts[0]
+            if part is None:
+                block = self._file.read(max(self.chunk_size, size - len(out)))
+                if not block:
+                    self._parts.pop(0)
+                    continue
+                out += block
+            else:
+                out += part
+                self._parts.pop(0)
+        out, self._pending = out[:size], out[size:]
+        self.bytes_sent += len(out)
+        return out
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StreamingUploader:
+    """
+    Uploads files to an n8n webhook, one streamed multipart POST per file, over a pooled
+    keep-alive session with at most max_workers uploads in flight. A failed file is retried
+    on its own (connection errors and 429/5xx), so one bad PDF never forces a re-send of the rest.
+    """
 
-        # Cleanup success path
-        for f in open_files:
-            f.close()
+    def __init__(self, webhook_url, auth_token, max_workers=4, max_retries=2, backoff=1.0, timeout=300,
+                 chunk_size=CHUNK_SIZE):
+        self.webhook_url = webhook_url
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({'auth': auth_token})
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def upload_file(self, file_path):
+        """Upload one file with retries; returns a per-file report (status, bytes, seconds, MB/s, response)"""
+        filename = os.path.basename(file_path)
+        report = {"file": filename, "ok": False, "status": None, "bytes": 0, "seconds": 0.0,
+                  "mb_per_s": 0.0, "attempts": 0, "response": None, "error": None}
+        if not os.path.exists(file_path):
+            report["error"] = "not found"
+            return report
+
+        for attempt in range(self.max_retries + 1):
+            report["attempts"] = attempt + 1
+            start = time.perf_counter()
+            try:
+                with MultipartFileStream(file_path, filename=filename, chunk_size=self.chunk_size) as body:
+                    response = self.session.post(
+                        self.webhook_url, data=body, headers={"Content-Type": body.content_type}, timeout=self.timeout
+                    )
+                    report["bytes"] = body.bytes_sent
+            except requests.exceptions.RequestException as e:
+                report["status"], report["error"] = None, str(e)
+                retryable = True
+            else:
+                report["status"] = response.status_code
+                retryable = response.status_code in RETRY_STATUSES
+                if response.ok:
+                    try:
+                        report["response"] = response.json()
+                    except ValueError:
+                        report["response"] = {"text_response": response.text}
+                    report["ok"], report["error"] = True, None
+                else:
+                    report["error"] = f"HTTP {response.status_code}: {response.text[:200]}"
+            finally:
+                report["seconds"] = round(time.perf_counter() - start, 3)
+
+            if report["ok"] or not retryable:
+                break
+            if attempt < self.max_retries:
+                time.sleep(self.backoff * (2 ** attempt))
+
+        if report["seconds"] > 0:
+            report["mb_per_s"] = round(report["bytes"] / report["seconds"] / 1_000_000, 3)
+        return report
+
+    def upload(self, folder_path, file_list, on_result=None):
+        """Upload files concurrently; on_result(report) is called as each file finishes. Returns reports in input order"""
+        paths = [os.path.join(folder_path, filename) for filename in file_list]
+        reports = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            future_to_path = {executor.submit(self.upload_file, path): path for path in paths}
+            for future in concurrent.futures.as_completed(future_to_path):
+                report = future.result()
+                reports[future_to_path[future]] = report
+                if on_result:
+                    on_result(report)
+        return [reports[path] for path in paths]
+
+
+def print_upload_report(report):
+    if report["ok"]:
+        print(f"  ✓ {report['file']}: {report['bytes'] / 1_000_000:.2f} MB in {report['seconds']:.2f}s "
+              f"({report['mb_per_s']:.2f} MB/s, attempt {report['attempts']})")
+    else:
+        print(f"  ✗ {report['file']}: {report['error']} (after {report['attempts']} attempt(s))")
+
+
+def send_raw_files_for_sniffing(webhook_url, folder_path, file_list, auth_token, max_workers=4):
+    """
+    Uploads files with NO metadata and GENERIC content-type headers.
+    This forces n8n to rely on Magic Bytes detection.
 
-        response.raise_for_status()
-        print(f"✓ Success! Status: {response.status_code}")
+    Each file is streamed as its own multipart POST (field 'data', application/octet-stream),
+    so n8n receives one execution per file. Returns {filename: n8n response} for the files
+    that made it, or None if none did.
+    """
+    print(f"Streaming {len(file_list)} files as generic binary ({max_workers} at a time)...")
 
-        # Return JSON if possible, else text
-        try:
-            return response.json()
-        except ValueError:
-            return {"text_response": response.text}
+    # CRITICAL FOR TESTING:
+    # Every part is sent as 'application/octet-stream'.
+    # This forces the n8n Sniffer Node to look at the magic bytes.
+    with StreamingUploader(webhook_url, auth_token, max_workers=max_workers) as uploader:
+        start = time.perf_counter()
+        reports = uploader.upload(folder_path, file_list, on_result=print_upload_report)
+        elapsed = time.perf_counter() - start
 
-    except Exception as e:
-        # Cleanup error path
-        # This is now safe because open_files was defined before 'try'
-        for f in open_files:
-            f.close()
-        print(f"✗ Error: {e}")
-        return None
+    sent = [r for r in reports if r["ok"]]
+    total_mb = sum(r["bytes"] for r in sent) / 1_000_000
+    print(f"\n{len(sent)}/{len(reports)} files uploaded, {total_mb:.2f} MB in {elapsed:.2f}s")
+    return {r["file"]: r["response"] for r in sent} or None
 
 
 if __name__ == "__main__":
@@ -90,4 +215,4 @@ if __name__ == "__main__":
     if result:
         print("\n=== Response from n8n ===")
         # Using json.dumps to make the output readable
-        print(json.dumps(result, indent=2))
\ No newline at end of file
+        print(json.dumps(result, indent=2))
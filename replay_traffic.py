@@ -0,0 +1,209 @@
+"""
+Replay a captured /reconcile corpus against one or two engine builds.
+
+The corpus is what ar_matching writes with TRAFFIC_CAPTURE_PATH set: pseudonymized production
+payloads (gzip JSONL) that keep the skew synthetic data lacks - one customer with 800 open items,
+memo texts that are all the same word. Each engine is a path to an ar_matching.py, loaded as its
+own module, so a checkout of any commit can serve as the baseline:
+
+    git show HEAD~5:ar_matching.py > /tmp/ar_matching_base.py
+    python replay_traffic.py capture.jsonl.gz                                   # current tree only
+    python replay_traffic.py capture.jsonl.gz --baseline /tmp/ar_matching_base.py --repeat 3
+
+Builds are called with what their run_reconciliation() accepts: top_k only where it exists (older
+builds compute no suggestions, so their times lack that stage), stage hooks only where there is a
+probe parameter (otherwise totals only). The original build, which computed inside the /reconcile
+endpoint, is driven through reconcile(request). Reported per engine: compute time percentiles and
+the time spent in each engine stage. With --baseline, every payment whose bucket or matched
+invoices differ between the two builds is counted by transition, with examples. The corpus summary
+states what the capture's pseudonyms keep: a "tokens" corpus does not exercise typo'd references
+or name variants the way production traffic does.
+"""
+import argparse
+import asyncio
+import contextlib
+import gzip
+import importlib.util
+import inspect
+import io
+import json
+import os
+import time
+from collections import Counter, defaultdict
+
+import numpy as np
+
+BUCKETS = ("high_confidence", "hitl_review", "no_match", "duplicates")
+# What each capture mode (TRAFFIC_CAPTURE_PSEUDONYMS) keeps from the original names, IDs and memos
+PSEUDONYM_LIMITS = {
+    "similarity": "letters and digits substituted one for one - equality, prefixes and edit distances kept; "
+                  "name scores may move a few points where token_set_ratio sorts words differently",
+    "tokens": "every word and number replaced by an unrelated token - typo'd references and misspelt or "
+              "abbreviated names no longer resemble the original, so BK-tree typo resolution and Step 4.5 "
+              "name grouping are under-exercised; re-capture with TRAFFIC_CAPTURE_PSEUDONYMS=similarity",
+}
+
+
+class StageTimer:
+    """Probe for run_reconciliation: wall time per stage of one run"""
+
+    def __init__(self):
+        self.stage = "setup"
+        self.started = time.perf_counter()
+        self.seconds = defaultdict(float)
+
+    def enter(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.seconds[self.stage] += now - self.started
+        self.stage, self.started = stage, now
+
+    def finish(self, request, top_k: int) -> None:
+        self.enter("done")
+
+
+def load_engine(path: str, name: str):
+    os.environ.setdefault("API_KEY", "replay-traffic")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    with contextlib.redirect_stdout(io.StringIO()):  # ar_matching prints its API_KEY debug lines on import
+        spec.loader.exec_module(module)
+    if hasattr(module, "run_reconciliation"):
+        parameters = inspect.signature(module.run_reconciliation).parameters
+        module.supports_top_k = "top_k" in parameters
+        module.supports_probe = "probe" in parameters
+    elif inspect.iscoroutinefunction(getattr(module, "reconcile", None)) and \
+            list(inspect.signature(module.reconcile).parameters) == ["request"]:
+        # Before run_reconciliation existed the engine ran inside the endpoint
+        module.run_reconciliation = lambda request: asyncio.run(module.reconcile(request))
+        module.supports_top_k = module.supports_probe = False
+    else:
+        raise SystemExit(f"{path} has neither run_reconciliation() nor a reconcile(request) endpoint")
+    return module
+
+
+def read_corpus(paths, limit=None):
+    entries = []
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entries.append(json.loads(line))
+                    if limit and len(entries) >= limit:
+                        return entries
+    return entries
+
+
+def assignments(response) -> dict:
+    """payment_id -> sorted (bucket, invoice_ids) of every group it appears in"""
+    out = defaultdict(list)
+    for bucket in BUCKETS:
+        for group in getattr(response, bucket, []):
+            for pid in group.payment_ids:
+                out[pid].append((bucket, tuple(sorted(group.invoice_ids))))
+    return {pid: sorted(groups) for pid, groups in out.items()}
+
+
+def run(engine, entry: dict, repeat: int) -> tuple:
+    """Best-of-repeat compute seconds, stage seconds of that run, and the response"""
+    request = engine.ReconciliationRequest(**entry["payload"])
+    best = None
+    for _ in range(repeat):
+        timer = StageTimer() if engine.supports_probe else None
+        options = {}
+        if engine.supports_top_k:
+            options["top_k"] = entry.get("top_k", 0)
+        if timer is not None:
+            options["probe"] = timer
+        start = time.perf_counter()
+        response = engine.run_reconciliation(request, **options)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, dict(timer.seconds) if timer else {}, response)
+    return best
+
+
+def describe_corpus(entries) -> None:
+    pays = [len(e["payload"]["payments"]) for e in entries]
+    items = [len(e["payload"]["open_items"]) for e in entries]
+    largest_customer, memo_share = 0, 0.0
+    for e in entries:
+        customers = Counter(i["customer_name"].upper() for i in e["payload"]["open_items"])
+        largest_customer = max([largest_customer] + list(customers.values()))
+        memos = Counter(p.get("memo_text", "").upper() for p in e["payload"]["payments"])
+        if memos:
+            memo_share = max(memo_share, memos.most_common(1)[0][1] / sum(memos.values()))
+    print(f"{len(entries)} requests | payments p50 {np.percentile(pays, 50):.0f} max {max(pays)} | "
+          f"open items p50 {np.percentile(items, 50):.0f} max {max(items)} | "
+          f"largest customer {largest_customer} open items | most common memo up to {memo_share:.0%} of a request")
+    # Captures written before the mode was recorded used per-token pseudonyms
+    for mode, count in Counter(e.get("pseudonyms", "tokens") for e in entries).most_common():
+        print(f"  {count} requests pseudonymized as '{mode}': {PSEUDONYM_LIMITS.get(mode, 'unknown mode')}")
+
+
+def report_engine(label: str, seconds: list, stages: dict) -> None:
+    ms = np.array(seconds) * 1000.0
+    print(f"\n{label}: total {ms.sum():.0f} ms | p50 {np.percentile(ms, 50):.1f} p95 {np.percentile(ms, 95):.1f} "
+          f"p99 {np.percentile(ms, 99):.1f} max {ms.max():.1f} ms per request")
+    if stages:
+        total = sum(stages.values()) or 1.0
+        for stage, s in sorted(stages.items(), key=lambda kv: -kv[1]):
+            print(f"  {stage:>22} {s * 1000.0:>10.1f} ms {100.0 * s / total:>6.1f}%")
+    else:
+        print("  (this build has no stage hooks - totals only)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus", nargs="+", help="capture file(s) written with TRAFFIC_CAPTURE_PATH")
+    parser.add_argument("--engine", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ar_matching.py"))
+    parser.add_argument("--baseline", help="ar_matching.py of the build to compare against")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per request; the fastest counts")
+    parser.add_argument("--limit", type=int, help="replay only the first N requests")
+    parser.add_argument("--examples", type=int, default=5, help="differing payments to print per transition")
+    args = parser.parse_args()
+
+    entries = read_corpus(args.corpus, args.limit)
+    if not entries:
+        raise SystemExit("Corpus is empty")
+    describe_corpus(entries)
+
+    engines = [("engine", load_engine(args.engine, "replay_engine"))]
+    if args.baseline:
+        engines.insert(0, ("baseline", load_engine(args.baseline, "replay_baseline")))
+
+    timings = {label: [] for label, _ in engines}
+    stages = {label: defaultdict(float) for label, _ in engines}
+    transitions, examples = Counter(), defaultdict(list)
+    for n, entry in enumerate(entries):
+        results = {}
+        for label, engine in engines:
+            seconds, stage_seconds, response = run(engine, entry, args.repeat)
+            timings[label].append(seconds)
+            for stage, s in stage_seconds.items():
+                stages[label][stage] += s
+            results[label] = assignments(response)
+        if args.baseline:
+            before, after = results["baseline"], results["engine"]
+            for pid in sorted(set(before) | set(after)):
+                old, new = before.get(pid, []), after.get(pid, [])
+                if old != new:
+                    old_bucket = ",".join(b for b, _ in old) or "-"
+                    new_bucket = ",".join(b for b, _ in new) or "-"
+                    key = (old_bucket, new_bucket if new_bucket != old_bucket else new_bucket + " (other invoices)")
+                    transitions[key] += 1
+                    if len(examples[key]) < args.examples:
+                        examples[key].append(f"request {n}: {pid} {old} -> {new}")
+
+    for label, engine in engines:
+        report_engine(f"{label} ({args.baseline if label == 'baseline' else args.engine})", timings[label], stages[label])
+        if not engine.supports_top_k and any(e.get("top_k") for e in entries):
+            print("  (this build takes no top_k - the captured suggestion requests were run without suggestions)")
+    if args.baseline:
+        base, new = sum(timings["baseline"]), sum(timings["engine"])
+        print(f"\nengine / baseline total time: {new / base:.3f}x")
+        if not transitions:
+            print("Bucket assignments identical for every payment.")
+        for (old, new_bucket), count in transitions.most_common():
+            print(f"\n{count:>6} payments {old} -> {new_bucket}")
+            for line in examples[(old, new_bucket)]:
+                print(f"         {line}")
@@ -0,0 +1,84 @@
+import random
+from datetime import datetime, timedelta
+
+
+CUSTOMERS = [
+    "Acme Corporation", "Globex Inc", "Initech LLC", "Umbrella Corp", "Stark Industries",
+    "Wayne Enterprises", "Wonka Industries", "Soylent Corp", "Hooli", "Vehement Capital",
+    "Massive Dynamic", "Cyberdyne Systems", "Tyrell Corporation", "Oscorp", "Gringotts Bank",
+]
+PAYMENT_TERMS = ["NET 30", "NET 15", "DUE ON RECEIPT", "2/10 NET 30", ""]
+MEMO_LINES = ["Consulting services", "Hardware order", "Software license", "Annual maintenance",
+              "Freight charges", "Cloud hosting", ""]
+
+
+def _date(base: datetime, offset_days: int) -> str:
+    return (base + timedelta(days=offset_days)).strftime("%Y%m%d")
+
+
+def make_payload(n_payments: int = 100, n_open_items: int = 120, seed: int = 0) -> dict:
+    """
+    Build a synthetic /reconcile payload.
+    Mix: explicit 1:1, N:1 splits, 1:N remittances, name/ID typos, memo-only references,
+    short payments and payments with no matching invoice.
+    """
+    rng = random.Random(seed)
+    base = datetime(2025, 1, 1)
+    customers = CUSTOMERS[:max(1, min(len(CUSTOMERS), n_open_items // 5 or 1))]
+
+    open_items = []
+    for i in range(n_open_items):
+        open_items.append({
+            "invoice_id": f"INV-{10000 + i}",
+            "customer_name": rng.choice(customers),
+            "total_open_amount": round(rng.uniform(50, 25000), 2),
+            "due_in_date": _date(base, rng.randint(0, 364)),
+            "isOpen": rng.random() > 0.02,
+            "payment_terms": rng.choice(PAYMENT_TERMS),
+            "memo_line": rng.choice(MEMO_LINES),
+            "is_credit": rng.random() < 0.03,
+        })
+
+    payments = []
+    available = list(open_items)
+    rng.shuffle(available)
+    for j in range(n_payments):
+        inv = available[j % len(available)] if available else None
+        if inv is None:
+            break
+        due = datetime.strptime(inv["due_in_date"], "%Y%m%d")
+        payment = {
+            "payment_id": f"PAY-{j}",
+            "invoice_ids": [],
+            "customer_name": inv["customer_name"],
+            "memo_text": inv["memo_line"],
+            "amount": inv["total_open_amount"],
+            "is_negative_payment": False,
+            "payment_date": _date(due, rng.randint(-5, 20)),
+            "payment_terms_hint": inv["payment_terms"],
+        }
+        kind = rng.random()
+        if kind < 0.35:
+            payment["invoice_ids"] = [inv["invoice_id"]]
+        elif kind < 0.45:
+            extra = rng.sample(open_items, 2)
+            payment["invoice_ids"] = [inv["invoice_id"]] + [e["invoice_id"] for e in extra]
+            payment["amount"] = round(inv["total_open_amount"] + sum(e["total_open_amount"] for e in extra), 2)
+        elif kind < 0.52:
+            payment["invoice_ids"] = [inv["invoice_id"]]
+            payment["amount"] = round(inv["total_open_amount"] / 2, 2)
+        elif kind < 0.58:
+            payment["invoice_ids"] = [inv["invoice_id"].replace("-", "")]
+        elif kind < 0.65:
+            payment["memo_text"] = f"Payment for Invoice {inv['invoice_id'][4:]}"
+        elif kind < 0.70:
+            payment["customer_name"] = inv["customer_name"].upper().replace("CORPORATION", "CORP")
+        elif kind < 0.78:
+            payment["customer_name"] = rng.choice(CUSTOMERS)
+            payment["amount"] = round(rng.uniform(50, 25000), 2)
+            payment["memo_text"] = "PAYMENT"
+        if rng.random() < 0.3:
+            payment["value_date"] = payment["payment_date"]
+        payments.append(payment)
+
+    return {"payments": payments, "open_items": open_items}
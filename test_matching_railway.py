@@ -4,11 +4,13 @@ from pathlib import Path
 from dotenv import load_dotenv
 import os
 
+from ar_client import ARMatchingClient, ARMatchingError
+
 # === Load environment variables ===
 load_dotenv()
 
 # === CONFIG ===
-API_URL = "https://armatching-production.up.railway.app/reconcile"
+API_URL = "https://armatching-production.up.railway.app"
 API_KEY = os.getenv("API_KEY")
 
 if not API_KEY:
@@ -37,23 +39,15 @@ print(f"   Payments: {len(payload.get('payments', []))}")
 print(f"   Open Items: {len(payload.get('open_items', []))}")
 print("-" * 50)
 
-# === Send to API ===
-headers = {
-    "X-API-Key": API_KEY,
-    "Content-Type": "application/json"
-}
-
+# === Send to API (pooled, retried, chunked to the server limits) ===
 try:
-    response = requests.post(API_URL, json=payload, headers=headers, timeout=30)
-    response.raise_for_status()
-except requests.exceptions.RequestException as e:
+    with ARMatchingClient(API_URL, API_KEY, timeout=30) as client:
+        result = client.reconcile(payload)
+except (ARMatchingError, requests.exceptions.RequestException) as e:
     print(f"API Error: {e}")
-    if hasattr(e, 'response') and e.response is not None:
-        print(f"Response: {e.response.text}")
     exit(1)
 
 # === Pretty print result ===
-result = response.json()
 print("\nAPI Response:")
 print(json.dumps(result, indent=2, ensure_ascii=False))
 